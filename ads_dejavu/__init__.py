@@ -1,10 +1,19 @@
 from ads_dejavu.database import get_database, Database
+from ads_dejavu.database_cache import CachedDatabase
+from ads_dejavu.bloom import BloomFilter
+from ads_dejavu.database_async import get_async_database
+from ads_dejavu.query import QueryHashes
+from ads_dejavu.recognize import FileRecognizer
 import ads_dejavu.decoder as decoder
 import ads_dejavu.fingerprint as fingerprint
 import multiprocessing
 import os
 import logging
-from resampy import resample
+import time
+import asyncio
+from contextlib import contextmanager
+from functools import partial
+from threading import RLock
 import numpy as np
 
 
@@ -18,34 +27,200 @@ class Dejavu(object):
     OFFSET_SECS = 'offset_seconds'
     AUDIO_LENGTH = 'audio_length'
     RELATIVE_CONFIDENCE = 'relative_confidence'
+    ROWS_FETCHED = 'rows_fetched'
+    MARGIN = 'margin'
+    QUERY_FRACTION = 'query_fraction'
+    EARLY_EXIT = 'early_exit'
+
+    # fingerprints buffered before each bulk insert
+    BULK_INSERT_ROWS = 1000000
 
     def __init__(self, config):
         super(Dejavu, self).__init__()
 
         self.config = config
 
+        # guards the stop-list and Bloom filter loaded on first use, queries
+        # being run from many threads at once
+        self._lock = RLock()
+
         # initialize db
         db_cls = get_database(config.get("database_type", None))
 
         self.db = db_cls(**config.get("database", {}))
-        self.db.setup()
+
+        # keep recently looked up hashes in memory
+        if self.config.get("cache", None) is not None:
+            self.db = CachedDatabase(self.db, **self.config["cache"])
+
+        # query-only nodes don't need to create tables nor
+        # to clean up songs left half fingerprinted
+        self.read_only = self.config.get("read_only", False)
+        if not self.read_only:
+            self.db.setup()
 
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
-        self.get_fingerprinted_songs()
+
+        # if True, offset differences are counted by the database and only
+        # the `alignment_top_k` most common ones are sent back
+        self.server_side_alignment = self.config.get("server_side_alignment", False)
+        self.alignment_top_k = self.config.get("alignment_top_k", 10)
+
+        # hashes of the files already fingerprinted, only loaded
+        # from the database when fingerprinting
+        self._songhashes_set = None
+
+        # hashes shared by too many songs are skipped when querying ("query"),
+        # and also left out when fingerprinting ("ingest")
+        self.stoplist_mode = self.config.get("stoplist", None)
+        self._stoplist = None
+
+        # Bloom filter of the stored hashes, to drop query hashes surely
+        # not in the database before looking them up
+        self.bloom_config = self.config.get("bloom_filter", None)
+        self._bloom = None
+        # (inode, mtime) of the filter file last merged in
+        self._bloom_file = None
+
+        # if set, recognizers look up query hashes in batches and stop as
+        # soon as one song leads clearly, see `recognize_progressive`
+        self.progressive = self.config.get("progressive", None)
+
+    @property
+    def songhashes_set(self):
+        if self._songhashes_set is None:
+            self.get_fingerprinted_songs()
+        return self._songhashes_set
 
     def get_fingerprinted_songs(self):
         # get songs previously indexed
         self.songs = self.db.get_songs()
-        self.songhashes_set = set()  # to know which ones we've computed before
+        songhashes_set = set()  # to know which ones we've computed before
         for song in self.songs:
             song_hash = song[Database.FIELD_FILE_SHA1]
-            self.songhashes_set.add(song_hash)
+            songhashes_set.add(song_hash)
+        self._songhashes_set = songhashes_set
+
+    def _register_song(self, file_hash):
+        # keep the known songs up to date without reloading all of them
+        self.songhashes_set.add(file_hash.upper())
+
+    @property
+    def stoplist(self):
+        if self._stoplist is None:
+            with self._lock:
+                if self._stoplist is None:
+                    self._stoplist = set(self.db.get_stoplist()) if self.stoplist_mode else set()
+        return self._stoplist
+
+    def rebuild_stoplist(self, max_postings):
+        """
+        Stop-lists the hashes with more than `max_postings` fingerprints.
+        In "ingest" mode their fingerprints are also deleted.
+        """
+        size = self.db.rebuild_stoplist(max_postings, prune=self.stoplist_mode == "ingest")
+        self._stoplist = None
+        return size
+
+    @property
+    def bloom(self):
+        if self.bloom_config is None:
+            return None
+        if self._bloom is None:
+            with self._lock:
+                if self._bloom is None:
+                    path = self.bloom_config.get("path", None)
+                    if path and os.path.exists(path):
+                        self._bloom_file = self._bloom_file_version(path)
+                        self._bloom = BloomFilter.load(path)
+                    else:
+                        self.build_bloom_filter()
+        else:
+            self._reload_bloom()
+        return self._bloom
+
+    @staticmethod
+    def _bloom_file_version(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _reload_bloom(self):
+        # other processes save the songs they fingerprint into the file, so
+        # it is merged in again whenever it changes
+        path = self.bloom_config.get("path", None)
+        if not path or self._bloom_file_version(path) in (None, self._bloom_file):
+            return
+        with self._lock:
+            version = self._bloom_file_version(path)
+            if version in (None, self._bloom_file):
+                return
+            saved = BloomFilter.load(path)
+            if self._bloom.compatible(saved):
+                self._bloom.merge(saved)
+            else:
+                # rebuilt with other parameters, from the whole database
+                self._bloom = saved
+            self._bloom_file = version
 
-    def fingerprint_directory(self, path, extensions, nprocesses=None):
+    def build_bloom_filter(self):
+        """
+        Builds the Bloom filter from every hash in the database, and saves it
+        if the configuration gives it a path.
+        """
+        capacity = self.bloom_config.get("capacity", None) or self.db.get_num_fingerprints()
+        bloom = BloomFilter(capacity, self.bloom_config.get("error_rate", 0.01))
+
+        hashes = []
+        for hash in self.db.get_hashes():
+            hashes.append(hash)
+            if len(hashes) >= 100000:
+                bloom.update(hashes)
+                hashes = []
+        bloom.update(hashes)
+
+        self._bloom = bloom
+        self._save_bloom()
+        logging.getLogger('dejavu').info("Bloom filter built with %(hashes)d hashes, %(bytes)d bytes, "
+                                         "%(false_positive_rate).4f false positive rate" % bloom.stats())
+        return bloom
+
+    def _save_bloom(self):
+        # merged with the saved filter, which may hold songs other processes
+        # fingerprinted meanwhile
+        if self._bloom is not None and self.bloom_config.get("path", None):
+            self._bloom.save(self.bloom_config["path"], merge=True)
+
+    def _index_hashes(self, hashes):
+        # a saved filter is loaded to add them, or it would miss these songs
+        # from then on; one neither loaded nor saved will be built from the
+        # database, these included
+        path = self.bloom_config.get("path", None) if self.bloom_config is not None else None
+        bloom = self.bloom if path and os.path.exists(path) else self._bloom
+        if bloom is not None:
+            bloom.update([x[0] for x in hashes])
+
+    def _fingerprints_to_insert(self, hashes):
+        hashes = set([(x[0], int(x[1])) for x in hashes])
+        if self.stoplist_mode == "ingest" and self.stoplist:
+            hashes = set([x for x in hashes if x[0].upper() not in self.stoplist])
+        return hashes
+
+    def fingerprint_directory(self, path, extensions, nprocesses=None, bulk=False, defer_indexes=False):
+        """
+        Fingerprints every file in `path` with one of the given extensions.
+
+        With `bulk`, fingerprints of many songs are buffered and sent with
+        `Database.insert_hashes_bulk`, which is much faster for initial
+        catalog builds. `defer_indexes` additionally drops the fingerprint
+        indexes for the whole run and rebuilds them at the end.
+        """
         # Try to use the maximum amount of processes if not given.
         try:
             nprocesses = nprocesses or multiprocessing.cpu_count()
@@ -54,6 +229,7 @@ class Dejavu(object):
         else:
             nprocesses = 1 if nprocesses <= 0 else nprocesses
 
+        self.db.before_fork()
         pool = multiprocessing.Pool(nprocesses)
 
         filenames_to_fingerprint = []
@@ -74,26 +250,53 @@ class Dejavu(object):
         iterator = pool.imap_unordered(_fingerprint_worker,
                                        worker_input)
 
-        # Loop till we have all of them
-        while True:
-            try:
-                song_name, hashes, file_hash, audio_length = iterator.next()
-            except multiprocessing.TimeoutError:
-                continue
-            except StopIteration:
-                break
-            except:
-                logging.getLogger('dejavu').exception("Failed fingerprinting")
-            else:
-                logging.getLogger('dejavu').debug("Inserting " + song_name + " in database")
-                sid = self.db.insert_song(song_name, file_hash, audio_length)
-
-                self.db.insert_hashes(sid, set([(x[0], int(x[1])) for x in hashes]))
-                self.db.set_song_fingerprinted(sid)
-                self.get_fingerprinted_songs()
-                logging.getLogger('dejavu').info(song_name + " inserted in database")
+        # Songs waiting to be bulk inserted
+        pending = []
+        pending_rows = 0
+
+        with self.db.deferred_indexes() if bulk and defer_indexes else _no_context():
+            # Loop till we have all of them
+            while True:
+                try:
+                    song_name, hashes, file_hash, audio_length = iterator.next()
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                except:
+                    logging.getLogger('dejavu').exception("Failed fingerprinting")
+                else:
+                    logging.getLogger('dejavu').debug("Inserting " + song_name + " in database")
+                    sid = self.db.insert_song(song_name, file_hash, audio_length)
+                    hashes = self._fingerprints_to_insert(hashes)
+
+                    if bulk:
+                        pending.append((sid, hashes, file_hash))
+                        pending_rows += len(hashes)
+                        if pending_rows >= Dejavu.BULK_INSERT_ROWS:
+                            self._insert_bulk(pending)
+                            pending, pending_rows = [], 0
+                        continue
+
+                    self.db.insert_hashes(sid, hashes)
+                    self._index_hashes(hashes)
+                    self.db.set_song_fingerprinted(sid)
+                    self._register_song(file_hash)
+                    logging.getLogger('dejavu').info(song_name + " inserted in database")
+
+            if pending:
+                self._insert_bulk(pending)
         pool.close()
         pool.join()
+        self._save_bloom()
+
+    def _insert_bulk(self, songs):
+        self.db.insert_hashes_bulk([(sid, hashes) for sid, hashes, _ in songs])
+        for sid, hashes, file_hash in songs:
+            self._index_hashes(hashes)
+            self.db.set_song_fingerprinted(sid)
+            self._register_song(file_hash)
+        logging.getLogger('dejavu').info("%d songs inserted in database" % len(songs))
 
     def fingerprint_file(self, filepath, song_name=None):
         songname = decoder.path_to_songname(filepath)
@@ -111,34 +314,140 @@ class Dejavu(object):
             logging.getLogger('dejavu').debug("Inserting " + song_name + " in database")
             sid = self.db.insert_song(song_name, file_hash, audio_length)
 
-            self.db.insert_hashes(sid, set([(x[0], int(x[1])) for x in hashes]))
+            hashes = self._fingerprints_to_insert(hashes)
+            self.db.insert_hashes(sid, hashes)
+            self._index_hashes(hashes)
             self.db.set_song_fingerprinted(sid)
-            self.get_fingerprinted_songs()
+            self._register_song(file_hash)
+            self._save_bloom()
             logging.getLogger('dejavu').info(song_name + " inserted in database")
 
-    def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS):
-        hashes = fingerprint.fingerprint(samples, Fs=Fs)
-        mapper = {}
+    def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS, as_arrays=False):
+        mapper, total_hashes = self._hash_mapper(fingerprint.fingerprint(samples, Fs=Fs))
+        if as_arrays:
+            return (self.db.return_matches(mapper, as_arrays=True), total_hashes)
+        return (self.db.return_matches(mapper), total_hashes)
+
+    def find_matches_batch(self, queries, Fs=fingerprint.DEFAULT_FS):
+        """
+            Same as `find_matches` for many queries at once. Hashes of all the
+            queries are looked up in the database together, once each.
+
+            queries: dictionary of query id => samples
+
+            Returns a dictionary of query id => (matches, total_hashes).
+        """
+        mappers = {}
+        for query_id, samples in queries.items():
+            mappers[query_id] = self._hash_mapper(fingerprint.fingerprint(samples, Fs=Fs))
+
+        found = self.match_hashes_batch(dict((query_id, mapper) for query_id, (mapper, _) in mappers.items()))
+        return dict((query_id, (found[query_id], total_hashes))
+                    for query_id, (_, total_hashes) in mappers.items())
+
+    def match_hashes_batch(self, mappers):
+        """
+            Looks up the hashes of many queries, given as a dictionary of
+            query id => `QueryHashes`, in a single database query.
+
+            Returns a dictionary of query id => list of
+            (sid, offset_difference) matches.
+        """
+        hashes = set()
+        for mapper in mappers.values():
+            hashes.update(mapper)
+
+        postings = {}
+        for hash, sid, offset in self.db.return_postings(hashes):
+            postings.setdefault(hash, []).append((hash, sid, offset))
+
+        return dict((query_id, list(mapper.matches(posting for hash in mapper for posting in postings.get(hash, ()))))
+                    for query_id, mapper in mappers.items())
+
+    def find_match_histogram(self, samples, Fs=fingerprint.DEFAULT_FS):
+        mapper, total_hashes = self._hash_mapper(fingerprint.fingerprint(samples, Fs=Fs))
+        return (self.db.return_match_histogram(mapper.items(), self.alignment_top_k), total_hashes)
+
+    def _hash_mapper(self, hashes):
+        """
+            Returns the `QueryHashes` of the (hash, offset) tuples of a query,
+            every offset of a repeated hash included, and the number of
+            hashes before dropping the stop-listed ones.
+        """
+        pairs = []
         total_hashes = 0
+        stoplist = self.stoplist
         for hash, offset in hashes:
-            mapper[hash.upper()[:fingerprint.FINGERPRINT_REDUCTION]] = offset
             total_hashes += 1
-        return (self.db.return_matches(mapper), total_hashes)
+            hash = hash.upper()[:fingerprint.FINGERPRINT_REDUCTION]
+            if hash in stoplist:
+                continue
+            pairs.append((hash, offset))
+        mapper = QueryHashes(pairs)
+
+        bloom = self.bloom
+        if bloom is not None and mapper:
+            hashes = mapper.keys()
+            mapper = mapper.subset([hash for hash, found in zip(hashes, bloom.contains_many(hashes)) if found])
+        return mapper, total_hashes
 
-    def align_matches(self, matches, total_hashes, audio_len=-1):
+    def lookup_hashes(self, hashes):
+        """
+            Returns the query offset, song id and offset difference of every
+            match of some (hash, offset) tuples, as three int64 arrays.
+        """
+        mapper, _ = self._hash_mapper(hashes)
+        postings = list(self.db.return_postings(mapper.keys())) if mapper else []
+        if not postings:
+            return (np.zeros(0, np.int64),) * 3
+        hashes, sids, offsets = zip(*postings)
+        sids, diffs, query_offsets = mapper.join([mapper.index[hash] for hash in hashes], sids, offsets,
+                                                 query_offsets=True)
+        return query_offsets, sids, diffs
+
+    def align_matches(self, matches, total_hashes, audio_len=-1, top_n=None):
         """
             Finds hash matches that align in time with other matches and finds
             consensus about which hashes are "true" signal from the audio.
 
-            Returns a dictionary with match information.
+            Returns a dictionary with match information, or with `top_n` a
+            list of up to `top_n` of them, one per song, best first and each
+            with the `margin` of its count over the next candidate.
+        """
+        if top_n is not None:
+            if not (isinstance(matches, tuple) and len(matches) == 2 and isinstance(matches[0], np.ndarray)):
+                matches = list(matches)
+                matches = (np.array([sid for sid, _ in matches], np.int64),
+                           np.array([diff for _, diff in matches], np.int64))
+            if len(matches[0]) == 0:
+                return []
+            return self._candidates(self._histogram(*matches), top_n, audio_len, len(matches[0]))
+
+        song_id, largest, largest_count, rows = self._align(matches)
+        return self._match_info(song_id, largest, largest_count, audio_len, rows)
+
+    @staticmethod
+    def _align(matches):
+        """
+            Returns the (song_id, offset_difference, count, rows) of the most
+            common (song_id, offset_difference) pair in `matches`, either
+            (sid, offset_difference) tuples or a tuple of two arrays as
+            returned by `Database.match_arrays`.
+
+            Ties go to the pair that reached the count first.
         """
+        if isinstance(matches, tuple) and len(matches) == 2 and isinstance(matches[0], np.ndarray):
+            return Dejavu._align_arrays(*matches)
+
         # align by diffs
         diff_counter = {}
         largest = 0
         largest_count = 0
         song_id = -1
+        rows = 0
         for tup in matches:
             sid, diff = tup
+            rows += 1
             if diff not in diff_counter:
                 diff_counter[diff] = {}
             if sid not in diff_counter[diff]:
@@ -150,8 +459,119 @@ class Dejavu(object):
                 largest_count = diff_counter[diff][sid]
                 song_id = sid
 
+        return song_id, largest, largest_count, rows
+
+    @staticmethod
+    def _histogram(sids, diffs):
+        """
+            Counts the (sid, offset_difference) pairs of two arrays.
+
+            Returns the sid, offset difference, count and index of the last
+            occurrence of every distinct pair, as four arrays.
+        """
+        # one int64 key per (sid, diff) pair
+        sids = np.asarray(sids, dtype=np.int64)
+        diffs = np.asarray(diffs, dtype=np.int64)
+        min_diff = diffs.min()
+        keys = sids * (int(diffs.max() - min_diff) + 1) + (diffs - min_diff)
+
+        # equal keys end up together, in the order they came in
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        ends = np.flatnonzero(np.append(sorted_keys[1:] != sorted_keys[:-1], True))
+        counts = np.diff(np.append(-1, ends))
+        last = order[ends]
+        return sids[last], diffs[last], counts, last
+
+    @staticmethod
+    def _align_arrays(sids, diffs):
+        """
+            Same as `_align` for arrays of song ids and offset differences,
+            counted with a sort instead of one dictionary update per row.
+        """
+        rows = len(sids)
+        if rows == 0:
+            return -1, 0, 0, 0
+
+        pair_sids, pair_diffs, counts, last = Dejavu._histogram(sids, diffs)
+        # the loop keeps the first pair to reach the largest count, which
+        # is the one whose last occurrence comes first
+        largest_count = counts.max()
+        winner = np.argmin(np.where(counts == largest_count, last, rows))
+        return int(pair_sids[winner]), int(pair_diffs[winner]), int(largest_count), rows
+
+    @staticmethod
+    def _rank(histogram, top_n):
+        """
+            Returns the (sid, offset_difference, count, margin) of the best
+            pair of the `top_n` songs with the largest counts in a histogram
+            as returned by `_histogram`, ranked like `_align` breaks ties.
+        """
+        pair_sids, pair_diffs, counts, last = histogram
+        order = np.lexsort((last, -counts))
+        # the first pair of each song in ranking order is its best one
+        _, first = np.unique(pair_sids[order], return_index=True)
+        best = order[np.sort(first)][:top_n + 1]
+
+        ranked = []
+        for i, pair in enumerate(best[:top_n]):
+            next_count = counts[best[i + 1]] if i + 1 < len(best) else 0
+            ranked.append((int(pair_sids[pair]), int(pair_diffs[pair]), int(counts[pair]),
+                           int(counts[pair] - next_count)))
+        return ranked
+
+    def _candidates(self, histogram, top_n, audio_len, rows_fetched):
+        ranked = self._rank(histogram, top_n)
+        songs = self.db.get_songs_by_ids([sid for sid, _, _, _ in ranked])
+
+        candidates = []
+        for sid, diff, count, margin in ranked:
+            match = self._song_match_info(songs.get(sid), sid, diff, count, audio_len, rows_fetched)
+            if match:
+                match[Dejavu.MARGIN] = margin
+                candidates.append(match)
+        return candidates
+
+    def align_histogram(self, histogram, total_hashes, audio_len=-1, top_n=None):
+        """
+            Same as `align_matches` for (sid, offset_difference, count) tuples
+            already counted by the database.
+        """
+        diff_counter = {}
+        last = {}
+        largest = 0
+        largest_count = 0
+        song_id = -1
+        rows = 0
+        for sid, diff, count in histogram:
+            diff_counter[(sid, diff)] = diff_counter.get((sid, diff), 0) + count
+            last[(sid, diff)] = rows
+            rows += 1
+
+            if diff_counter[(sid, diff)] > largest_count:
+                largest = diff
+                largest_count = diff_counter[(sid, diff)]
+                song_id = sid
+
+        if top_n is not None:
+            if not diff_counter:
+                return []
+            pairs = list(diff_counter)
+            histogram = (np.array([sid for sid, _ in pairs], np.int64),
+                         np.array([diff for _, diff in pairs], np.int64),
+                         np.array([diff_counter[pair] for pair in pairs], np.int64),
+                         np.array([last[pair] for pair in pairs], np.int64))
+            return self._candidates(histogram, top_n, audio_len, rows)
+
+        return self._match_info(song_id, largest, largest_count, audio_len, rows)
+
+    def _match_info(self, song_id, largest, largest_count, audio_len, rows_fetched):
         # extract idenfication
         song = self.db.get_song_by_id(song_id)
+        return self._song_match_info(song, song_id, largest, largest_count, audio_len, rows_fetched)
+
+    @staticmethod
+    def _song_match_info(song, song_id, largest, largest_count, audio_len, rows_fetched):
         if song:
             # TODO: Clarify what `get_song_by_id` should return.
             songname = song.get(Dejavu.SONG_NAME, None)
@@ -169,17 +589,217 @@ class Dejavu(object):
             Dejavu.SONG_NAME : songname,
             Dejavu.CONFIDENCE : largest_count,
             Dejavu.AUDIO_LENGTH : database_audio_len,
-            Dejavu.RELATIVE_CONFIDENCE : (largest_count * len_ratio * 100) / song['num_fingerprints'],
+            Dejavu.RELATIVE_CONFIDENCE : (largest_count * len_ratio * 100) / song[Database.FIELD_NUM_FINGERPRINTS],
             Dejavu.OFFSET : int(largest),
             Dejavu.OFFSET_SECS : nseconds,
+            Dejavu.ROWS_FETCHED : rows_fetched,
             Database.FIELD_FILE_SHA1 : song.get(Database.FIELD_FILE_SHA1, None),
         }
         return song
 
+    def recognize_many(self, clips, Fs=fingerprint.DEFAULT_FS):
+        """
+            Recognizes many clips with a single database lookup.
+
+            clips: dictionary of clip id => channels, a sequence of sample
+                   arrays already sampled at `Fs`
+
+            Returns a dictionary of clip id => match information, as
+            returned by `align_matches`.
+        """
+        t = time.time()
+        queries = {}
+        for clip_id, channels in clips.items():
+            for channeln, channel in enumerate(channels):
+                queries[(clip_id, channeln)] = channel
+        found = self.find_matches_batch(queries, Fs=Fs)
+
+        results = {}
+        for clip_id, channels in clips.items():
+            matches = []
+            total_hashes = 0
+            for channeln in range(len(channels)):
+                extracted_matches = found[(clip_id, channeln)]
+                total_hashes += extracted_matches[1]
+                matches.extend(extracted_matches[0])
+            match = self.align_matches(matches, total_hashes, len(channels[-1]) / Fs)
+            if match:
+                # time spent on the whole batch so far
+                match[Dejavu.MATCH_TIME] = time.time() - t
+            results[clip_id] = match
+        return results
+
+    def recognize_progressive(self, channels, Fs=fingerprint.DEFAULT_FS, batch_size=None, margin=None,
+                              deadline=None):
+        """
+            Recognizes a clip looking up its hashes a batch at a time, and
+            stops once the best song has `margin` more aligned hashes than
+            any other or `deadline` seconds have passed since the call.
+
+            Hashes repeated within the clip are queried last, as they are
+            the least distinctive, and every batch spans the whole clip.
+            Defaults come from the `progressive` configuration.
+
+            Returns the best match found so far as `align_matches` does,
+            plus the fraction of the query hashes looked up and whether it
+            stopped early.
+        """
+        t = time.time()
+        options = self.progressive or {}
+        batch_size = batch_size or options.get("batch_size", 500)
+        margin = margin if margin is not None else options.get("margin", 20)
+        deadline = deadline if deadline is not None else options.get("deadline", None)
+
+        # (channel, hash) entries, with the query offsets by channel
+        mappers = []
+        repetitions = {}
+        for channel in channels:
+            mapper, _ = self._hash_mapper(fingerprint.fingerprint(channel, Fs=Fs))
+            for hash in mapper:
+                repetitions[hash] = repetitions.get(hash, 0) + len(mapper.offsets_of(hash))
+            mappers.append(mapper)
+        entries = [(channeln, hash) for channeln, mapper in enumerate(mappers)
+                   for hash in sorted(mapper, key=lambda hash: mapper.offsets_of(hash)[0])]
+
+        # rarest first, and within a rarity the i-th hash goes to batch i % batches
+        batches = max(1, -(-len(entries) // batch_size))
+        order = sorted(range(len(entries)),
+                       key=lambda i: (repetitions[entries[i][1]], i % batches, i))
+
+        # best (count, offset_difference) by song, and count by pair
+        counts = {}
+        best = {}
+        rows = 0
+        queried = 0
+        leader = runner_up = (0, 0, -1)
+        early_exit = False
+        for start in range(0, len(order), batch_size):
+            batch = [entries[i] for i in order[start:start + batch_size]]
+            queried += len(batch)
+            for channeln, mapper in enumerate(mappers):
+                batch_mapper = mapper.subset([hash for n, hash in batch if n == channeln])
+                if not batch_mapper:
+                    continue
+                sids, diffs = self.db.return_matches(batch_mapper, as_arrays=True)
+                rows += len(sids)
+                if len(sids) == 0:
+                    continue
+                for sid, diff, count in zip(*[column.tolist() for column in self._histogram(sids, diffs)[:3]]):
+                    count = counts[(sid, diff)] = counts.get((sid, diff), 0) + count
+                    if count > best.get(sid, (0,))[0]:
+                        best[sid] = (count, diff)
+
+            if best:
+                top = sorted(((count, diff, sid) for sid, (count, diff) in best.items()),
+                             key=lambda x: x[0], reverse=True)[:2]
+                leader = top[0]
+                runner_up = top[1] if len(top) > 1 else (0, 0, -1)
+            if start + batch_size >= len(order):
+                break
+            if leader[0] - runner_up[0] >= margin or (deadline is not None and time.time() - t >= deadline):
+                early_exit = True
+                break
+
+        largest_count, largest, song_id = leader
+        match = self._match_info(song_id, largest, largest_count, len(channels[-1]) / float(Fs), rows)
+        if match:
+            match[Dejavu.MARGIN] = leader[0] - runner_up[0]
+            match[Dejavu.QUERY_FRACTION] = queried / float(len(entries)) if entries else 1.
+            match[Dejavu.EARLY_EXIT] = early_exit
+            match[Dejavu.MATCH_TIME] = time.time() - t
+        return match
+
     def recognize(self, recognizer, *options, **kwoptions):
         r = recognizer(self)
         return r.recognize(*options, **kwoptions)
 
+    def recognize_directory(self, path, extensions, nprocesses=None, top_n=None):
+        """
+        Recognizes every file in `path` with one of the given extensions on a
+        pool of processes, each keeping its own `Dejavu` and database
+        connection for all the files it gets.
+
+        Yields a dictionary per file as soon as it is done, in no particular
+        order: its name, the match (or the `top_n` best candidates) and the
+        seconds spent decoding and in total, or the error that stopped it.
+        """
+        try:
+            nprocesses = nprocesses or multiprocessing.cpu_count()
+        except NotImplementedError:
+            nprocesses = 1
+        else:
+            nprocesses = 1 if nprocesses <= 0 else nprocesses
+
+        filenames = [filename for filename, _ in decoder.find_files(path, extensions)]
+        self.db.before_fork()
+        pool = multiprocessing.Pool(nprocesses, initializer=_init_recognize_worker, initargs=(self.config,))
+        try:
+            for result in pool.imap_unordered(partial(_recognize_worker, top_n=top_n), filenames):
+                yield result
+        finally:
+            # also stops the workers if the caller doesn't want all files
+            pool.terminate()
+            pool.join()
+
+
+class AsyncDejavu(object):
+    """
+    Recognition as coroutines, so one event loop serves many concurrent
+    requests. Fingerprinting runs on `executor` (the loop's default one when
+    None) and database lookups go through the async counterpart of the
+    configured database, see `get_async_database`.
+
+    ```python
+    djv = AsyncDejavu(config)
+    match = await djv.recognize(channels, Fs)
+    await djv.close()
+    ```
+    """
+
+    def __init__(self, config, executor=None):
+        super(AsyncDejavu, self).__init__()
+        # the blocking instance keeps the configuration, stop-list and bloom filter
+        self.dejavu = Dejavu(config)
+        self.executor = executor
+        self.db = get_async_database(self.dejavu.db, executor)
+
+    async def _run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS):
+        hashes = await self._run(fingerprint.fingerprint, samples, Fs=Fs)
+        # the first call loads the stop-list and bloom filter, which blocks
+        mapper, total_hashes = await self._run(self.dejavu._hash_mapper, hashes)
+        return await self.db.return_matches(mapper), total_hashes
+
+    async def align_matches(self, matches, total_hashes, audio_len=-1):
+        song_id, largest, largest_count, rows = await self._run(self.dejavu._align, matches)
+        song = await self.db.get_song_by_id(song_id)
+        return Dejavu._song_match_info(song, song_id, largest, largest_count, audio_len, rows)
+
+    async def recognize(self, channels, Fs=fingerprint.DEFAULT_FS):
+        """
+            Recognizes a clip, given as a sequence of sample arrays already
+            sampled at `Fs`, and returns the match information as
+            `Dejavu.align_matches` does.
+        """
+        t = time.time()
+        found = await asyncio.gather(*[self.find_matches(channel, Fs=Fs) for channel in channels])
+        matches = [match for extracted_matches, _ in found for match in extracted_matches]
+        total_hashes = sum(hashes for _, hashes in found)
+        match = await self.align_matches(matches, total_hashes, len(channels[-1]) / Fs)
+        if match:
+            match[Dejavu.MATCH_TIME] = time.time() - t
+        return match
+
+    async def recognize_file(self, filename):
+        frames, Fs, _, _ = await self._run(decoder.read, filename, self.dejavu.limit)
+        frames, Fs = await self._run(decoder.preprocess, frames, Fs)
+        return await self.recognize(frames, Fs=Fs)
+
+    async def close(self):
+        await self.db.close()
+
 
 def _fingerprint_worker(filename, limit=None, song_name=None):
     # Pool.imap sends arguments as tuples so we have to unpack
@@ -192,15 +812,7 @@ def _fingerprint_worker(filename, limit=None, song_name=None):
     songname, extension = os.path.splitext(os.path.basename(filename))
     song_name = song_name or songname
     channels, Fs, file_hash, audio_length = decoder.read(filename, limit)
-    channels = np.array(channels, dtype=np.int16)
-    if decoder.CONVERT_TO_MONO:
-        channels = np.array([np.mean(channels, axis=0)], dtype=channels.dtype)
-    if decoder.RESAMPLE and Fs != fingerprint.DEFAULT_FS and len(channels[-1]) > 0:
-        channels = resample(channels, Fs, fingerprint.DEFAULT_FS, axis=-1)
-        Fs = fingerprint.DEFAULT_FS
-    if decoder.NORMALIZE and len(channels[-1]) > 0:
-        gain = (-np.iinfo(channels.dtype).min) / np.max(np.abs(channels))
-        channels = np.array(channels * gain, dtype=channels.dtype)
+    channels, Fs = decoder.preprocess(channels, Fs)
     result = set()
     channel_amount = len(channels)
 
@@ -213,6 +825,36 @@ def _fingerprint_worker(filename, limit=None, song_name=None):
     return song_name, result, file_hash, audio_length
 
 
+# Dejavu instance of each recognize_directory worker process
+_recognize_dejavu = {}
+
+
+def _init_recognize_worker(config):
+    _recognize_dejavu["dejavu"] = Dejavu(dict(config, read_only=True))
+
+
+def _recognize_worker(filename, top_n=None):
+    result = {"file": filename}
+    t = time.time()
+    try:
+        match = _recognize_dejavu["dejavu"].recognize(FileRecognizer, filename, top_n=top_n)
+    except Exception as e:
+        logging.getLogger('dejavu').exception("Failed recognizing %s" % filename)
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    else:
+        result["match"] = match
+        # every candidate carries the same match time
+        first = match[0] if isinstance(match, list) and match else match
+        result["decode_time"] = time.time() - t - (first or {}).get(Dejavu.MATCH_TIME, 0.)
+    result["total_time"] = time.time() - t
+    return result
+
+
+@contextmanager
+def _no_context():
+    yield
+
+
 def chunkify(lst, n):
     """
     Splits a list into roughly n equal parts.
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import warnings
+import argparse
+
+from ads_dejavu import Dejavu, _no_context
+from ads_dejavu.recognize import FileRecognizer
+from ads_dejavu.recognize import MicrophoneRecognizer
+from ads_dejavu.monitor import Monitor
+from ads_dejavu.archive import ArchiveScanner
+from ads_dejavu.server import RecognitionServer
+from argparse import RawTextHelpFormatter
+
+warnings.filterwarnings("ignore")
+
+DEFAULT_CONFIG_FILE = "dejavu.cnf.SAMPLE"
+
+
+def init(configpath):
+    """
+    Load config from a JSON file
+    """
+    try:
+        with open(configpath) as f:
+            config = json.load(f)
+    except IOError as err:
+        print("Cannot open configuration: %s. Exiting" % (str(err)))
+        sys.exit(1)
+
+    # create a Dejavu instance
+    return Dejavu(config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog="python -m ads_dejavu",
+        description="Dejavu: Audio Fingerprinting library",
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-c', '--config', nargs='?',
+                        help='Path to configuration file\n'
+                             'Usages: \n'
+                             '--config /path/to/config-file\n')
+    parser.add_argument('-f', '--fingerprint', nargs='*',
+                        help='Fingerprint files in a directory\n'
+                             'Usages: \n'
+                             '--fingerprint /path/to/directory extension\n'
+                             '--fingerprint /path/to/directory')
+    parser.add_argument('-r', '--recognize', nargs='+',
+                        help='Recognize what is '
+                             'playing through the microphone\n'
+                             'Usage: \n'
+                             '--recognize mic number_of_seconds \n'
+                             '--recognize file path/to/file \n'
+                             '--recognize dir path/to/directory extension \n'
+                             'The last prints a JSON line per file\n')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='Processes used by --recognize dir, by default\n'
+                             'one per CPU\n')
+    parser.add_argument('--top', type=int, metavar='N',
+                        help='With --recognize, list the N best candidates\n'
+                             'instead of the single best match\n')
+    parser.add_argument('-s', '--stoplist', type=int, metavar='MAX_POSTINGS',
+                        help='Rebuild the stop-list with the hashes having\n'
+                             'more than MAX_POSTINGS fingerprints\n'
+                             'Usage: \n'
+                             '--stoplist 500\n')
+    parser.add_argument('--migrate-schema', action='store_true',
+                        help='Move the fingerprints table to the compact\n'
+                             'schema version 2, printing the size and lookup\n'
+                             'time of the old and new tables\n')
+    parser.add_argument('--export-snapshot', metavar='PATH',
+                        help='Write the catalog to a snapshot file\n'
+                             'Usage: \n'
+                             '--export-snapshot catalog.djv\n')
+    parser.add_argument('--import-snapshot', metavar='PATH',
+                        help='Add the songs and fingerprints of a snapshot file\n'
+                             'Usage: \n'
+                             '--import-snapshot catalog.djv\n')
+    parser.add_argument('--uncompressed', action='store_true',
+                        help='Export an uncompressed snapshot, which the\n'
+                             'memory database maps instead of reading\n')
+    parser.add_argument('--monitor', metavar='SOURCE',
+                        help='Print a JSON line per song detected in a long\n'
+                             'recording, or in 16-bit PCM read from stdin\n'
+                             'with "-", and the throughput at the end\n'
+                             'Usage: \n'
+                             '--monitor broadcast.mp3\n'
+                             'ffmpeg -i URL -f s16le -ac 1 -ar 8000 - | ... --monitor -\n')
+    parser.add_argument('--scan-archive', nargs=2, metavar=('PATH', 'EXT'),
+                        help='Detect every song in the recordings under PATH,\n'
+                             'one channel per subdirectory, on all CPUs\n'
+                             'Usage: \n'
+                             '--scan-archive /path/to/archive mp3 --report day.csv\n')
+    parser.add_argument('--report', metavar='PATH',
+                        help='CSV, or JSON lines if it ends with .jsonl, written\n'
+                             'by --scan-archive instead of printing JSON lines\n')
+    parser.add_argument('--shard', type=float, default=1800.,
+                        help='Seconds of audio per --scan-archive task\n')
+    parser.add_argument('--window', type=float, default=10.,
+                        help='Seconds aligned at once by --monitor\n'
+                             'and --scan-archive\n')
+    parser.add_argument('--hop', type=float, default=2.,
+                        help='Seconds between --monitor and --scan-archive\n'
+                             'windows\n')
+    parser.add_argument('--rate', type=int, default=8000,
+                        help='Sample rate of the PCM read by --monitor -\n')
+    parser.add_argument('--serve', metavar='ADDRESS', nargs='?', const='127.0.0.1:9000',
+                        help='Serve recognitions over HTTP until interrupted,\n'
+                             'on HOST:PORT or on a Unix socket path\n'
+                             'Usage: \n'
+                             '--serve 127.0.0.1:9000\n'
+                             '--serve /tmp/dejavu.sock\n')
+    parser.add_argument('--batch-window', type=float, default=0.005,
+                        help='Seconds --serve waits to look up the hashes of\n'
+                             'concurrent requests together\n')
+    args = parser.parse_args()
+
+    if not args.fingerprint and not args.recognize and args.stoplist is None and not args.migrate_schema \
+            and not args.export_snapshot and not args.import_snapshot and not args.monitor \
+            and not args.scan_archive and not args.serve:
+        parser.print_help()
+        sys.exit(0)
+
+    config_file = args.config
+    if config_file is None:
+        config_file = DEFAULT_CONFIG_FILE
+
+    djv = init(config_file)
+    if args.fingerprint:
+        # Fingerprint all files in a directory
+        if len(args.fingerprint) == 2:
+            directory = args.fingerprint[0]
+            extension = args.fingerprint[1]
+            print("Fingerprinting all .%s files in the %s directory"
+                  % (extension, directory))
+            djv.fingerprint_directory(directory, ["." + extension], 4)
+
+        elif len(args.fingerprint) == 1:
+            filepath = args.fingerprint[0]
+            if os.path.isdir(filepath):
+                print("Please specify an extension if you'd like to fingerprint a directory!")
+                sys.exit(1)
+            djv.fingerprint_file(filepath)
+
+    elif args.recognize:
+        # Recognize audio source
+        song = None
+        source = args.recognize[0]
+        if len(args.recognize) != (3 if source in ('dir', 'directory') else 2):
+            parser.error("Wrong number of arguments for --recognize %s" % source)
+        opt_arg = args.recognize[1]
+
+        if source in ('dir', 'directory'):
+            results = djv.recognize_directory(opt_arg, ["." + args.recognize[2]], args.processes, top_n=args.top)
+            for result in results:
+                print(json.dumps(result), flush=True)
+            sys.exit(0)
+        if source in ('mic', 'microphone'):
+            song = djv.recognize(MicrophoneRecognizer, seconds=int(opt_arg))
+        elif source == 'file':
+            song = djv.recognize(FileRecognizer, opt_arg, top_n=args.top)
+        print(song)
+
+    elif args.stoplist is not None:
+        size = djv.rebuild_stoplist(args.stoplist)
+        print("%d hashes stop-listed" % size)
+
+    elif args.migrate_schema:
+        report = djv.db.migrate_schema()
+        if report is None:
+            print("Fingerprints table already uses schema version 2")
+        else:
+            print(json.dumps(report, indent=2))
+
+    elif args.export_snapshot:
+        snapshot = djv.db.export_snapshot(args.export_snapshot,
+                                          compression=None if args.uncompressed else "zlib")
+        print("%d fingerprints of %d songs exported" % (len(snapshot), len(snapshot.songs)))
+
+    elif args.import_snapshot:
+        # An empty catalog is loaded without indexes, rebuilt once at the end
+        bulk = djv.db.deferred_indexes() if djv.db.get_num_fingerprints() == 0 else _no_context()
+        with bulk:
+            stats = djv.db.import_snapshot(args.import_snapshot)
+        print("%d fingerprints of %d songs imported" % (stats["rows"], stats["songs"]))
+
+    elif args.monitor:
+        monitor = Monitor(djv, window=args.window, hop=args.hop)
+        if args.monitor == '-':
+            detections = monitor.monitor_pcm(sys.stdin.buffer, Fs=args.rate)
+        else:
+            detections = monitor.monitor_file(args.monitor)
+        for detection in detections:
+            print(json.dumps(detection))
+            sys.stdout.flush()
+        print(json.dumps(monitor.stats()), file=sys.stderr)
+
+    elif args.scan_archive:
+        scanner = ArchiveScanner(djv.config, shard=args.shard, window=args.window, hop=args.hop)
+        timelines = scanner.scan(scanner.find_channels(args.scan_archive[0], ["." + args.scan_archive[1]]))
+        if args.report:
+            scanner.write_report(timelines, args.report)
+        else:
+            for row in scanner.report_rows(timelines):
+                print(json.dumps(row))
+        print(json.dumps(scanner.stats), file=sys.stderr)
+
+    elif args.serve:
+        host, _, port = args.serve.rpartition(':')
+        if host and port.isdigit():
+            server = RecognitionServer(djv, host=host, port=int(port), batch_window=args.batch_window)
+        else:
+            server = RecognitionServer(djv, socket_path=args.serve, batch_window=args.batch_window)
+        print("Serving recognitions on %s" % server.address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(json.dumps(server.stats()))
+
+    sys.exit(0)
@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from ads_dejavu import Dejavu
+from ads_dejavu.monitor import Monitor
+import ads_dejavu.decoder as decoder
+
+# Dejavu instance and Monitor options of each worker process
+_worker = {}
+
+
+def _init_worker(config, options):
+    _worker["dejavu"] = Dejavu(dict(config, read_only=True))
+    _worker["options"] = options
+
+
+def _scan_shard(shard):
+    """
+    Decodes a shard and returns its detections, with times relative to the
+    start of its channel, plus the audio and CPU seconds spent.
+    """
+    t = time.process_time()
+    channel, filename, file_start, start, seconds = shard
+    channels, Fs = decoder.read_segment(filename, start, seconds)
+    samples = decoder.preprocess(channels, Fs, mono=True, resample=True, normalize=False)[0][0]
+
+    monitor = Monitor(_worker["dejavu"], **_worker["options"])
+    detections = list(monitor.monitor([samples]))
+    for detection in detections:
+        detection[Monitor.START] = round(detection[Monitor.START] + file_start + start, 3)
+        detection[Monitor.END] = round(detection[Monitor.END] + file_start + start, 3)
+        detection["channel"] = channel
+        detection["file"] = filename
+    return detections, monitor.audio_seconds, time.process_time() - t
+
+
+class ArchiveScanner(object):
+    """
+    Scans recorded broadcast archives for every song in the catalog, on a
+    pool of processes.
+
+    Each recording is split into shards of `shard` seconds, overlapping by
+    `overlap` seconds so that songs across a boundary are detected whole in
+    at least one of them, and only that part of the file is decoded. Every
+    process keeps its own `Dejavu` and database connection. Detections of
+    all shards are merged into one timeline per channel.
+
+    ```python
+    scanner = ArchiveScanner(config, window=10, hop=2)
+    timelines = scanner.scan(scanner.find_channels("archive", [".mp3"]))
+    scanner.write_report(timelines, "report.csv")
+    ```
+    """
+
+    FIELDS = ("channel", Monitor.START, Monitor.END, Dejavu.SONG_ID, Dejavu.SONG_NAME, Dejavu.OFFSET_SECS,
+              Dejavu.CONFIDENCE, "file")
+
+    def __init__(self, config, shard=1800., overlap=None, nprocesses=None, **options):
+        """
+        shard: Seconds of audio per task.
+        overlap: Seconds shared by consecutive shards, by default a window
+                 plus the context a hash needs.
+        nprocesses: Processes in the pool, by default one per CPU.
+        options: `Monitor` options, such as `window` and `hop`.
+        """
+        super(ArchiveScanner, self).__init__()
+        self.config = config
+        self.options = options
+        self.shard = shard
+        monitor = Monitor(None, **options)
+        if overlap is None:
+            overlap = monitor._seconds(monitor.window_frames + monitor.TAIL_FRAMES + monitor.LEAD_FRAMES)
+        self.overlap = overlap
+        # seconds two detections of a song may be apart and still be merged
+        self.max_gap = monitor._seconds(monitor.max_gap_frames)
+        self.tolerance = monitor._seconds(monitor.tolerance)
+        try:
+            self.nprocesses = nprocesses or multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.nprocesses = 1
+        self.stats = {}
+
+    @staticmethod
+    def find_channels(path, extensions):
+        """
+        Returns a dictionary of channel => recordings in chronological order
+        for the audio files under `path`. Files in a subdirectory belong to
+        the channel named after it, files at the top to one channel each.
+        """
+        channels = {}
+        for filename, _ in decoder.find_files(path, extensions):
+            directory = os.path.relpath(os.path.dirname(filename), path)
+            channel = decoder.path_to_songname(filename) if directory == os.curdir else directory
+            channels.setdefault(channel, []).append(filename)
+        return dict((channel, sorted(files)) for channel, files in channels.items())
+
+    def shards(self, channels):
+        """
+        Returns the (channel, filename, file_start, start, seconds) shards
+        of a dictionary of channel => recordings, recordings of a channel
+        following each other.
+        """
+        shards = []
+        for channel, files in sorted(channels.items()):
+            file_start = 0.
+            for filename in files:
+                length = decoder.duration(filename)
+                start = 0.
+                while start < length:
+                    shards.append((channel, filename, file_start, start,
+                                   min(self.shard + self.overlap, length - start)))
+                    start += self.shard
+                file_start += length
+        return shards
+
+    def scan(self, channels):
+        """
+        Scans a dictionary of channel => recordings, and returns a
+        dictionary of channel => detections sorted by start.
+        """
+        t = time.time()
+        shards = self.shards(channels)
+        pool = multiprocessing.Pool(self.nprocesses, initializer=_init_worker, initargs=(self.config, self.options))
+
+        detections = []
+        cpu_seconds = 0.
+        try:
+            for shard_detections, _, shard_cpu in pool.imap_unordered(_scan_shard, shards):
+                detections.extend(shard_detections)
+                cpu_seconds += shard_cpu
+        finally:
+            pool.close()
+            pool.join()
+
+        timelines = self.merge(detections)
+        elapsed = time.time() - t
+        # overlaps are scanned twice, count the recordings once
+        audio_seconds = sum(min(seconds, self.shard) for _, _, _, _, seconds in shards)
+        self.stats = {
+            "shards": len(shards),
+            "processes": self.nprocesses,
+            "audio_seconds": audio_seconds,
+            "seconds": elapsed,
+            "cpu_seconds": cpu_seconds,
+            "hours_per_hour": audio_seconds / elapsed if elapsed else 0.,
+            "hours_per_cpu_hour": audio_seconds / cpu_seconds if cpu_seconds else 0.,
+        }
+        logging.getLogger('dejavu').info("Scanned %(audio_seconds).0f seconds of audio in %(shards)d shards "
+                                         "in %(seconds).2f seconds" % self.stats)
+        return timelines
+
+    def merge(self, detections):
+        """
+        Merges detections of the same song at the same position, overlapping
+        or close enough, such as those of shards sharing a boundary. Returns
+        a dictionary of channel => detections sorted by start.
+        """
+        timelines = {}
+        for detection in sorted(detections, key=lambda d: (d["channel"], d[Monitor.START])):
+            timeline = timelines.setdefault(detection["channel"], [])
+            song_start = detection[Monitor.START] - detection[Dejavu.OFFSET_SECS]
+            for previous in reversed(timeline):
+                if previous[Dejavu.SONG_ID] == detection[Dejavu.SONG_ID] and \
+                        previous[Monitor.END] + self.max_gap >= detection[Monitor.START] and \
+                        abs(previous[Monitor.START] - previous[Dejavu.OFFSET_SECS] - song_start) <= self.tolerance:
+                    previous[Monitor.END] = max(previous[Monitor.END], detection[Monitor.END])
+                    previous[Dejavu.CONFIDENCE] = max(previous[Dejavu.CONFIDENCE], detection[Dejavu.CONFIDENCE])
+                    break
+            else:
+                timeline.append(detection)
+        for timeline in timelines.values():
+            timeline.sort(key=lambda d: d[Monitor.START])
+        return timelines
+
+    def report_rows(self, timelines):
+        return [dict((field, detection.get(field)) for field in self.FIELDS)
+                for channel in sorted(timelines) for detection in timelines[channel]]
+
+    def write_report(self, timelines, path):
+        """
+        Writes the detections as CSV, or as JSON lines when `path` ends
+        with .jsonl.
+        """
+        rows = self.report_rows(timelines)
+        with open(path, "w", newline="") as f:
+            if path.endswith(".jsonl"):
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+            else:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
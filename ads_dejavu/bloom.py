@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+import hashlib
+import math
+import os
+import struct
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    Holds an exclusive lock on `path`.lock, across processes, where the
+    platform supports it.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open("%s.lock" % path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class BloomFilter(object):
+    """
+    Compact set of hashes answering "maybe stored" or "surely not stored".
+
+    Used to drop query hashes absent from the catalog before they are sent
+    to the database. The filter never gives false negatives, and gives
+    false positives at roughly `error_rate` while it holds at most
+    `capacity` hashes.
+
+    ```python
+    bloom = BloomFilter(capacity=10 ** 7, error_rate=0.01)
+    bloom.update(hashes)
+    maybe_stored = bloom.contains_many(query_hashes)
+    ```
+    """
+
+    MAGIC = b"DJVBLOOM"
+    VERSION = 1
+    # magic, version, number of bits, number of hash functions, hashes added
+    HEADER = struct.Struct("<8sIQIQ")
+
+    def __init__(self, capacity, error_rate=0.01, nbits=None, nhashes=None):
+        super(BloomFilter, self).__init__()
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits = nbits or int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = nhashes or max(int(round(float(self.nbits) / capacity * math.log(2))), 1)
+        self.bits = np.zeros((self.nbits + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+        self._lock = Lock()
+        # hashes checked and hashes the filter surely doesn't hold
+        self.checked = 0
+        self.rejected = 0
+
+    def _positions(self, hashes):
+        """
+        Returns the bit positions of each hash, one row per hash, using
+        double hashing over a 128 bits digest.
+        """
+        digests = b"".join(hashlib.blake2b(h.upper().encode(), digest_size=16).digest() for h in hashes)
+        words = np.frombuffer(digests, dtype="<u8").reshape(-1, 2)
+        h1 = words[:, :1]
+        h2 = words[:, 1:] | np.uint64(1)
+        # overflows wrap around, that's fine for spreading the positions
+        with np.errstate(over="ignore"):
+            return (h1 + np.arange(self.nhashes, dtype=np.uint64) * h2) % np.uint64(self.nbits)
+
+    def update(self, hashes):
+        """
+        Adds the given hashes, in hexadecimal format.
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return
+        positions = self._positions(hashes).ravel()
+        with self._lock:
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+            self.count += len(hashes)
+
+    def add(self, hash):
+        self.update([hash])
+
+    def contains_many(self, hashes):
+        """
+        Returns a boolean array, False for the hashes surely not added.
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return np.zeros(0, dtype=bool)
+        positions = self._positions(hashes)
+        bits = self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)
+        found = np.all(bits & 1, axis=1)
+        with self._lock:
+            self.checked += len(hashes)
+            self.rejected += len(hashes) - int(np.count_nonzero(found))
+        return found
+
+    def __contains__(self, hash):
+        return bool(self.contains_many([hash])[0])
+
+    def __len__(self):
+        return self.count
+
+    def false_positive_rate(self):
+        """
+        Expected false positive rate for the hashes added so far.
+        """
+        return (1 - math.exp(-float(self.nhashes) * self.count / self.nbits)) ** self.nhashes
+
+    def stats(self):
+        """
+        Returns the filter size and rates, and how much of the queries it
+        kept from reaching the database.
+        """
+        with self._lock:
+            return {
+                "hashes": self.count,
+                "capacity": self.capacity,
+                "bytes": self.bits.nbytes,
+                "error_rate": self.error_rate,
+                "false_positive_rate": self.false_positive_rate(),
+                "checked": self.checked,
+                "rejected": self.rejected,
+                "rejected_ratio": float(self.rejected) / self.checked if self.checked else 0.,
+            }
+
+    def compatible(self, other):
+        """
+        Whether both filters set the same bits for the same hashes.
+        """
+        return self.nbits == other.nbits and self.nhashes == other.nhashes
+
+    def merge(self, other):
+        """
+        Adds every hash of another filter with the same parameters.
+        """
+        if not self.compatible(other):
+            raise ValueError("Can't merge Bloom filters of %d bits and %d hashes with %d bits and %d hashes" %
+                             (self.nbits, self.nhashes, other.nbits, other.nhashes))
+        with self._lock:
+            np.bitwise_or(self.bits, other.bits, out=self.bits)
+            # hashes added to both are counted once, by the bits they set
+            ones = int(np.unpackbits(self.bits).sum())
+            estimate = -float(self.nbits) / self.nhashes * math.log(max(1. - float(ones) / self.nbits, 1e-12))
+            self.count = max(self.count, other.count, int(round(estimate)))
+
+    def save(self, path, merge=False):
+        """
+        Writes the filter to `path`, replacing any previous file atomically.
+
+        merge: First add the hashes of the filter at `path`, under a lock,
+               so processes saving the same file never drop each other's
+               hashes. A file with other parameters is replaced.
+        """
+        tmp_path = "%s.tmp" % path
+        with _file_lock(path):
+            if merge and os.path.exists(path):
+                other = BloomFilter.load(path)
+                if self.compatible(other):
+                    self.merge(other)
+            with self._lock:
+                with open(tmp_path, "wb") as f:
+                    f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.nbits, self.nhashes, self.count))
+                    f.write(struct.pack("<dQ", self.error_rate, self.capacity))
+                    self.bits.tofile(f)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a filter written by `save`.
+        """
+        with open(path, "rb") as f:
+            magic, version, nbits, nhashes, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError("%s is not a dejavu bloom filter" % path)
+            error_rate, capacity = struct.unpack("<dQ", f.read(16))
+            bloom = cls(capacity, error_rate, nbits=nbits, nhashes=nhashes)
+            bloom.bits = np.fromfile(f, dtype=np.uint8, count=bloom.bits.size)
+            bloom.count = count
+        return bloom
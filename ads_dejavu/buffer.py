@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    First in, first out buffer of samples in a preallocated NumPy array,
+    optionally with one row per channel. Appending copies the samples into
+    place, consuming only moves the start, and the samples stored are
+    always available as a contiguous view.
+
+    The array is only reallocated when it can't hold the samples stored,
+    and they are only moved back to its start when appending would run
+    past its end.
+    """
+
+    def __init__(self, capacity, dtype=np.float32, channels=None):
+        super(RingBuffer, self).__init__()
+        self.shape = () if channels is None else (channels,)
+        self._data = np.zeros(self.shape + (max(1, capacity),), dtype=dtype)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return self._data.shape[-1]
+
+    def append(self, samples):
+        samples = np.asarray(samples)
+        n = samples.shape[-1]
+        if self._end + n > self.capacity:
+            stored = len(self)
+            if stored + n > self.capacity:
+                data = np.zeros(self.shape + (max(2 * self.capacity, stored + n),), dtype=self._data.dtype)
+            else:
+                data = self._data
+            data[..., :stored] = self._data[..., self._start:self._end]
+            self._data, self._start, self._end = data, 0, stored
+        self._data[..., self._end:self._end + n] = samples
+        self._end += n
+
+    def view(self):
+        """
+        Returns the samples stored, without copying them. The view is only
+        valid until the next `append`.
+        """
+        return self._data[..., self._start:self._end]
+
+    def consume(self, n):
+        """
+        Drops the `n` oldest samples.
+        """
+        self._start = min(self._start + n, self._end)
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def clear(self):
+        self._start = self._end = 0
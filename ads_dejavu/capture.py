@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+import queue
+
+import numpy as np
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+import ads_dejavu.decoder as decoder
+
+
+class CaptureSource(object):
+    """
+    Where `MicrophoneRecognizer` records from. `read` returns the next chunk
+    as an int16 array with one row per channel, or None once the source is
+    exhausted.
+    """
+
+    def open(self, channels, samplerate, chunksize):
+        self.channels = channels
+        self.samplerate = samplerate
+        self.chunksize = chunksize
+
+    def read(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PyAudioSource(CaptureSource):
+    """
+    Records from the default input device. With `callback` set the stream
+    is non-blocking: PortAudio hands chunks over from its own thread as they
+    are captured, and `read` waits at most `timeout` seconds for one.
+    """
+
+    def __init__(self, callback=False, timeout=1.):
+        super(PyAudioSource, self).__init__()
+        if pyaudio is None:
+            raise ImportError("PyAudioSource needs pyaudio, install it with `pip install pyaudio`")
+        self.callback = callback
+        self.timeout = timeout
+        self.audio = pyaudio.PyAudio()
+        self.stream = None
+        self.chunks = None
+
+    def open(self, channels, samplerate, chunksize):
+        super(PyAudioSource, self).open(channels, samplerate, chunksize)
+        self.close()
+        self.chunks = queue.Queue() if self.callback else None
+        self.stream = self.audio.open(
+            format=pyaudio.paInt16,
+            channels=channels,
+            rate=samplerate,
+            input=True,
+            frames_per_buffer=chunksize,
+            stream_callback=self._callback if self.callback else None,
+        )
+
+    def _callback(self, data, frame_count, time_info, status):
+        self.chunks.put(data)
+        return None, pyaudio.paContinue
+
+    def read(self):
+        if self.callback:
+            try:
+                data = self.chunks.get(timeout=self.timeout)
+            except queue.Empty:
+                return np.zeros((self.channels, 0), np.int16)
+        else:
+            data = self.stream.read(self.chunksize)
+        # interleaved frames, one column per channel
+        return np.frombuffer(data, np.int16).reshape(-1, self.channels).T
+
+    def close(self):
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+
+class ChunkSource(CaptureSource):
+    """
+    Plays back an iterable of chunks, each an int16 array with one row per
+    channel (or a 1-D array for mono), or interleaved 16-bit PCM bytes.
+    """
+
+    def __init__(self, chunks):
+        super(ChunkSource, self).__init__()
+        self.chunks = chunks
+        self.iterator = None
+
+    def open(self, channels, samplerate, chunksize):
+        super(ChunkSource, self).open(channels, samplerate, chunksize)
+        self.iterator = iter(self.chunks)
+
+    def read(self):
+        chunk = next(self.iterator, None)
+        if chunk is None:
+            return None
+        if isinstance(chunk, bytes):
+            chunk = np.frombuffer(chunk, np.int16).reshape(-1, self.channels).T
+        chunk = np.asarray(chunk, np.int16)
+        if chunk.ndim == 1:
+            chunk = chunk[np.newaxis]
+        if len(chunk) != self.channels:
+            # mixed down, or the mono chunk copied to every channel
+            chunk = np.repeat(np.mean(chunk, axis=0, keepdims=True), self.channels, axis=0).astype(np.int16)
+        return chunk
+
+
+class FileSource(ChunkSource):
+    """
+    Plays back an audio file, `chunksize` samples at a time, resampled to
+    the recording's sample rate.
+    """
+
+    def __init__(self, filename):
+        super(FileSource, self).__init__(())
+        self.filename = filename
+
+    def open(self, channels, samplerate, chunksize):
+        frames, Fs, _, _ = decoder.read(self.filename)
+        frames, _ = decoder.preprocess(frames, Fs, mono=False, resample=True, normalize=False, rate=samplerate)
+        self.chunks = (frames[:, i:i + chunksize] for i in range(0, frames.shape[-1], chunksize))
+        super(FileSource, self).open(channels, samplerate, chunksize)
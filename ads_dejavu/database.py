@@ -1,5 +1,9 @@
 from __future__ import absolute_import
 import abc
+from contextlib import contextmanager
+import time
+
+import numpy as np
 
 
 class Database(object):
@@ -11,6 +15,7 @@ class Database(object):
     FIELD_OFFSET = 'offset'
     FIELD_HASH = 'hash'
     AUDIO_LENGTH = 'audio_length'
+    FIELD_NUM_FINGERPRINTS = 'num_fingerprints'
 
     # Name of your Database subclass, this is used in configuration
     # to refer to your class
@@ -77,6 +82,18 @@ class Database(object):
         """
         pass
 
+    def get_songs_by_ids(self, sids):
+        """
+        Returns a dictionary of song identifier => song for the given
+        identifiers, leaving out the ones not found.
+        """
+        songs = {}
+        for sid in sids:
+            song = self.get_song_by_id(sid)
+            if song:
+                songs[sid] = song
+        return songs
+
     @abc.abstractmethod
     def get_songs(self):
         """
@@ -131,6 +148,62 @@ class Database(object):
         """
         pass
 
+    @abc.abstractmethod
+    def get_hashes(self):
+        """
+        Returns every distinct hash in the database, in hexadecimal format.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_fingerprints(self):
+        """
+        Returns every (hash, sid, offset) tuple in the database, with hash
+        in uppercase hexadecimal format.
+        """
+        pass
+
+    def export_snapshot(self, path, compression="zlib"):
+        """
+        Writes the fingerprinted songs and their fingerprints to a snapshot
+        file at `path` and returns the `Snapshot`.
+
+        compression: "zlib", or None to write a snapshot that can be memory
+                     mapped.
+        """
+        snapshot = Snapshot.from_database(self)
+        snapshot.save(path, compression=compression)
+        return snapshot
+
+    def import_snapshot(self, snapshot):
+        """
+        Adds the songs and fingerprints of a snapshot, either a path or a
+        `Snapshot`, through `insert_song` and `insert_hashes_bulk`. Songs
+        already in the database, by file hash, are skipped.
+
+        Returns the `insert_hashes_bulk` statistics plus the amount of
+        songs imported.
+        """
+        if not isinstance(snapshot, Snapshot):
+            snapshot = Snapshot.load(snapshot)
+        snapshot.check_params()
+
+        existing = set(song[self.FIELD_FILE_SHA1].upper() for song in self.get_songs())
+        sids = {}
+        for song in snapshot.songs:
+            if song[self.FIELD_FILE_SHA1].upper() in existing:
+                continue
+            sids[song[self.FIELD_SONG_ID]] = self.insert_song(
+                song[self.FIELD_SONGNAME], song[self.FIELD_FILE_SHA1], song[self.AUDIO_LENGTH])
+
+        stats = self.insert_hashes_bulk((sids[song[self.FIELD_SONG_ID]], hashes)
+                                        for song, hashes in snapshot.iter_songs()
+                                        if song[self.FIELD_SONG_ID] in sids)
+        for sid in sids.values():
+            self.set_song_fingerprinted(sid)
+        stats["songs"] = len(sids)
+        return stats
+
     @abc.abstractmethod
     def insert_hashes(self, sid, hashes):
         """
@@ -143,22 +216,117 @@ class Database(object):
         """
         pass
 
+    def insert_hashes_bulk(self, songs_hashes, **options):
+        """
+        Insert the fingerprints of many songs at once, meant for initial
+        catalog builds. Backends with a faster bulk path should override this,
+        the default calls `insert_hashes` for every song.
+
+        songs_hashes: A sequence of tuples in the format (sid, hashes), with
+                      hashes as in `insert_hashes`.
+
+        Returns a dictionary with the amount of rows, seconds taken and
+        rows per second.
+        """
+        t = time.time()
+        rows = 0
+        for sid, hashes in songs_hashes:
+            hashes = set(hashes)
+            self.insert_hashes(sid, hashes)
+            rows += len(hashes)
+        t = time.time() - t
+        return {"rows": rows, "seconds": t, "rows_per_second": rows / t if t else 0.}
+
+    def get_stoplist(self):
+        """
+        Returns a dictionary of the hashes shared by too many fingerprints to
+        be useful in queries, with their number of fingerprints.
+        """
+        return {}
+
     @abc.abstractmethod
-    def return_matches(self, hashes):
+    def rebuild_stoplist(self, max_postings, prune=False):
+        """
+        Recomputes the stop-list with the hashes having more than
+        `max_postings` fingerprints.
+
+        prune: Also delete the fingerprints of the stop-listed hashes.
+
+        Returns the number of stop-listed hashes.
+        """
+        pass
+
+    @contextmanager
+    def deferred_indexes(self):
+        """
+        Context manager dropping the fingerprint indexes while its block runs
+        and rebuilding them when leaving it, if the backend supports it.
+        """
+        yield
+
+    @abc.abstractmethod
+    def return_matches(self, hashes, as_arrays=False):
         """
         Searches the database for pairs of (hash, offset) values.
 
-        hashes: A sequence of tuples in the format (hash, offset)
+        hashes: `QueryHashes` of the query, every offset of each hash
         -   hash: Part of a sha1 hash, in hexadecimal format
         - offset: Offset this hash was created from/at.
+        as_arrays: Return the result as `match_arrays` does.
 
-        Returns a sequence of (sid, offset_difference) tuples.
+        Returns a sequence of (sid, offset_difference) tuples, one per
+        fingerprint found and query offset of its hash.
 
                       sid: Song identifier
         offset_difference: (offset - database_offset)
         """
         pass
 
+    @staticmethod
+    def match_arrays(postings, mapper):
+        """
+        Turns (hash, sid, offset) postings into a (sids, offset_differences)
+        tuple of int64 arrays, in the same order, given the `QueryHashes`
+        of the query. Postings are repeated once per query offset.
+        """
+        postings = list(postings)
+        if not postings:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        hashes, sids, offsets = zip(*postings)
+        return mapper.join([mapper.index[hash] for hash in hashes], sids, offsets)
+
+    @abc.abstractmethod
+    def return_postings(self, hashes):
+        """
+        Searches the database for every fingerprint of the given hashes.
+
+        hashes: A sequence of hashes, in hexadecimal format
+
+        Returns a sequence of (hash, sid, offset) tuples, with hash in
+        uppercase hexadecimal format.
+        """
+        pass
+
+    def return_match_histogram(self, hashes, top_k=10):
+        """
+        Searches the database for pairs of (hash, offset) values and counts
+        the resulting (sid, offset_difference) pairs.
+
+        hashes: A sequence of tuples in the format (hash, offset)
+         top_k: Number of most common pairs to return
+
+        Returns a sequence of (sid, offset_difference, count) tuples, most
+        common first.
+
+        Backends able to count on their side should override this, the
+        default counts the output of `return_matches`.
+        """
+        counter = {}
+        for match in self.return_matches(QueryHashes(hashes)):
+            counter[match] = counter.get(match, 0) + 1
+        ranked = sorted(counter.items(), key=lambda kv: kv[1], reverse=True)
+        return [(sid, diff, count) for (sid, diff), count in ranked[:top_k]]
+
 
 def get_database(database_type=None):
     # Default to using the mysql database
@@ -173,5 +341,9 @@ def get_database(database_type=None):
     raise TypeError("Unsupported database type supplied.")
 
 
+from ads_dejavu.query import QueryHashes
+from ads_dejavu.snapshot import Snapshot
+
 # Import our default database handler
 import ads_dejavu.database_sql
+import ads_dejavu.database_memory
@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+import abc
+import asyncio
+import logging
+import time
+from collections import deque
+from multiprocessing import cpu_count
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+from ads_dejavu.database_memory import MemoryDatabase
+from ads_dejavu.database_sql import SQLDatabase, grouper
+
+
+class AsyncDatabase(object):
+    """
+    Lookups needed to recognize audio, as coroutines, so a single event loop
+    can serve many concurrent recognitions.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    async def return_postings(self, hashes):
+        """
+        Returns a list of the (hash, sid, offset) tuples of the given hashes,
+        in hexadecimal format.
+        """
+        pass
+
+    async def return_matches(self, mapper):
+        """
+        Returns a list of the (sid, offset_difference) tuples of the
+        `QueryHashes` of a query.
+        """
+        return list(mapper.matches(await self.return_postings(mapper.keys())))
+
+    @abc.abstractmethod
+    async def get_song_by_id(self, sid):
+        """
+        Return a song by its identifier
+        """
+        pass
+
+    async def close(self):
+        """
+        Releases the connections held, if any.
+        """
+        pass
+
+
+class AsyncSQLDatabase(AsyncDatabase):
+    """
+    MySQL through aiomysql, with the same tables, options and chunked
+    lookups as `SQLDatabase`. Chunks of a query run concurrently on the
+    event loop instead of threads.
+    """
+
+    def __init__(self, query_chunk_size=10000, query_workers=None, pool_min_size=0, pool_max_size=None,
+                 pool_timeout=None, pool_ping_interval=None, schema_version=None, **options):
+        super(AsyncSQLDatabase, self).__init__()
+        if aiomysql is None:
+            raise ImportError("AsyncSQLDatabase needs aiomysql, install it with `pip install aiomysql`")
+
+        # pymysql's old name for it
+        if "passwd" in options:
+            options["password"] = options.pop("passwd")
+        self.options = options
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size or cpu_count()
+        self.query_chunk_size = query_chunk_size
+        self.query_workers = query_workers or self.pool_max_size
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+        # (hashes, rows, seconds) of the most recent SELECT chunks
+        self.chunk_timings = deque(maxlen=1000)
+
+    async def _get_pool(self):
+        async with self._pool_lock:
+            if self._pool is None:
+                self._pool = await aiomysql.create_pool(minsize=self.pool_min_size, maxsize=self.pool_max_size,
+                                                        autocommit=True, **self.options)
+            return self._pool
+
+    async def _select_chunk(self, split_values, workers):
+        async with workers:
+            t = time.time()
+            query = SQLDatabase.SELECT_MULTIPLE % ', '.join(['UNHEX(%s)'] * len(split_values))
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, split_values)
+                    rows = await cur.fetchall()
+            t = time.time() - t
+
+        self.chunk_timings.append((len(split_values), len(rows), t))
+        logging.getLogger('dejavu').debug("Fetched %d rows for %d hashes in %.4f seconds" %
+                                          (len(rows), len(split_values), t))
+        return rows
+
+    async def return_postings(self, hashes):
+        # bounds the chunks in flight for this query, like `query_workers` threads
+        workers = asyncio.Semaphore(self.query_workers)
+        chunks = await asyncio.gather(*[self._select_chunk(split_values, workers)
+                                        for split_values in grouper(list(hashes), self.query_chunk_size)])
+        return [row for rows in chunks for row in rows]
+
+    async def get_song_by_id(self, sid):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(SQLDatabase.SELECT_SONG, (sid,))
+                return await cur.fetchone()
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+
+class AsyncDatabaseAdapter(AsyncDatabase):
+    """
+    Runs the lookups of a blocking `Database` on an executor, or right on
+    the event loop when `inline` is set, for embedded databases answering
+    from memory.
+    """
+
+    def __init__(self, database, executor=None, inline=False):
+        super(AsyncDatabaseAdapter, self).__init__()
+        self.database = database
+        self.executor = executor
+        self.inline = inline
+
+    async def _call(self, method, *args):
+        if self.inline:
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    def _postings(self, hashes):
+        return list(self.database.return_postings(hashes))
+
+    async def return_postings(self, hashes):
+        return await self._call(self._postings, list(hashes))
+
+    async def get_song_by_id(self, sid):
+        return await self._call(self.database.get_song_by_id, sid)
+
+
+def get_async_database(database, executor=None):
+    """
+    Returns the async counterpart of `database`: `AsyncSQLDatabase` for
+    MySQL when aiomysql is installed, inline lookups for `MemoryDatabase`
+    and lookups on `executor` for anything else.
+    """
+    if isinstance(database, SQLDatabase) and aiomysql is not None:
+        return AsyncSQLDatabase(**database._options)
+    if isinstance(database, MemoryDatabase):
+        return AsyncDatabaseAdapter(database, inline=True)
+    return AsyncDatabaseAdapter(database, executor=executor)
@@ -0,0 +1,242 @@
+from __future__ import absolute_import
+import sys
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+from ads_dejavu.database import Database
+
+
+class CachedDatabase(Database):
+    """
+    Read-through LRU cache of hash => posting list in front of any `Database`.
+
+    Lookups of hashes seen recently, including those with no fingerprints
+    at all, are answered from memory and only the misses are sent to the
+    wrapped database. Inserting fingerprints invalidates the cached entries
+    of their hashes.
+
+    ```python
+    db = CachedDatabase(SQLDatabase(**options), max_bytes=256 * 2**20)
+    ```
+    """
+
+    def __init__(self, database, max_bytes=256 * 2**20):
+        super(CachedDatabase, self).__init__()
+        self.database = database
+        self.max_bytes = max_bytes
+
+        # hash => array of interleaved song_id, offset values
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        # bumped by every invalidation, so lookups that raced with an
+        # insert don't store stale posting lists
+        self._generation = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        # backend specific methods, like `SQLDatabase.get_pool_stats`
+        if name.startswith('__') or name == 'database':
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+            hits, misses: Hash lookups served from memory or sent to the database
+               hit_ratio: hits / (hits + misses)
+        entries, bytes: Cached hashes and the memory they use
+               evictions: Entries dropped to stay under `max_bytes`
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.,
+                "entries": len(self._cache),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        """
+        Drops every cached posting list.
+        """
+        with self._lock:
+            self._cache.clear()
+            self.bytes = 0
+            self._generation += 1
+
+    def invalidate(self, hashes):
+        """
+        Drops the cached posting lists of the given hashes.
+        """
+        with self._lock:
+            for hash in hashes:
+                hash = hash.upper()
+                postings = self._cache.pop(hash, None)
+                if postings is not None:
+                    self.bytes -= self._entry_size(hash, postings)
+            self._generation += 1
+
+    @staticmethod
+    def _entry_size(hash, postings):
+        return sys.getsizeof(hash) + sys.getsizeof(postings)
+
+    def _store(self, generation, fetched):
+        with self._lock:
+            if generation != self._generation:
+                return
+            for hash, postings in fetched.items():
+                size = self._entry_size(hash, postings)
+                if size > self.max_bytes or hash in self._cache:
+                    continue
+                self._cache[hash] = postings
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                hash, postings = self._cache.popitem(last=False)
+                self.bytes -= self._entry_size(hash, postings)
+                self.evictions += 1
+
+    def return_postings(self, hashes):
+        """
+        Return the (sha1, song_id, offset) tuples of the given hashes,
+        querying the wrapped database only for the ones not cached.
+        Hashes are cached, and returned, uppercase like the database does.
+        """
+        hits = []
+        misses = []
+        with self._lock:
+            generation = self._generation
+            for hash in hashes:
+                hash = hash.upper()
+                postings = self._cache.get(hash)
+                if postings is None:
+                    misses.append(hash)
+                    continue
+                self._cache.move_to_end(hash)
+                hits.append((hash, postings))
+            self.hits += len(hits)
+            self.misses += len(misses)
+
+        for hash, postings in hits:
+            for i in range(0, len(postings), 2):
+                yield (hash, postings[i], postings[i + 1])
+
+        if not misses:
+            return
+
+        # hashes without fingerprints are cached too, they are the most common
+        fetched = dict((hash, array('I')) for hash in misses)
+        for hash, sid, offset in self.database.return_postings(misses):
+            fetched[hash].extend((sid, offset))
+            yield (hash, sid, offset)
+        self._store(generation, fetched)
+
+    def return_matches(self, mapper, as_arrays=False):
+        postings = self.return_postings(mapper.keys())
+        if as_arrays:
+            return self.match_arrays(postings, mapper)
+        return mapper.matches(postings)
+
+    def insert(self, hash, sid, offset):
+        self.database.insert(hash, sid, offset)
+        self.invalidate([hash])
+
+    def insert_hashes(self, sid, hashes):
+        hashes = list(hashes)
+        self.database.insert_hashes(sid, hashes)
+        self.invalidate([hash for hash, _ in hashes])
+
+    def insert_hashes_bulk(self, songs_hashes, **options):
+        songs_hashes = list(songs_hashes)
+        stats = self.database.insert_hashes_bulk(songs_hashes, **options)
+        self.invalidate([hash for _, hashes in songs_hashes for hash, _ in hashes])
+        return stats
+
+    def empty(self):
+        self.database.empty()
+        self.clear()
+
+    def delete_unfingerprinted_songs(self):
+        self.database.delete_unfingerprinted_songs()
+        self.clear()
+
+    def rebuild_stoplist(self, max_postings, prune=False):
+        size = self.database.rebuild_stoplist(max_postings, prune=prune)
+        if prune:
+            self.clear()
+        return size
+
+    def before_fork(self):
+        self.database.before_fork()
+
+    def after_fork(self):
+        self.database.after_fork()
+
+    def setup(self):
+        self.database.setup()
+        self.clear()
+
+    def get_num_songs(self):
+        return self.database.get_num_songs()
+
+    def get_num_fingerprints(self):
+        return self.database.get_num_fingerprints()
+
+    def set_song_fingerprinted(self, sid):
+        self.database.set_song_fingerprinted(sid)
+
+    def get_songs(self):
+        return self.database.get_songs()
+
+    def get_song_by_id(self, sid):
+        return self.database.get_song_by_id(sid)
+
+    def get_songs_by_ids(self, sids):
+        return self.database.get_songs_by_ids(sids)
+
+    def insert_song(self, *args, **kwargs):
+        return self.database.insert_song(*args, **kwargs)
+
+    def query(self, hash):
+        return self.database.query(hash)
+
+    def get_iterable_kv_pairs(self):
+        return self.database.get_iterable_kv_pairs()
+
+    def get_hashes(self):
+        return self.database.get_hashes()
+
+    def get_fingerprints(self):
+        return self.database.get_fingerprints()
+
+    def export_snapshot(self, path, compression="zlib"):
+        return self.database.export_snapshot(path, compression=compression)
+
+    def import_snapshot(self, snapshot):
+        stats = self.database.import_snapshot(snapshot)
+        self.clear()
+        return stats
+
+    def return_match_histogram(self, hashes, top_k=10):
+        return self.database.return_match_histogram(hashes, top_k=top_k)
+
+    def get_stoplist(self):
+        return self.database.get_stoplist()
+
+    def deferred_indexes(self):
+        return self.database.deferred_indexes()
+
+    def __getstate__(self):
+        # the cache itself stays behind, the new process starts empty
+        return (self.database, self.max_bytes)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
@@ -0,0 +1,300 @@
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+from threading import RLock
+import logging
+import time
+
+import numpy as np
+
+from ads_dejavu.database import Database
+from ads_dejavu.snapshot import Snapshot, SONG_FIELDS, hash_dtype
+
+
+class MemoryDatabase(Database):
+    """
+    Keeps the whole catalog in memory, as columns sorted by hash that are
+    looked up with binary searches. Meant for recognition nodes bootstrapped
+    from a snapshot, which stays memory mapped when stored uncompressed.
+
+    Fingerprints inserted afterwards are buffered and merged into the sorted
+    columns on the next lookup. Nothing is written back to disk, use
+    `export_snapshot` for that.
+
+    ```python
+    db = MemoryDatabase(snapshot="catalog.djv")
+    ```
+    """
+
+    type = "memory"
+
+    def __init__(self, snapshot=None, mmap=True):
+        super(MemoryDatabase, self).__init__()
+        self._options = {"snapshot": snapshot, "mmap": mmap}
+        self._lock = RLock()
+        self._reset()
+        if snapshot is not None:
+            self.import_snapshot(Snapshot.load(snapshot, mmap=mmap))
+
+    def _reset(self):
+        self.hashes = np.zeros(0, hash_dtype())
+        self.song_ids = np.zeros(0, "<u4")
+        self.offsets = np.zeros(0, "<u4")
+        # (hashes, song_ids, offsets) arrays waiting to be merged
+        self._pending = []
+        # song_id => song fields plus the fingerprinted flag
+        self.songs = {}
+        # stop-listed hash => number of fingerprints
+        self._stoplist = {}
+        self._next_sid = 1
+
+    def _merge(self):
+        """
+        Merges the pending fingerprints into the sorted columns, dropping
+        duplicated rows, and counts the fingerprints of their songs again.
+        Must be called holding the lock.
+        """
+        if not self._pending:
+            return
+        sids = np.unique(np.concatenate([pending[1] for pending in self._pending]))
+        columns = [self.hashes, self.song_ids, self.offsets]
+        for i, column in enumerate(zip(*self._pending)):
+            columns[i] = np.concatenate([columns[i]] + list(column))
+        self._pending = []
+
+        hashes, song_ids, offsets = columns
+        order = np.lexsort((offsets, song_ids, hashes))
+        hashes, song_ids, offsets = hashes[order], song_ids[order], offsets[order]
+        unique = np.ones(len(hashes), dtype=bool)
+        unique[1:] = (hashes[1:] != hashes[:-1]) | (song_ids[1:] != song_ids[:-1]) | (offsets[1:] != offsets[:-1])
+        self.hashes, self.song_ids, self.offsets = hashes[unique], song_ids[unique], offsets[unique]
+
+        counted, counts = np.unique(self.song_ids[np.isin(self.song_ids, sids)], return_counts=True)
+        counts = dict(zip(counted.tolist(), counts.tolist()))
+        for sid in sids.tolist():
+            if sid in self.songs:
+                self.songs[sid][Database.FIELD_NUM_FINGERPRINTS] = counts.get(sid, 0)
+
+    def _columns(self):
+        with self._lock:
+            self._merge()
+            return self.hashes, self.song_ids, self.offsets
+
+    def _delete_songs(self, sids):
+        with self._lock:
+            self._merge()
+            keep = ~np.isin(self.song_ids, np.array(list(sids), dtype="<u4"))
+            self.hashes, self.song_ids, self.offsets = self.hashes[keep], self.song_ids[keep], self.offsets[keep]
+            for sid in sids:
+                del self.songs[sid]
+
+    def empty(self):
+        with self._lock:
+            self._reset()
+
+    def delete_unfingerprinted_songs(self):
+        with self._lock:
+            self._delete_songs([sid for sid, song in self.songs.items() if not song["fingerprinted"]])
+
+    def get_num_songs(self):
+        with self._lock:
+            return sum(1 for song in self.songs.values() if song["fingerprinted"])
+
+    def get_num_fingerprints(self):
+        return len(self._columns()[0])
+
+    def set_song_fingerprinted(self, sid):
+        with self._lock:
+            self.songs[sid]["fingerprinted"] = True
+
+    def _song(self, sid):
+        # pending fingerprints aren't counted until merged
+        self._merge()
+        return dict((field, self.songs[sid][field]) for field in SONG_FIELDS)
+
+    def get_songs(self):
+        with self._lock:
+            songs = [self._song(sid) for sid, song in self.songs.items() if song["fingerprinted"]]
+        return iter(songs)
+
+    def get_song_by_id(self, sid):
+        with self._lock:
+            return self._song(sid) if sid in self.songs else None
+
+    def get_songs_by_ids(self, sids):
+        with self._lock:
+            return dict((sid, self._song(sid)) for sid in sids if sid in self.songs)
+
+    def insert(self, hash, sid, offset):
+        self.insert_hashes(sid, [(hash, offset)])
+
+    def insert_song(self, song_name, file_hash, audio_length):
+        with self._lock:
+            sid = self._next_sid
+            self._next_sid += 1
+            self.songs[sid] = {
+                Database.FIELD_SONG_ID: sid,
+                Database.FIELD_SONGNAME: song_name,
+                Database.FIELD_FILE_SHA1: file_hash.upper(),
+                Database.AUDIO_LENGTH: audio_length,
+                Database.FIELD_NUM_FINGERPRINTS: 0,
+                "fingerprinted": False,
+            }
+            return sid
+
+    def insert_hashes(self, sid, hashes):
+        hashes = set(hashes)
+        if not hashes:
+            return
+        values, offsets = zip(*hashes)
+        with self._lock:
+            self._pending.append((np.array([unhexlify(hash) for hash in values], dtype=self.hashes.dtype),
+                                  np.full(len(values), sid, dtype="<u4"),
+                                  np.array(offsets, dtype="<u4")))
+
+    def query(self, hash):
+        if hash is None:
+            return self.get_iterable_kv_pairs()
+        return ((sid, offset) for _, sid, offset in self.return_postings([hash]))
+
+    def get_iterable_kv_pairs(self):
+        _, song_ids, offsets = self._columns()
+        return zip(song_ids.tolist(), offsets.tolist())
+
+    def _to_hex(self, hashes):
+        width = 2 * hashes.dtype.itemsize
+        hex_hashes = hexlify(hashes.tobytes()).decode().upper()
+        return [hex_hashes[i:i + width] for i in range(0, len(hex_hashes), width)]
+
+    def get_hashes(self):
+        return iter(self._to_hex(np.unique(self._columns()[0])))
+
+    def get_fingerprints(self):
+        hashes, song_ids, offsets = self._columns()
+        return zip(self._to_hex(hashes), song_ids.tolist(), offsets.tolist())
+
+    def _lookup(self, hashes):
+        """
+        Returns the stored song ids and offsets of the given hashes, and
+        the index of the query hash each of them answers.
+        """
+        stored, song_ids, offsets = self._columns()
+        query = np.array([unhexlify(hash) for hash in hashes], dtype=stored.dtype)
+        lo = np.searchsorted(stored, query, side="left")
+        counts = np.searchsorted(stored, query, side="right") - lo
+        # row of every posting, and the query hash it answers
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        rows = starts + np.arange(len(starts))
+        owners = np.repeat(np.arange(len(hashes)), counts)
+        return song_ids[rows], offsets[rows], owners
+
+    def return_postings(self, hashes):
+        """
+        Return the (sha1, song_id, offset) tuples of the given hashes, with
+        sha1 as given.
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return iter(())
+        song_ids, offsets, owners = self._lookup(hashes)
+        return zip([hashes[i] for i in owners.tolist()], song_ids.tolist(), offsets.tolist())
+
+    def return_matches(self, mapper, as_arrays=False):
+        hashes = list(mapper)
+        if not hashes:
+            song_ids = offsets = owners = np.zeros(0, np.int64)
+        else:
+            song_ids, offsets, owners = self._lookup(hashes)
+        song_ids, diffs = mapper.join(owners, song_ids, offsets)
+        if as_arrays:
+            return song_ids, diffs
+        return zip(song_ids.tolist(), diffs.tolist())
+
+    def get_stoplist(self):
+        with self._lock:
+            return dict(self._stoplist)
+
+    def rebuild_stoplist(self, max_postings, prune=False):
+        """
+        Recomputes the stop-list with the hashes having more than
+        `max_postings` fingerprints and returns its size. Like the
+        fingerprints, it only lives as long as this database.
+
+        Hashes pruned earlier stay in the stop-list while they are still
+        over the threshold, even though they are no longer in fingerprints.
+        """
+        t = time.time()
+        with self._lock:
+            hashes, song_ids, offsets = self._columns()
+            unique, counts = np.unique(hashes, return_counts=True)
+            hot = counts > max_postings
+            stoplist = dict((hash, n) for hash, n in self._stoplist.items() if n > max_postings)
+            stoplist.update(zip(self._to_hex(unique[hot]), counts[hot].tolist()))
+            self._stoplist = stoplist
+
+            if prune and stoplist:
+                stoplisted = np.array([unhexlify(hash) for hash in stoplist], dtype=hashes.dtype)
+                # the column is sorted, every unique hash stands for a run of rows
+                keep = ~np.repeat(np.isin(unique, stoplisted), counts)
+                self.hashes, self.song_ids, self.offsets = hashes[keep], song_ids[keep], offsets[keep]
+                counted, counts = np.unique(self.song_ids, return_counts=True)
+                counts = dict(zip(counted.tolist(), counts.tolist()))
+                for sid, song in self.songs.items():
+                    song[Database.FIELD_NUM_FINGERPRINTS] = counts.get(sid, 0)
+        logging.getLogger('dejavu').info("Stop-listed %d hashes with more than %d fingerprints in %.2f seconds" %
+                                         (len(stoplist), max_postings, time.time() - t))
+        return len(stoplist)
+
+    def export_snapshot(self, path, compression="zlib"):
+        with self._lock:
+            hashes, song_ids, offsets = self._columns()
+            songs = list(self.get_songs())
+            keep = np.isin(song_ids, np.array([song[Database.FIELD_SONG_ID] for song in songs], dtype="<u4"))
+        snapshot = Snapshot(hashes[keep], song_ids[keep], offsets[keep], songs)
+        snapshot.save(path, compression=compression)
+        return snapshot
+
+    def import_snapshot(self, snapshot):
+        """
+        Adds the songs and fingerprints of a snapshot. Into an empty
+        database its columns are taken as they are, memory mapped ones
+        included, otherwise they are merged with the stored ones.
+        """
+        if not isinstance(snapshot, Snapshot):
+            snapshot = Snapshot.load(snapshot, mmap=self._options["mmap"])
+        snapshot.check_params()
+
+        with self._lock:
+            if not self.songs:
+                for song in snapshot.songs:
+                    self.songs[song[Database.FIELD_SONG_ID]] = dict(song, fingerprinted=True)
+                self._next_sid = max(self.songs) + 1 if self.songs else 1
+                self.hashes, self.song_ids, self.offsets = snapshot.hashes, snapshot.song_ids, snapshot.offsets
+                return {"rows": len(snapshot), "songs": len(snapshot.songs)}
+
+            # songs get new identifiers, the ones already stored are skipped
+            existing = set(song[Database.FIELD_FILE_SHA1] for song in self.songs.values())
+            sids = np.zeros(max([0] + [song[Database.FIELD_SONG_ID] for song in snapshot.songs]) + 1, dtype="<u4")
+            for song in snapshot.songs:
+                if song[Database.FIELD_FILE_SHA1].upper() in existing:
+                    continue
+                sid = self.insert_song(song[Database.FIELD_SONGNAME], song[Database.FIELD_FILE_SHA1],
+                                       song[Database.AUDIO_LENGTH])
+                self.songs[sid].update({
+                    Database.FIELD_NUM_FINGERPRINTS: song[Database.FIELD_NUM_FINGERPRINTS],
+                    "fingerprinted": True,
+                })
+                sids[song[Database.FIELD_SONG_ID]] = sid
+
+            new_ids = sids[snapshot.song_ids]
+            keep = new_ids > 0
+            self._pending.append((snapshot.hashes[keep], new_ids[keep], snapshot.offsets[keep]))
+            self._merge()
+            return {"rows": int(np.count_nonzero(keep)), "songs": int(np.count_nonzero(sids))}
+
+    def __getstate__(self):
+        # a new process loads the same snapshot again, later inserts stay behind
+        return (self._options,)
+
+    def __setstate__(self, state):
+        options, = state
+        self.__init__(**options)
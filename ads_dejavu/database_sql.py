@@ -2,23 +2,28 @@ from __future__ import absolute_import
 import logging
 
 try:
-    import queue
     from itertools import zip_longest
 except ImportError:
-    import Queue as queue
     from itertools import izip_longest as zip_longest
+from concurrent import futures
 import math
+import os
+import time
 
 import pymysql as mysql
-from pymysql.cursors import DictCursor
+from pymysql.cursors import DictCursor, SSCursor
 
 from ads_dejavu.database import Database
 from ads_dejavu.fingerprint import FINGERPRINT_REDUCTION
 
 from multiprocessing import cpu_count
-from threading import Thread
+from threading import Condition, Lock
+from collections import deque
 
 from itertools import chain
+from binascii import unhexlify
+from contextlib import contextmanager
+import tempfile
 
 class SQLDatabase(Database):
     """
@@ -61,9 +66,12 @@ class SQLDatabase(Database):
     # tables
     FINGERPRINTS_TABLENAME = "fingerprints"
     SONGS_TABLENAME = "songs"
+    QUERY_HASHES_TABLENAME = "query_hashes"
+    STOPLIST_TABLENAME = "stoplist"
 
     # fields
     FIELD_FINGERPRINTED = "fingerprinted"
+    FIELD_POSTINGS = "postings"
 
     # creates
     CREATE_FINGERPRINTS_TABLE = """
@@ -81,6 +89,20 @@ class SQLDatabase(Database):
         Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID
     )
 
+    # schema version 2: the rows live in the clustered primary key itself,
+    # lookups by hash read no other B-tree. Songs cascade by hand.
+    CREATE_FINGERPRINTS_TABLE_V2 = """
+        CREATE TABLE IF NOT EXISTS `%%s` (
+             `%s` binary (%s) not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+         PRIMARY KEY (%s, %s, %s)
+    ) ENGINE=INNODB;""" % (
+        Database.FIELD_HASH, str(math.ceil(FINGERPRINT_REDUCTION/2.)),
+        Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+        Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET
+    )
+
     CREATE_SONGS_TABLE = """
         CREATE TABLE IF NOT EXISTS `%s` (
             `%s` mediumint unsigned not null auto_increment,
@@ -88,14 +110,88 @@ class SQLDatabase(Database):
             `%s` tinyint default 0,
             `%s` binary(20) not null,
             `%s` float,
+            `%s` int unsigned not null default 0,
         PRIMARY KEY (`%s`),
         UNIQUE KEY `%s` (`%s`)
     ) ENGINE=INNODB;""" % (
         SONGS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, FIELD_FINGERPRINTED,
-        Database.FIELD_FILE_SHA1, Database.AUDIO_LENGTH,
+        Database.FIELD_FILE_SHA1, Database.AUDIO_LENGTH, Database.FIELD_NUM_FINGERPRINTS,
         Database.FIELD_SONG_ID, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
     )
 
+    CREATE_STOPLIST_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+             `%s` binary (%s) not null,
+             `%s` int unsigned not null,
+         PRIMARY KEY (%s)
+    ) ENGINE=INNODB;""" % (
+        STOPLIST_TABLENAME, Database.FIELD_HASH, str(math.ceil(FINGERPRINT_REDUCTION/2.)),
+        FIELD_POSTINGS, Database.FIELD_HASH
+    )
+
+    # migrations
+    SELECT_NUM_FINGERPRINTS_COLUMN = """
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '%s' AND COLUMN_NAME = '%s';
+    """ % (SONGS_TABLENAME, Database.FIELD_NUM_FINGERPRINTS)
+
+    ADD_NUM_FINGERPRINTS_COLUMN = """
+        ALTER TABLE %s ADD COLUMN `%s` int unsigned not null default 0;
+    """ % (SONGS_TABLENAME, Database.FIELD_NUM_FINGERPRINTS)
+
+    # songs left without fingerprints get no count row, so they are set to 0
+    BACKFILL_NUM_FINGERPRINTS = """
+        UPDATE %s
+        LEFT JOIN (
+            SELECT %s, count(*) as n FROM %s GROUP BY %s
+        ) counts ON counts.%s = %s.%s
+        SET %s.%s = COALESCE(counts.n, 0);
+    """ % (SONGS_TABLENAME,
+           Database.FIELD_SONG_ID, FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID,
+           Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID,
+           SONGS_TABLENAME, Database.FIELD_NUM_FINGERPRINTS)
+
+    BACKFILL_SONGS_NUM_FINGERPRINTS = """
+        UPDATE %s
+        LEFT JOIN (
+            SELECT %s, count(*) as n FROM %s WHERE %s IN (%%s) GROUP BY %s
+        ) counts ON counts.%s = %s.%s
+        SET %s.%s = COALESCE(counts.n, 0)
+        WHERE %s.%s IN (%%s);
+    """ % (SONGS_TABLENAME,
+           Database.FIELD_SONG_ID, FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
+           Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID,
+           SONGS_TABLENAME, Database.FIELD_NUM_FINGERPRINTS,
+           SONGS_TABLENAME, Database.FIELD_SONG_ID)
+
+    SELECT_FINGERPRINTS_PRIMARY_KEY = """
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = 'PRIMARY';
+    """
+
+    SELECT_MAX_SONG_ID = "SELECT COALESCE(MAX(%s), 0) FROM %s;" % (Database.FIELD_SONG_ID, SONGS_TABLENAME)
+
+    COPY_FINGERPRINTS = """
+        INSERT IGNORE INTO `%%s` (%s, %s, %s)
+            SELECT %s, %s, %s FROM `%%s` WHERE %s > %%%%s AND %s <= %%%%s;
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+           Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+           Database.FIELD_SONG_ID, Database.FIELD_SONG_ID)
+
+    SWAP_FINGERPRINTS_TABLES = "RENAME TABLE `%s` TO `%%s`, `%%s` TO `%s`;" % (
+        FINGERPRINTS_TABLENAME, FINGERPRINTS_TABLENAME)
+
+    SELECT_TABLE_SIZES = """
+        SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s, %s);
+    """
+
+    SELECT_SAMPLE_HASHES = "SELECT HEX(%s) FROM `%%s` LIMIT %%%%s;" % Database.FIELD_HASH
+
+    SELECT_MULTIPLE_FROM = """
+        SELECT HEX(%s), %s, %s FROM `%%s` WHERE %s IN (%%%%s);
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_HASH)
+
     # inserts (ignores duplicates)
     INSERT_FINGERPRINT = """
         INSERT IGNORE INTO %s (%s, %s, %s) values
@@ -105,6 +201,38 @@ class SQLDatabase(Database):
     INSERT_SONG = "INSERT INTO %s (%s, %s, %s) values (%%s, UNHEX(%%s), %%s);" % (
         SONGS_TABLENAME, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.AUDIO_LENGTH)
 
+    # bulk loads
+    INSERT_FINGERPRINTS_MANY = """
+        INSERT IGNORE INTO %s (%s, %s, %s) values (%%s, %%s, %%s);
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    LOAD_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s INTO TABLE %s
+        FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n'
+        (@%s, %s, %s) SET %s = UNHEX(@%s);
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+           Database.FIELD_HASH, Database.FIELD_HASH)
+
+    SELECT_FOREIGN_KEYS = """
+        SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = %s;
+    """
+
+    DROP_FOREIGN_KEY = "ALTER TABLE `%s` DROP FOREIGN KEY `%s`;"
+
+    DROP_FINGERPRINTS_INDEXES = """
+        ALTER TABLE %s DROP INDEX `%s`, DROP INDEX `unique_constraint`;
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+
+    ADD_FINGERPRINTS_INDEXES = """
+        ALTER TABLE %s
+            ADD INDEX (%s),
+            ADD UNIQUE KEY `unique_constraint` (%s, %s, %s),
+            ADD FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE;
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+           Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
+           Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID)
+
     # selects
     SELECT = """
         SELECT %s, %s FROM %s WHERE %s = UNHEX(%%s);
@@ -115,21 +243,73 @@ class SQLDatabase(Database):
     """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
            FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
 
+    # server side alignment
+    CREATE_QUERY_HASHES_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS `%s` (
+             `%s` binary (%s) not null,
+             `%s` int unsigned not null,
+         INDEX (%s)
+    ) ENGINE=MEMORY;""" % (
+        QUERY_HASHES_TABLENAME, Database.FIELD_HASH, str(math.ceil(FINGERPRINT_REDUCTION/2.)),
+        Database.FIELD_OFFSET, Database.FIELD_HASH
+    )
+
+    INSERT_QUERY_HASH = "INSERT INTO %s (%s, %s) values (%%s, %%s);" % (
+        QUERY_HASHES_TABLENAME, Database.FIELD_HASH, Database.FIELD_OFFSET)
+
+    SELECT_MATCH_HISTOGRAM = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - CAST(q.%s AS SIGNED) as diff, count(*) as n
+        FROM %s q
+        JOIN %s f ON f.%s = q.%s
+        GROUP BY f.%s, diff
+        ORDER BY n DESC
+        LIMIT %%s;
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_OFFSET,
+           QUERY_HASHES_TABLENAME,
+           FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_HASH,
+           Database.FIELD_SONG_ID)
+
+    DROP_QUERY_HASHES = "DROP TEMPORARY TABLE IF EXISTS %s;" % QUERY_HASHES_TABLENAME
+
+    # stop-list
+    SELECT_STOPLIST = """
+        SELECT HEX(%s), %s FROM %s;
+    """ % (Database.FIELD_HASH, FIELD_POSTINGS, STOPLIST_TABLENAME)
+
+    INSERT_STOPLIST = """
+        INSERT INTO %s (%s, %s)
+            SELECT %s, count(*) as n FROM %s GROUP BY %s HAVING n > %%s
+        ON DUPLICATE KEY UPDATE %s = VALUES(%s);
+    """ % (STOPLIST_TABLENAME, Database.FIELD_HASH, FIELD_POSTINGS,
+           Database.FIELD_HASH, FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+           FIELD_POSTINGS, FIELD_POSTINGS)
+
+    DELETE_STOPLIST = """
+        DELETE FROM %s WHERE %s <= %%s;
+    """ % (STOPLIST_TABLENAME, FIELD_POSTINGS)
+
+    DELETE_STOPLISTED_FINGERPRINTS = """
+        DELETE %s FROM %s JOIN %s ON %s.%s = %s.%s;
+    """ % (FINGERPRINTS_TABLENAME, FINGERPRINTS_TABLENAME, STOPLIST_TABLENAME,
+           FINGERPRINTS_TABLENAME, Database.FIELD_HASH, STOPLIST_TABLENAME, Database.FIELD_HASH)
+
     SELECT_ALL = """
         SELECT %s, %s FROM %s;
     """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME)
 
+    SELECT_HASHES = """
+        SELECT DISTINCT HEX(%s) FROM %s;
+    """ % (Database.FIELD_HASH, FINGERPRINTS_TABLENAME)
+
     SELECT_SONG = """
-        SELECT %s, HEX(%s) as %s, %s, count(*) as %s
-        FROM %s
-        JOIN %s ON %s.%s = %s.%s
-        WHERE %s.%s = %%s
-        group by %s.%s;
-    """ % (Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1, Database.AUDIO_LENGTH, 'num_fingerprints',
-           SONGS_TABLENAME,
-           FINGERPRINTS_TABLENAME, SONGS_TABLENAME, Database.FIELD_SONG_ID, FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID,
-           SONGS_TABLENAME, Database.FIELD_SONG_ID,
-           SONGS_TABLENAME, Database.FIELD_SONG_ID)
+        SELECT %s, HEX(%s) as %s, %s, %s FROM %s WHERE %s = %%s;
+    """ % (Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1, Database.AUDIO_LENGTH,
+           Database.FIELD_NUM_FINGERPRINTS, SONGS_TABLENAME, Database.FIELD_SONG_ID)
+
+    SELECT_SONGS_BY_IDS = """
+        SELECT %s, %s, HEX(%s) as %s, %s, %s FROM %s WHERE %s IN (%%s);
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1,
+           Database.AUDIO_LENGTH, Database.FIELD_NUM_FINGERPRINTS, SONGS_TABLENAME, Database.FIELD_SONG_ID)
 
     SELECT_NUM_FINGERPRINTS = """
         SELECT COUNT(*) as n FROM %s
@@ -140,34 +320,82 @@ class SQLDatabase(Database):
     """ % (Database.FIELD_SONG_ID, SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
     SELECT_SONGS = """
-        SELECT %s, %s, HEX(%s) as %s FROM %s WHERE %s = 1;
+        SELECT %s, %s, HEX(%s) as %s, %s, %s FROM %s WHERE %s = 1;
     """ % (Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1,
-           SONGS_TABLENAME, FIELD_FINGERPRINTED)
+           Database.AUDIO_LENGTH, Database.FIELD_NUM_FINGERPRINTS, SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    SELECT_FINGERPRINTS = """
+        SELECT HEX(%s), %s, %s FROM %s;
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME)
 
     # drops
     DROP_FINGERPRINTS = "DROP TABLE IF EXISTS %s;" % FINGERPRINTS_TABLENAME
     DROP_SONGS = "DROP TABLE IF EXISTS %s;" % SONGS_TABLENAME
+    DROP_STOPLIST = "DROP TABLE IF EXISTS %s;" % STOPLIST_TABLENAME
+    DROP_OLD_FINGERPRINTS = "DROP TABLE IF EXISTS %s_v1;" % FINGERPRINTS_TABLENAME
+    DROP_TABLE = "DROP TABLE IF EXISTS `%s`;"
+    ANALYZE_TABLE = "ANALYZE TABLE `%s`;"
 
     # update
     UPDATE_SONG_FINGERPRINTED = """
         UPDATE %s SET %s = 1 WHERE %s = %%s
     """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, Database.FIELD_SONG_ID)
 
+    UPDATE_SONG_NUM_FINGERPRINTS = """
+        UPDATE %s SET %s = %s + %%s WHERE %s = %%s
+    """ % (SONGS_TABLENAME, Database.FIELD_NUM_FINGERPRINTS, Database.FIELD_NUM_FINGERPRINTS, Database.FIELD_SONG_ID)
+
     # delete
     DELETE_UNFINGERPRINTED = """
         DELETE FROM %s WHERE %s = 0;
     """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
-    def __init__(self, **options):
+    SELECT_NUM_UNFINGERPRINTED = """
+        SELECT COUNT(*) FROM %s WHERE %s = 0;
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    DELETE_UNFINGERPRINTED_FINGERPRINTS = """
+        DELETE %s FROM %s JOIN %s ON %s.%s = %s.%s WHERE %s.%s = 0;
+    """ % (FINGERPRINTS_TABLENAME, FINGERPRINTS_TABLENAME, SONGS_TABLENAME,
+           FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID,
+           SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    def __init__(self, query_chunk_size=10000, query_workers=None, schema_version=1, **options):
         super(SQLDatabase, self).__init__()
         self.cursor = cursor_factory(**options)
-        self._options = options
+        self._options = dict(options, query_chunk_size=query_chunk_size, query_workers=query_workers,
+                             schema_version=schema_version)
+
+        # Schema of the fingerprints table created by `setup`, tables that
+        # already exist keep theirs until `migrate_schema` runs
+        if schema_version not in (1, 2):
+            raise ValueError("Unsupported schema version: %s" % schema_version)
+        self.schema_version = schema_version
+
+        # Hashes per SELECT and how many of those run concurrently
+        self.query_chunk_size = query_chunk_size
+        self.query_workers = query_workers or self.cursor.pool.max_size
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = Lock()
+        # (hashes, rows, seconds) of the most recent SELECT chunks
+        self.chunk_timings = deque(maxlen=1000)
+
+    def before_fork(self):
+        # Close idle connections so the child doesn't inherit their sockets.
+        self.cursor.pool.close_idle()
 
     def after_fork(self):
         # Clear the cursor cache, we don't want any stale connections from
         # the previous process.
         Cursor.clear_cache()
 
+    def get_pool_stats(self):
+        """
+        Returns the counters of the connection pool used by this database.
+        """
+        return self.cursor.pool.stats()
+
     def setup(self):
         """
         Creates any non-existing tables required for dejavu to function.
@@ -178,11 +406,42 @@ class SQLDatabase(Database):
         with self.cursor() as cur:
             try:
                 cur.execute(self.CREATE_SONGS_TABLE)
-                cur.execute(self.CREATE_FINGERPRINTS_TABLE)
-                cur.execute(self.DELETE_UNFINGERPRINTED)
+                if self.schema_version == 2:
+                    cur.execute(self.CREATE_FINGERPRINTS_TABLE_V2 % self.FINGERPRINTS_TABLENAME)
+                else:
+                    cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+                cur.execute(self.CREATE_STOPLIST_TABLE)
+                self._delete_unfingerprinted(cur)
             except mysql.MySQLError as e:
                 logging.exception(e)
 
+        self.migrate()
+
+    def migrate(self):
+        """
+        Brings tables created by older versions of dejavu up to date.
+
+        Songs tables without a `num_fingerprints` column get one, filled
+        from the fingerprints table.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_NUM_FINGERPRINTS_COLUMN)
+            column_exists, = cur.fetchone()
+            if column_exists:
+                return
+            cur.execute(self.ADD_NUM_FINGERPRINTS_COLUMN)
+        self.backfill_num_fingerprints()
+
+    def backfill_num_fingerprints(self):
+        """
+        Recomputes the number of fingerprints stored for every song.
+        """
+        t = time.time()
+        with self.cursor() as cur:
+            cur.execute(self.BACKFILL_NUM_FINGERPRINTS)
+        logging.getLogger('dejavu').info("Backfilled %s in %.2f seconds" %
+                                         (Database.FIELD_NUM_FINGERPRINTS, time.time() - t))
+
     def empty(self):
         """
         Drops tables created by dejavu and then creates them again
@@ -192,8 +451,11 @@ class SQLDatabase(Database):
             This will result in a loss of data
         """
         with self.cursor() as cur:
+            # the table `migrate_schema` kept may reference the songs
+            cur.execute(self.DROP_OLD_FINGERPRINTS)
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
+            cur.execute(self.DROP_STOPLIST)
 
         self.setup()
 
@@ -202,7 +464,128 @@ class SQLDatabase(Database):
         Removes all songs that have no fingerprints associated with them.
         """
         with self.cursor() as cur:
-            cur.execute(self.DELETE_UNFINGERPRINTED)
+            self._delete_unfingerprinted(cur)
+
+    def _delete_unfingerprinted(self, cur):
+        if self._fingerprints_schema_version(cur) == 2:
+            # No foreign key to cascade, and the join scans the whole
+            # fingerprints table, so only run it when there's something to delete
+            cur.execute(self.SELECT_NUM_UNFINGERPRINTED)
+            unfingerprinted, = cur.fetchone()
+            if unfingerprinted:
+                cur.execute(self.DELETE_UNFINGERPRINTED_FINGERPRINTS)
+        cur.execute(self.DELETE_UNFINGERPRINTED)
+
+    def _fingerprints_schema_version(self, cur, table=FINGERPRINTS_TABLENAME):
+        cur.execute(self.SELECT_FINGERPRINTS_PRIMARY_KEY, (table,))
+        has_primary_key, = cur.fetchone()
+        return 2 if has_primary_key else 1
+
+    def _drop_foreign_keys(self, cur, table):
+        cur.execute(self.SELECT_FOREIGN_KEYS, (table,))
+        for name, in cur.fetchall():
+            cur.execute(self.DROP_FOREIGN_KEY % (table, name))
+
+    def fingerprints_schema_version(self):
+        """
+        Returns the schema version of the existing fingerprints table: 2 when
+        its rows are clustered by the (hash, song_id, offset) primary key,
+        1 for the original hash index, unique key and foreign key.
+        """
+        with self.cursor() as cur:
+            return self._fingerprints_schema_version(cur)
+
+    def migrate_schema(self, batch_songs=100, keep_old=True):
+        """
+        Copies the fingerprints into a schema version 2 table while the
+        current one keeps answering queries, then swaps both tables with an
+        atomic rename and returns the `compare_fingerprint_tables` report.
+
+        Rows are copied `batch_songs` songs at a time so no statement holds
+        its locks for long, until the copy catches up with the songs table.
+
+        .. warning:
+            Stop fingerprinting before the copy catches up, fingerprints
+            inserted in the old table after their song was copied are lost.
+        """
+        new_table = "%s_v2" % self.FINGERPRINTS_TABLENAME
+        old_table = "%s_v1" % self.FINGERPRINTS_TABLENAME
+        logger = logging.getLogger('dejavu')
+
+        with self.cursor() as cur:
+            if self._fingerprints_schema_version(cur) == 2:
+                logger.info("Fingerprints table already uses schema version 2")
+                return None
+            cur.execute(self.CREATE_FINGERPRINTS_TABLE_V2 % new_table)
+
+        t = time.time()
+        copied = 0
+        while True:
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_MAX_SONG_ID)
+                max_sid, = cur.fetchone()
+            if copied >= max_sid:
+                break
+            while copied < max_sid:
+                upper = min(copied + batch_songs, max_sid)
+                with self.cursor() as cur:
+                    cur.execute(self.COPY_FINGERPRINTS % (new_table, self.FINGERPRINTS_TABLENAME), (copied, upper))
+                copied = upper
+                logger.debug("Copied the fingerprints of songs up to %d of %d" % (copied, max_sid))
+        logger.info("Copied fingerprints to %s in %.2f seconds" % (new_table, time.time() - t))
+
+        report = self.compare_fingerprint_tables(self.FINGERPRINTS_TABLENAME, new_table)
+
+        with self.cursor() as cur:
+            cur.execute(self.SWAP_FINGERPRINTS_TABLES % (old_table, new_table))
+            if not keep_old:
+                cur.execute(self.DROP_TABLE % old_table)
+            else:
+                # the kept table must not cascade song deletions or stop the
+                # songs table from being dropped
+                self._drop_foreign_keys(cur, old_table)
+        self.schema_version = 2
+        return report
+
+    def compare_fingerprint_tables(self, table, other_table, sample=1000, repeat=3):
+        """
+        Returns the size of two fingerprints tables and the best of `repeat`
+        timings of both answering the same `sample` hashes, drawn from
+        `table`.
+        """
+        sizes = {}
+        with self.cursor() as cur:
+            for name in (table, other_table):
+                # table statistics are estimates, refresh them first
+                cur.execute(self.ANALYZE_TABLE % name)
+                cur.fetchall()
+            cur.execute(self.SELECT_TABLE_SIZES, (table, other_table))
+            for name, rows, data_length, index_length in cur.fetchall():
+                sizes[name] = {
+                    "rows": rows,
+                    "data_bytes": data_length,
+                    "index_bytes": index_length,
+                    "total_bytes": data_length + index_length,
+                }
+            cur.execute(self.SELECT_SAMPLE_HASHES % table, (sample,))
+            hashes = [hash for hash, in cur.fetchall()]
+
+        report = {}
+        for name in (table, other_table):
+            timings = []
+            for _ in range(repeat):
+                t = time.time()
+                fetched = 0
+                with self.cursor() as cur:
+                    for split_values in grouper(hashes, self.query_chunk_size):
+                        query = self.SELECT_MULTIPLE_FROM % name % ', '.join(['UNHEX(%s)'] * len(split_values))
+                        cur.execute(query, split_values)
+                        fetched += len(cur.fetchall())
+                timings.append(time.time() - t)
+            report[name] = dict(sizes.get(name, {}), hashes=len(hashes), rows_fetched=fetched,
+                                lookup_seconds=min(timings))
+            logging.getLogger('dejavu').info("%s: %s" % (name, report[name]))
+        return report
 
     def get_num_songs(self):
         """
@@ -243,6 +626,40 @@ class SQLDatabase(Database):
             for row in cur:
                 yield row
 
+    def get_stoplist(self):
+        """
+        Returns the stop-listed hashes with their number of fingerprints.
+        """
+        try:
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_STOPLIST)
+                return dict(cur.fetchall())
+        except mysql.ProgrammingError:
+            # Read only nodes may run against tables created before stop-lists
+            return {}
+
+    def rebuild_stoplist(self, max_postings, prune=False):
+        """
+        Recomputes the stop-list with the hashes having more than
+        `max_postings` fingerprints and returns its size.
+
+        Hashes pruned earlier stay in the stop-list while they are still
+        over the threshold, even though they are no longer in fingerprints.
+        """
+        t = time.time()
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_STOPLIST_TABLE)
+            cur.execute(self.DELETE_STOPLIST, (max_postings,))
+            cur.execute(self.INSERT_STOPLIST, (max_postings,))
+            if prune:
+                cur.execute(self.DELETE_STOPLISTED_FINGERPRINTS)
+        if prune:
+            self.backfill_num_fingerprints()
+        stoplist = self.get_stoplist()
+        logging.getLogger('dejavu').info("Stop-listed %d hashes with more than %d fingerprints in %.2f seconds" %
+                                         (len(stoplist), max_postings, time.time() - t))
+        return len(stoplist)
+
     def get_song_by_id(self, sid):
         """
         Returns song by its ID.
@@ -251,12 +668,24 @@ class SQLDatabase(Database):
             cur.execute(self.SELECT_SONG, (sid,))
             return cur.fetchone()
 
+    def get_songs_by_ids(self, sids):
+        """
+        Returns the songs of the given IDs in a single query, by ID.
+        """
+        sids = list(sids)
+        if not sids:
+            return {}
+        with self.cursor(cursor_type=DictCursor) as cur:
+            cur.execute(self.SELECT_SONGS_BY_IDS % ', '.join(['%s'] * len(sids)), sids)
+            return dict((row[Database.FIELD_SONG_ID], row) for row in cur)
+
     def insert(self, hash, sid, offset):
         """
         Insert a (sha1, song_id, offset) row into database.
         """
         with self.cursor() as cur:
             cur.execute(self.INSERT_FINGERPRINT, (hash, sid, offset))
+            cur.execute(self.UPDATE_SONG_NUM_FINGERPRINTS, (cur.rowcount, sid))
 
     def insert_song(self, songname, file_hash, audio_length):
         """
@@ -287,6 +716,24 @@ class SQLDatabase(Database):
         """
         return self.query(None)
 
+    def get_hashes(self):
+        """
+        Returns every distinct hash in the database, streamed from MySQL.
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_HASHES)
+            for hash, in cur:
+                yield hash
+
+    def get_fingerprints(self):
+        """
+        Streams every (hash, sid, offset) tuple in the database.
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_FINGERPRINTS)
+            for row in cur:
+                yield row
+
     def insert_hashes(self, sid, hashes):
         """
         Insert series of hash => song_id, offset
@@ -297,6 +744,7 @@ class SQLDatabase(Database):
             values.append((hash, sid, offset))
 
         base_query = "INSERT IGNORE INTO fingerprints (%s, %s, %s) values " % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+        inserted = 0
         with self.cursor() as cur:
             values.sort(key=lambda tup: tup[0])
             cur.execute("START TRANSACTION;")
@@ -305,42 +753,206 @@ class SQLDatabase(Database):
                 values2tuple = tuple(chain.from_iterable(split_values))
                 query = base_query + ', '.join(['(UNHEX(%s), %s, %s)'] * len(split_values))
                 query += ";"
-                cur.execute(query, values2tuple)
+                inserted += cur.execute(query, values2tuple)
+            # Duplicates are ignored, only count the rows actually inserted
+            cur.execute(self.UPDATE_SONG_NUM_FINGERPRINTS, (inserted, sid))
             cur.execute("COMMIT;")
 
-    def return_matches(self, mapper):
+    def insert_hashes_bulk(self, songs_hashes, method="load_data", batch_size=100000):
         """
-        Return the (song_id, offset_diff) tuples associated with
-        a list of (sha1, sample_offset) values.
+        Insert the fingerprints of many songs at once, for initial catalog
+        builds of songs that have no fingerprints yet.
+
+        Fingerprints are deduplicated here, so this can run inside
+        `deferred_indexes` where MySQL no longer checks the unique key.
+
+        method: "load_data" streams the rows as TSV files through
+                `LOAD DATA LOCAL INFILE`, which needs `local_infile` enabled
+                in the database options and on the server. "executemany"
+                sends them as large multi-row inserts.
+        batch_size: Rows sent per statement.
+        """
+        if method == "load_data":
+            load = self._load_data_batch
+        elif method == "executemany":
+            load = self._executemany_batch
+        else:
+            raise ValueError("Unsupported bulk insert method: %s" % method)
+
+        def rows():
+            for sid, hashes in songs_hashes:
+                for hash, offset in set(hashes):
+                    yield (hash, sid, offset)
+
+        t = time.time()
+        total = 0
+        num_fingerprints = {}
+        # songs with rows that were already stored, and so skipped
+        recount = set()
+        with self.cursor() as cur:
+            for batch in grouper(rows(), batch_size):
+                # rows in primary key order append to the clustered index
+                batch.sort()
+                inserted = load(cur, batch)
+                total += len(batch)
+                if inserted == len(batch):
+                    for _, sid, _ in batch:
+                        num_fingerprints[sid] = num_fingerprints.get(sid, 0) + 1
+                else:
+                    # only the database knows which songs the skipped rows were of
+                    recount |= set(sid for _, sid, _ in batch)
+            cur.executemany(self.UPDATE_SONG_NUM_FINGERPRINTS,
+                            [(n, sid) for sid, n in num_fingerprints.items() if sid not in recount])
+            if recount:
+                placeholders = ', '.join(['%s'] * len(recount))
+                cur.execute(self.BACKFILL_SONGS_NUM_FINGERPRINTS % (placeholders, placeholders),
+                            list(recount) * 2)
+        t = time.time() - t
+
+        stats = {"rows": total, "seconds": t, "rows_per_second": total / t if t else 0.}
+        logging.getLogger('dejavu').info("Bulk inserted %(rows)d fingerprints in %(seconds).2f seconds "
+                                         "(%(rows_per_second).0f rows/s)" % stats)
+        return stats
+
+    def _load_data_batch(self, cur, batch):
+        # Hashes go as hex text, so the file is safe to split on tabs and newlines
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv") as f:
+            for hash, sid, offset in batch:
+                f.write("%s\t%d\t%d\n" % (hash, sid, offset))
+            f.flush()
+            cur.execute(self.LOAD_FINGERPRINTS, (f.name,))
+        return cur.rowcount
+
+    def _executemany_batch(self, cur, batch):
+        cur.executemany(self.INSERT_FINGERPRINTS_MANY,
+                        [(unhexlify(hash), sid, offset) for hash, sid, offset in batch])
+        return cur.rowcount
+
+    @contextmanager
+    def deferred_indexes(self):
+        """
+        Drops the indexes, unique key and foreign key of the fingerprints
+        table while the block runs and rebuilds them, in a single pass, when
+        leaving it.
+
+        Schema version 2 tables keep everything in their primary key,
+        which can't be dropped, so they are left as they are.
+
+        .. warning:
+            Duplicates inserted in between make the rebuild fail.
         """
-        def execute_select_query(split_values):
-            query = self.SELECT_MULTIPLE
-            query = query % ', '.join(['UNHEX(%s)'] * len(split_values))
+        if self.fingerprints_schema_version() == 2:
+            yield
+            return
+
+        with self.cursor() as cur:
+            self._drop_foreign_keys(cur, self.FINGERPRINTS_TABLENAME)
+            cur.execute(self.DROP_FINGERPRINTS_INDEXES)
+        try:
+            yield
+        finally:
+            t = time.time()
             with self.cursor() as cur:
-                cur.execute(query, split_values)
-                return [(sid, offset - mapper[hash]) for hash, sid, offset in cur]
-
-        # Get an iteratable of all the hashes we need
-        values = list(mapper.keys())
-
-        que = queue.Queue()
-        threads = []
-        for split_values in grouper(values, 10000):
-            t = Thread(target=lambda q, arg1: q.put(execute_select_query(arg1)), args=(que, split_values))
-            t.start()
-            threads.append(t)
-        for t in threads:
-            t.join()
-        while not que.empty():
-            for result in que.get():
-                yield result
+                cur.execute(self.ADD_FINGERPRINTS_INDEXES)
+            logging.getLogger('dejavu').info("Rebuilt fingerprint indexes in %.2f seconds" % (time.time() - t))
+
+    def return_matches(self, mapper, as_arrays=False):
+        """
+        Return the (song_id, offset_diff) tuples associated with
+        the `QueryHashes` of a query.
+
+        Results are yielded as soon as each chunk of hashes is answered,
+        unless `as_arrays` is set.
+        """
+        postings = self.return_postings(mapper.keys())
+        if as_arrays:
+            return self.match_arrays(postings, mapper)
+        return mapper.matches(postings)
+
+    def return_postings(self, hashes):
+        """
+        Return the (sha1, song_id, offset) tuples of the given hashes.
+        """
+        return self._select_chunks(list(hashes))
+
+    def return_match_histogram(self, hashes, top_k=10):
+        """
+        Return the `top_k` most common (song_id, offset_diff, count) tuples
+        for a list of (sha1, sample_offset) values.
+
+        The query hashes are loaded into a temporary table and joined against
+        the fingerprints, so only the counted pairs travel back from MySQL.
+        Pairs with the same count may come back in any order.
+        """
+        values = [(unhexlify(hash), offset) for hash, offset in hashes]
+
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_QUERY_HASHES_TABLE)
+            try:
+                for split_values in grouper(values, 1000):
+                    cur.executemany(self.INSERT_QUERY_HASH, split_values)
+                cur.execute(self.SELECT_MATCH_HISTOGRAM, (top_k,))
+                return [(sid, int(diff), count) for sid, diff, count in cur]
+            finally:
+                # The connection goes back to the pool, don't leave it behind
+                cur.execute(self.DROP_QUERY_HASHES)
+
+    def _select_chunk(self, split_values):
+        """
+        Returns the (hash, song_id, offset) rows of a chunk of hashes.
+        """
+        t = time.time()
+        query = self.SELECT_MULTIPLE % ', '.join(['UNHEX(%s)'] * len(split_values))
+        with self.cursor() as cur:
+            cur.execute(query, split_values)
+            rows = cur.fetchall()
+        t = time.time() - t
+
+        self.chunk_timings.append((len(split_values), len(rows), t))
+        logging.getLogger('dejavu').debug("Fetched %d rows for %d hashes in %.4f seconds" %
+                                          (len(rows), len(split_values), t))
+        return rows
+
+    def _select_chunks(self, values):
+        """
+        Runs `_select_chunk` over `values` split in `query_chunk_size` hashes,
+        with at most `query_workers` chunks in flight, and yields the rows of
+        each chunk as it completes.
+        """
+        executor = self._get_executor()
+        pending = set()
+        try:
+            for split_values in grouper(values, self.query_chunk_size):
+                pending.add(executor.submit(self._select_chunk, split_values))
+                if len(pending) < self.query_workers:
+                    continue
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    for row in future.result():
+                        yield row
+            for future in futures.as_completed(pending):
+                pending.discard(future)
+                for row in future.result():
+                    yield row
+        finally:
+            # The caller stopped early or a chunk failed
+            for future in pending:
+                future.cancel()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            # Threads don't survive a fork, start new ones in the child.
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = futures.ThreadPoolExecutor(max_workers=self.query_workers)
+                self._executor_pid = os.getpid()
+            return self._executor
 
     def __getstate__(self):
         return (self._options,)
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        options, = state
+        self.__init__(**options)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -350,61 +962,275 @@ def grouper(iterable, n, fillvalue=None):
 
 
 def cursor_factory(**factory_options):
+    pool = ConnectionPool.get(**factory_options)
+
     def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(pool=pool, **options)
+    cursor.pool = pool
     return cursor
 
 
+class ConnectionPool(object):
+    """
+    Process-wide, thread-safe pool of MySQL connections.
+
+    There is one pool per set of connection options, shared by every
+    `SQLDatabase` (and every thread) of the process using those options.
+    Besides the pymysql connection arguments, the following options are
+    understood:
+
+    pool_min_size: Connections opened up front and kept open (default 0).
+    pool_max_size: Maximum connections open at once; callers block when
+                   all of them are in use (default: number of CPUs).
+    pool_timeout: Seconds to wait for a free connection before raising
+                  `PoolTimeout` (default None, wait forever).
+    pool_ping_interval: Idle seconds after which a connection is pinged
+                        before being handed out again (default 30).
+
+    Connections inherited through `fork` are never reused nor closed by
+    the child, they belong to the parent process.
+    """
+
+    POOL_OPTIONS = ("pool_min_size", "pool_max_size", "pool_timeout", "pool_ping_interval")
+
+    _pools = {}
+    _pools_lock = Lock()
+
+    def __init__(self, pool_min_size=0, pool_max_size=None, pool_timeout=None,
+                 pool_ping_interval=30, **options):
+        super(ConnectionPool, self).__init__()
+        self.min_size = pool_min_size
+        self.max_size = max(pool_max_size or cpu_count(), pool_min_size, 1)
+        self.timeout = pool_timeout
+        self.ping_interval = pool_ping_interval
+        self.options = options
+        self._cond = Condition(Lock())
+        self._reset()
+
+    @classmethod
+    def get(cls, **options):
+        """
+        Returns the pool of this process for the given connection options.
+        """
+        key = tuple(sorted((k, repr(v)) for k, v in options.items()))
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls._pools[key] = cls(**options)
+        pool.fill()
+        return pool
+
+    @classmethod
+    def reset_all(cls):
+        """
+        Forgets every connection of every pool, without closing them.
+        """
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+        for pool in pools:
+            with pool._cond:
+                pool._reset()
+
+    def _reset(self):
+        # (connection, last time it was used) of the connections not in use.
+        self._idle = deque()
+        self._size = 0
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.
+
+    def _check_pid(self):
+        # Called holding the lock. After a fork the connections belong to the
+        # parent, drop them without sending anything through their sockets.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def fill(self):
+        """
+        Opens connections until `pool_min_size` of them are available.
+        """
+        conns = []
+        while True:
+            with self._cond:
+                self._check_pid()
+                if self._size >= self.min_size:
+                    break
+                self._size += 1
+            try:
+                conns.append(self._connect())
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        for conn in conns:
+            self.release(conn)
+
+    def _connect(self):
+        conn = mysql.connect(**self.options)
+        conn.autocommit(False)
+        return conn
+
+    def acquire(self):
+        """
+        Takes a connection from the pool, opening a new one if none is idle
+        and the pool isn't full.
+        """
+        start = time.time()
+        conn = None
+        with self._cond:
+            self._check_pid()
+            while not self._idle and self._size >= self.max_size:
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise PoolTimeout("No connection available after %s seconds" % self.timeout)
+                self.waits += 1
+                self._cond.wait(remaining)
+                self._check_pid()
+            if self._idle:
+                conn, last_used = self._idle.pop()
+                self.hits += 1
+            else:
+                self._size += 1
+                self.misses += 1
+            self.wait_time += time.time() - start
+
+        if conn is None:
+            try:
+                return self._connect()
+            except Exception:
+                self._discard()
+                raise
+
+        # Health check connections that have been idle for a while.
+        if time.time() - last_used > self.ping_interval:
+            try:
+                conn.ping(True)
+            except mysql.MySQLError:
+                self._close(conn)
+                try:
+                    return self._connect()
+                except Exception:
+                    self._discard()
+                    raise
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Gives a connection back to the pool. Broken connections should be
+        given back with `discard` so they are closed instead of reused.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                # Checked out before a fork, it isn't ours to keep nor to close.
+                return
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+        if discard:
+            self._close(conn)
+
+    def _discard(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def close_idle(self):
+        """
+        Closes all the connections not currently in use.
+        """
+        with self._cond:
+            self._check_pid()
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except mysql.Error:
+            pass
+
+    def stats(self):
+        """
+        Returns the pool counters.
+
+              size: Open connections, idle or in use
+              idle: Open connections not in use
+              hits: Connections served from the idle ones
+            misses: Connections that had to be opened
+             waits: Times a caller blocked because the pool was full
+         wait_time: Total seconds spent acquiring connections
+        """
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+            }
+
+
+class PoolTimeout(mysql.OperationalError):
+    pass
+
+
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Takes a connection from the pool and returns an open cursor.
 
 
     ```python
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool=pool) as cur:
         cur.execute(query)
     ```
     """
 
-    def __init__(self, cursor_type=mysql.cursors.Cursor, **options):
+    def __init__(self, cursor_type=mysql.cursors.Cursor, pool=None, **options):
         super(Cursor, self).__init__()
 
-        self._cache = queue.Queue(maxsize=cpu_count())
-        try:
-            conn = self._cache.get_nowait()
-        except queue.Empty:
-            conn = mysql.connect(**options)
-        else:
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-
-        self.conn = conn
-        self.conn.autocommit(False)
+        self.pool = pool or ConnectionPool.get(**options)
+        self.conn = self.pool.acquire()
         self.cursor_type = cursor_type
 
     @classmethod
     def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=cpu_count())
+        ConnectionPool.reset_all()
 
     def __enter__(self):
         self.cursor = self.conn.cursor(self.cursor_type)
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
-            self.cursor.rollback()
+        discard = False
+        # if we had a MySQL related error we try to rollback the transaction.
+        if extype is not None and issubclass(extype, mysql.MySQLError):
+            try:
+                self.conn.rollback()
+            except mysql.MySQLError:
+                discard = True
+            # The connection itself may be unusable, don't give it to anyone else.
+            discard = discard or issubclass(extype, (mysql.OperationalError, mysql.InterfaceError))
 
-        self.cursor.close()
         try:
-            self.conn.commit()
-        except mysql.InterfaceError:
+            self.cursor.close()
+            if not discard:
+                self.conn.commit()
+        except mysql.MySQLError:
             logging.getLogger('dejavu').debug("Couldn't commit transaction")
+            discard = True
 
-        # Put it back on the queue
-        try:
-            self._cache.put_nowait(self.conn)
-        except queue.Full:
-            self.conn.close()
+        # Put it back on the pool
+        self.pool.release(self.conn, discard=discard)
@@ -1,11 +1,13 @@
 import os
 import fnmatch
+import wave
 import numpy as np
+from scipy.signal import firwin, resample_poly
 from pydub import AudioSegment
-from pydub.utils import audioop
-from pydub.effects import normalize
+from pydub.utils import audioop, mediainfo
 import dejavu.wavio as wavio
 from hashlib import sha1
+from math import gcd
 from sys import version
 from ads_dejavu.fingerprint import DEFAULT_FS
 
@@ -63,7 +65,7 @@ def read(filename, limit=None):
         if limit:
             audiofile = audiofile[:limit * 1000]
 
-        data = np.fromstring(audiofile._data, np.int16)
+        data = np.frombuffer(audiofile._data, np.int16)
 
         channels = []
         for chn in xrange(audiofile.channels):
@@ -85,6 +87,156 @@ def read(filename, limit=None):
     return channels, fs, unique_hash(filename), float(len(audiofile))/1000.0
 
 
+def preprocess(channels, Fs, mono=None, resample=None, normalize=None, rate=DEFAULT_FS):
+    """
+    Prepares decoded audio for fingerprinting, the same way for every entry
+    point: mixes it to mono, resamples it to `rate` and scales its peak
+    to full scale, as set by CONVERT_TO_MONO, RESAMPLE and NORMALIZE unless
+    given here.
+
+    Stages that wouldn't change anything are skipped, and audio that needs
+    none of them is returned as is. They run in the cheapest order: mixing
+    first leaves a single channel to resample, and normalizing last sees
+    the peak of the resampled audio.
+
+    returns: (channels, samplerate), channels as an int16 array with one
+             row per channel
+    """
+    mono = CONVERT_TO_MONO if mono is None else mono
+    resample = RESAMPLE if resample is None else resample
+    normalize = NORMALIZE if normalize is None else normalize
+
+    channels = np.asarray(channels)
+    if channels.ndim == 1:
+        channels = channels[np.newaxis]
+    if channels.shape[-1] == 0:
+        return channels.astype(np.int16, copy=False), Fs
+
+    if mono and len(channels) > 1:
+        channels = np.mean(channels, axis=0, keepdims=True)
+    if resample and Fs != rate:
+        # polyphase filtering gives the same fingerprints as resampy's
+        # sinc interpolation at a fraction of its cost
+        factor = gcd(int(Fs), int(rate))
+        channels = resample_poly(channels.astype(np.float64, copy=False), int(rate) // factor, int(Fs) // factor,
+                                 axis=-1)
+        Fs = rate
+    if normalize:
+        # the int16 peak can't be taken with np.abs, which overflows on -32768
+        peak = max(-float(channels.min()), float(channels.max()))
+        gain = np.iinfo(np.int16).max / peak if peak > 0 else 1.
+        if gain != 1.:
+            channels = channels * gain
+    if channels.dtype != np.int16:
+        # the filter overshoots on loud audio, which would wrap around
+        channels = np.clip(channels, -32768, 32767)
+    return channels.astype(np.int16, copy=False), Fs
+
+
+class StreamResampler(object):
+    """
+    Resamples mono int16 audio fed a chunk at a time to DEFAULT_FS, with the
+    polyphase filter `preprocess` uses. The input samples the filter still
+    needs are carried over to the next chunk, so the output is that of
+    resampling the whole audio at once, whatever the size of the chunks.
+    """
+
+    def __init__(self, Fs):
+        super(StreamResampler, self).__init__()
+        self.Fs = Fs
+        factor = gcd(int(Fs), DEFAULT_FS)
+        self.up = DEFAULT_FS // factor
+        self.down = int(Fs) // factor
+        # the filter of scipy.signal.resample_poly
+        max_rate = max(self.up, self.down)
+        self.half_len = 10 * max_rate
+        h = firwin(2 * self.half_len + 1, 1. / max_rate, window=('kaiser', 5.0)) * self.up
+        self.taps = -(-len(h) // self.up)
+        h = np.concatenate([h, np.zeros(self.taps * self.up - len(h))])
+        # phases[p, j] is the coefficient of input sample m0 - j for the
+        # outputs whose upsampled position is m0 * up + p
+        self.phases = h.reshape(self.taps, self.up).T
+        self.reset()
+
+    def reset(self):
+        # input samples from index `_start` on, the zeros before the audio
+        # included
+        self._buffer = np.zeros(self.taps - 1)
+        self._start = -(self.taps - 1)
+        self._received = 0
+        self._next = 0
+
+    def push(self, samples):
+        """
+        Adds samples and returns the resampled ones they complete.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        self._buffer = np.concatenate([self._buffer, samples])
+        self._received += len(samples)
+        # outputs whose last input sample has been received
+        end = max(self._next, (self._received * self.up - 1 - self.half_len) // self.down + 1)
+        return self._resample(end)
+
+    def flush(self):
+        """
+        Returns the last resampled samples, as if the audio was followed by
+        silence, and starts over.
+        """
+        self._buffer = np.concatenate([self._buffer, np.zeros(self.taps)])
+        end = -(-self._received * self.up // self.down)
+        samples = self._resample(end)
+        self.reset()
+        return samples
+
+    def _resample(self, end):
+        outputs = np.arange(self._next, end)
+        positions = outputs * self.down + self.half_len
+        rows = positions[:, np.newaxis] // self.up - np.arange(self.taps) - self._start
+        resampled = np.sum(self.phases[positions % self.up] * self._buffer[rows], axis=1)
+        self._next = max(self._next, end)
+
+        # drops the samples no output left needs
+        drop = (self._next * self.down + self.half_len) // self.up - (self.taps - 1) - self._start
+        drop = min(max(drop, 0), len(self._buffer))
+        self._buffer = self._buffer[drop:]
+        self._start += drop
+        return np.clip(resampled, -32768, 32767).astype(np.int16)
+
+
+def duration(filename):
+    """
+    Returns the seconds of audio in a file, from its header when possible.
+    """
+    if filename.lower().endswith(".wav"):
+        try:
+            wav = wave.open(filename, "rb")
+        except (wave.Error, EOFError):
+            pass
+        else:
+            with wav:
+                return wav.getnframes() / float(wav.getframerate())
+    try:
+        return float(mediainfo(filename)["duration"])
+    except (KeyError, ValueError, OSError):
+        return len(AudioSegment.from_file(filename)) / 1000.0
+
+
+def read_segment(filename, start, seconds):
+    """
+    Reads `seconds` of audio from `start` seconds into a file. ffmpeg only
+    decodes that part of compressed files.
+
+    returns: (channels, samplerate)
+    """
+    audiofile = AudioSegment.from_file(filename, start_second=start, duration=seconds)
+    data = np.frombuffer(audiofile.raw_data, np.int16)
+
+    channels = []
+    for chn in xrange(audiofile.channels):
+        channels.append(data[chn::audiofile.channels])
+    return channels, audiofile.frame_rate
+
+
 def path_to_songname(path):
     """
     Extracts song name from a filepath. Used to identify which songs
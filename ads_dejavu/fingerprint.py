@@ -6,6 +6,7 @@ from scipy.ndimage.filters import maximum_filter
 from scipy.ndimage.morphology import (generate_binary_structure,
                                       iterate_structure, binary_erosion)
 import hashlib
+from ads_dejavu.buffer import RingBuffer
 from operator import itemgetter
 import logging
 
@@ -130,7 +131,11 @@ def fingerprint(channel_samples, Fs=DEFAULT_FS,
     return generate_hashes(local_maxima, fan_value=fan_value)
 
 
-def get_2D_peaks(arr2D, amp_min=DEFAULT_AMP_MIN):
+def get_peak_mask(arr2D):
+    """
+    Boolean mask of arr2D with True at its local maxima. Whether a point is
+    one depends on the PEAK_NEIGHBORHOOD_SIZE columns at each side only.
+    """
     # http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.morphology.iterate_structure.html#scipy.ndimage.morphology.iterate_structure
     struct = generate_binary_structure(2, CONNECTIVITY_MASK)
     neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
@@ -141,8 +146,12 @@ def get_2D_peaks(arr2D, amp_min=DEFAULT_AMP_MIN):
     eroded_background = binary_erosion(background, structure=neighborhood,
                                        border_value=1)
 
+    return local_max ^ eroded_background
+
+
+def get_2D_peaks(arr2D, amp_min=DEFAULT_AMP_MIN):
     # Boolean mask of arr2D with True at peaks
-    detected_peaks = local_max ^ eroded_background
+    detected_peaks = get_peak_mask(arr2D)
 
     # extract peaks
     amps = arr2D[detected_peaks]
@@ -182,3 +191,129 @@ def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
                     h = hashlib.sha1((
                         "%s|%s|%s" % (str(freq1), str(freq2), str(t_delta))).encode())
                     yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], t1)
+
+
+def _hash(freq1, freq2, t_delta):
+    return hashlib.sha1(("%s|%s|%s" % (str(freq1), str(freq2), str(t_delta))).encode()).hexdigest()[0:FINGERPRINT_REDUCTION]
+
+
+class StreamFingerprinter(object):
+    """
+    Fingerprints audio fed a chunk at a time, computing only the spectrogram
+    columns the new samples complete and the peaks they settle. A hash is
+    returned as soon as both of its peaks are known.
+
+    The hashes match the ones `fingerprint` computes over the whole audio,
+    except that the 80 dB floor of the spectrogram follows the loudest
+    column so far instead of the loudest overall.
+    """
+
+    def __init__(self, Fs=DEFAULT_FS, wsize=DEFAULT_WINDOW_SIZE, wratio=DEFAULT_OVERLAP_RATIO,
+                 fan_value=DEFAULT_FAN_VALUE, amp_min=DEFAULT_AMP_MIN):
+        super(StreamFingerprinter, self).__init__()
+        self.Fs = Fs
+        self.wsize = wsize
+        self.hop_length = int(wsize * wratio)
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.reset()
+
+    def reset(self):
+        # samples of the frames still to compute, as `fingerprint` pads them
+        self._samples = RingBuffer(4 * self.wsize)
+        self._samples.append(np.zeros(self.wsize // 2, np.float32))
+        # spectrogram columns still needed to settle peaks, from `_column0`
+        self._columns = np.zeros((N_MELS, 0), np.float32)
+        self._column0 = 0
+        self._next_frame = 0
+        # first column whose peaks aren't settled yet
+        self._settled = 0
+        self._max_db = -np.inf
+        # the last fan_value - 1 peaks, the ones new peaks pair with
+        self._peaks = []
+        self.samples = 0
+
+    def _spectrogram(self):
+        samples = self._samples.view()
+        frames = 1 + (len(samples) - self.wsize) // self.hop_length if len(samples) >= self.wsize else 0
+        if frames <= 0:
+            return np.zeros((N_MELS, 0), np.float32)
+        arr2D = melspectrogram(
+            y=samples[:(frames - 1) * self.hop_length + self.wsize],
+            sr=self.Fs,
+            n_fft=self.wsize,
+            hop_length=self.hop_length,
+            center=False,
+            fmin=MIN_FREQ,
+            n_mels=N_MELS,
+            htk=HTK,
+            norm=1 if AREA_NORMALIZATION else None
+        )
+        self._samples.consume(frames * self.hop_length)
+        self._next_frame += frames
+
+        # power_to_db, with the floor below the loudest column so far
+        arr2D = 10.0 * np.log10(np.maximum(1e-10, arr2D))
+        self._max_db = max(self._max_db, arr2D.max())
+        arr2D = np.maximum(arr2D, self._max_db - 80.0)
+        arr2D[arr2D == -np.inf] = 0
+        return arr2D
+
+    def _settle(self, final):
+        """
+        Returns the (time, freq) peaks of the columns no longer depending on
+        columns to come, in the order `generate_hashes` sorts them.
+        """
+        last = self._column0 + self._columns.shape[1]
+        settled = last if final else last - PEAK_NEIGHBORHOOD_SIZE
+        if settled <= self._settled:
+            return []
+        mask = get_peak_mask(self._columns)
+        amps = self._columns
+        lo, hi = self._settled - self._column0, settled - self._column0
+        freqs, times = np.where(mask[:, lo:hi] & (amps[:, lo:hi] > self.amp_min))
+        order = np.lexsort((freqs, times))
+        peaks = list(zip((times[order] + self._settled).tolist(), freqs[order].tolist()))
+
+        self._settled = settled
+        # columns needed by the peaks of the columns to come
+        drop = max(0, self._settled - PEAK_NEIGHBORHOOD_SIZE - self._column0)
+        self._columns = self._columns[:, drop:]
+        self._column0 += drop
+        return peaks
+
+    def _pair(self, peaks):
+        hashes = []
+        for t2, freq2 in peaks:
+            for t1, freq1 in self._peaks:
+                t_delta = t2 - t1
+                if MIN_HASH_TIME_DELTA <= t_delta <= MAX_HASH_TIME_DELTA:
+                    hashes.append((_hash(freq1, freq2, t_delta), t1))
+            self._peaks.append((t2, freq2))
+            if len(self._peaks) >= self.fan_value:
+                self._peaks.pop(0)
+        return hashes
+
+    def push(self, samples):
+        """
+        Adds int16 samples and returns the (hash, offset) tuples completed
+        by them.
+        """
+        samples = np.asarray(samples)
+        self.samples += len(samples)
+        self._samples.append(buf_to_float(np.ascontiguousarray(samples, dtype=np.int16)))
+        return self._process(final=False)
+
+    def flush(self):
+        """
+        Returns the hashes left at the end of the audio.
+        """
+        # padded at the end as well, the last frames are the ones `fingerprint` computes
+        self._samples.append(np.zeros(self.wsize // 2, np.float32))
+        return self._process(final=True)
+
+    def _process(self, final):
+        columns = self._spectrogram()
+        if columns.shape[1]:
+            self._columns = np.concatenate([self._columns, columns], axis=1)
+        return self._pair(self._settle(final))
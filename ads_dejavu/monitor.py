@@ -0,0 +1,297 @@
+from __future__ import absolute_import
+import logging
+import time
+
+import numpy as np
+
+from ads_dejavu import Dejavu
+import ads_dejavu.decoder as decoder
+import ads_dejavu.fingerprint as fingerprint
+
+
+class Monitor(object):
+    """
+    Finds every song played in a long recording or a live stream, as a
+    timeline of detections.
+
+    Audio is fingerprinted a block at a time, each hash once, and the hashes
+    of a block are looked up together. Windows of `window` seconds every
+    `hop` seconds are then aligned over the matches of the hashes they
+    contain, and consecutive windows agreeing on the same song and offset
+    are merged into a single detection.
+
+    ```python
+    monitor = Monitor(djv, window=10, hop=2)
+    for detection in monitor.monitor_file("broadcast.mp3"):
+        print(detection)
+    print(monitor.stats())
+    ```
+    """
+
+    START = 'start'
+    END = 'end'
+    WINDOWS = 'windows'
+
+    # frames of context a hash needs before and after its anchor peak:
+    # the peak neighborhood, the spectrogram window and, after it, the
+    # farthest peak it can be paired with
+    LEAD_FRAMES = fingerprint.PEAK_NEIGHBORHOOD_SIZE + 4
+    TAIL_FRAMES = fingerprint.MAX_HASH_TIME_DELTA + fingerprint.PEAK_NEIGHBORHOOD_SIZE + 4
+
+    def __init__(self, dejavu, window=10., hop=2., min_confidence=5, max_gap=None, tolerance=2, block=300.):
+        """
+        window: Seconds of audio aligned at once.
+        hop: Seconds between the start of consecutive windows.
+        min_confidence: Aligned hashes a window needs to detect a song.
+        max_gap: Seconds without detections after which a detection is
+                 closed, defaults to `window`.
+        tolerance: Frames the offset difference may drift between windows
+                   of the same detection.
+        block: Seconds of audio fingerprinted and looked up at once.
+        """
+        super(Monitor, self).__init__()
+        self.dejavu = dejavu
+        self.Fs = fingerprint.DEFAULT_FS
+        self.hop_length = int(fingerprint.DEFAULT_WINDOW_SIZE * fingerprint.DEFAULT_OVERLAP_RATIO)
+        self.window_frames = max(1, self._frames(window))
+        self.hop_frames = max(1, self._frames(hop))
+        self.min_confidence = min_confidence
+        self.max_gap_frames = self._frames(window if max_gap is None else max_gap)
+        self.tolerance = tolerance
+        self.block_frames = max(1, self._frames(block))
+        self.reset()
+
+    def _frames(self, seconds):
+        return int(round(seconds * self.Fs / float(self.hop_length)))
+
+    def _seconds(self, frames):
+        return round(frames * self.hop_length / float(self.Fs), 5)
+
+    def reset(self):
+        # samples not fingerprinted yet, plus the context of the next block
+        self._buffer = np.zeros(0, np.int16)
+        self._buffer_frame = 0
+        # first frame whose hashes haven't been computed yet
+        self._next_frame = 0
+        # (query frame, sid, offset difference) of the matches not needed
+        # by any window yet to be aligned, sorted by query frame
+        self._rows = (np.zeros(0, np.int64),) * 3
+        self._window_start = 0
+        self._open = None
+        self.audio_seconds = 0.
+        self.cpu_seconds = 0.
+        self.lookup_seconds = 0.
+
+    def feed(self, samples):
+        """
+        Adds mono samples at `fingerprint.DEFAULT_FS` and returns the
+        detections closed by them.
+        """
+        t = time.process_time()
+        samples = np.asarray(samples, dtype=np.int16)
+        self.audio_seconds += len(samples) / float(self.Fs)
+        self._buffer = np.concatenate([self._buffer, samples])
+        detections = []
+        while self._fingerprint_block(final=False):
+            detections.extend(self._align_windows(final=False))
+        self.cpu_seconds += time.process_time() - t
+        return detections
+
+    def close(self):
+        """
+        Processes the audio left and returns the last detections.
+        """
+        t = time.process_time()
+        self._fingerprint_block(final=True)
+        detections = self._align_windows(final=True)
+        if self._open is not None:
+            detections.append(self._emit(self._open))
+            self._open = None
+        self.cpu_seconds += time.process_time() - t
+        return detections
+
+    def _fingerprint_block(self, final):
+        """
+        Fingerprints the next block of the buffer and looks its hashes up.
+        Returns False when there isn't enough audio for a block, unless
+        `final` is set, in which case the rest of the buffer is the block.
+        """
+        buffer_frames = len(self._buffer) // self.hop_length
+        if final:
+            if len(self._buffer) <= (self._next_frame - self._buffer_frame) * self.hop_length:
+                return False
+            # every frame left, the last incomplete one included
+            end_frame = self._buffer_frame + buffer_frames + 2
+        else:
+            end_frame = min(self._buffer_frame + buffer_frames - self.TAIL_FRAMES,
+                            self._next_frame + self.block_frames)
+            if end_frame - self._next_frame < self.block_frames:
+                return False
+
+        # only hashes anchored in this block, the buffer around it is context
+        pairs = [(hash, int(offset) + self._buffer_frame)
+                 for hash, offset in fingerprint.fingerprint(self._buffer, Fs=self.Fs)
+                 if self._next_frame <= int(offset) + self._buffer_frame < end_frame]
+        self._add_rows(*self._lookup(pairs))
+
+        self._next_frame = end_frame
+        drop = max(0, min(self._next_frame - self.LEAD_FRAMES - self._buffer_frame, buffer_frames))
+        self._buffer = self._buffer[drop * self.hop_length:]
+        self._buffer_frame += drop
+        return True
+
+    def _lookup(self, pairs):
+        """
+        Returns the query frame, sid and offset difference of the matches
+        of (hash, frame) pairs, as int64 arrays.
+        """
+        t = time.time()
+        rows = self.dejavu.lookup_hashes(pairs)
+        self.lookup_seconds += time.time() - t
+        return rows
+
+    def _add_rows(self, frames, sids, diffs):
+        order = np.argsort(frames, kind="stable")
+        self._rows = tuple(np.concatenate([old, new[order]]) for old, new in zip(self._rows, (frames, sids, diffs)))
+
+    def _align_windows(self, final):
+        detections = []
+        frames, sids, diffs = self._rows
+        while self._window_start < self._next_frame and \
+                (final or self._window_start + self.window_frames <= self._next_frame):
+            start = self._window_start
+            end = start + self.window_frames
+            lo, hi = np.searchsorted(frames, [start, end])
+            song_id, diff, count, _ = Dejavu._align_arrays(sids[lo:hi], diffs[lo:hi])
+            # first and last frames matching the winner, to place the detection
+            aligned = frames[lo:hi][(sids[lo:hi] == song_id) & (np.abs(diffs[lo:hi] - diff) <= self.tolerance)]
+            matched = (int(aligned.min()), int(aligned.max())) if len(aligned) else (start, start)
+            detections.extend(self._track(song_id, diff, count, start, min(end, self._next_frame), matched))
+            self._window_start += self.hop_frames
+
+        keep = np.searchsorted(frames, self._window_start)
+        self._rows = tuple(column[keep:] for column in self._rows)
+        return detections
+
+    def _track(self, song_id, diff, count, start, end, matched):
+        """
+        Extends the open detection with the best match of a window, or
+        closes it. Returns the detections closed.
+        """
+        first, last = matched
+        closed = []
+        current = self._open
+        if count < self.min_confidence:
+            if current is not None and start > current[self.END] + self.max_gap_frames:
+                closed.append(self._emit(current))
+                self._open = None
+            return closed
+
+        if current is not None and current[Dejavu.SONG_ID] == song_id and \
+                abs(current[Dejavu.OFFSET] - diff) <= self.tolerance and \
+                start <= current[self.END] + self.max_gap_frames:
+            current[self.END] = end
+            current["first"] = min(current["first"], first)
+            current["last"] = max(current["last"], last)
+            current[Dejavu.CONFIDENCE] = max(current[Dejavu.CONFIDENCE], count)
+            current[self.WINDOWS] += 1
+            return closed
+
+        if current is not None:
+            closed.append(self._emit(current))
+        self._open = {
+            Dejavu.SONG_ID: song_id,
+            Dejavu.OFFSET: diff,
+            Dejavu.CONFIDENCE: count,
+            self.START: start,
+            self.END: end,
+            self.WINDOWS: 1,
+            "first": first,
+            "last": last,
+        }
+        return closed
+
+    def _emit(self, detection):
+        """
+        Turns an open detection into seconds, from its first to its last
+        aligned hash, without going past the end of the song.
+        """
+        song = self.dejavu.db.get_song_by_id(detection[Dejavu.SONG_ID]) or {}
+        start = self._seconds(detection["first"])
+        end = self._seconds(detection["last"] + 1)
+        if song.get(Dejavu.AUDIO_LENGTH):
+            # the song starts where its offset difference puts its first frame
+            song_start = -detection[Dejavu.OFFSET] * self.hop_length / float(self.Fs)
+            end = min(end, song_start + song[Dejavu.AUDIO_LENGTH])
+        detection = {
+            Dejavu.SONG_ID: detection[Dejavu.SONG_ID],
+            Dejavu.SONG_NAME: song.get(Dejavu.SONG_NAME, None),
+            self.START: round(start, 3),
+            self.END: round(end, 3),
+            # position in the song at `start`
+            Dejavu.OFFSET_SECS: round(start + detection[Dejavu.OFFSET] * self.hop_length / float(self.Fs), 3),
+            Dejavu.CONFIDENCE: detection[Dejavu.CONFIDENCE],
+            self.WINDOWS: detection[self.WINDOWS],
+        }
+        logging.getLogger('dejavu').debug("Detected %s" % detection)
+        return detection
+
+    def monitor(self, chunks):
+        """
+        Yields the detections of an iterable of mono sample arrays at
+        `fingerprint.DEFAULT_FS`, as soon as each of them is closed.
+        """
+        self.reset()
+        for chunk in chunks:
+            for detection in self.feed(chunk):
+                yield detection
+        for detection in self.close():
+            yield detection
+
+    def monitor_file(self, filename):
+        """
+        Yields the detections of an audio file, mixed to mono.
+        """
+        channels, Fs, _, _ = decoder.read(filename)
+        samples = decoder.preprocess(channels, Fs, mono=True, resample=True, normalize=False)[0][0]
+        step = self.block_frames * self.hop_length
+        return self.monitor(samples[i:i + step] for i in range(0, len(samples), step))
+
+    def monitor_pcm(self, stream, Fs=fingerprint.DEFAULT_FS, channels=1, chunk_seconds=10.):
+        """
+        Yields the detections of raw 16-bit little-endian PCM read from a
+        binary file object, such as `sys.stdin.buffer` fed by
+        `ffmpeg -i URL -f s16le -ac 1 -ar 8000 -`.
+        """
+        return self.monitor(self._read_pcm(stream, Fs, channels, chunk_seconds))
+
+    def _read_pcm(self, stream, Fs, channels, chunk_seconds):
+        frame_bytes = 2 * channels
+        chunk_bytes = int(chunk_seconds * Fs) * frame_bytes
+        rest = b""
+        # one resampler for the whole stream, so the chunks join seamlessly
+        resampler = decoder.StreamResampler(Fs) if Fs != self.Fs else None
+        while True:
+            data = stream.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            usable = len(data) - len(data) % frame_bytes
+            rest = data[usable:]
+            samples = np.frombuffer(data[:usable], dtype="<i2").reshape(-1, channels).T
+            samples = decoder.preprocess(samples, Fs, mono=True, resample=False, normalize=False)[0][0]
+            yield resampler.push(samples) if resampler is not None else samples
+        if resampler is not None:
+            yield resampler.flush()
+
+    def stats(self):
+        """
+        Returns the audio processed and the CPU time spent on it, in this
+        process, with the hours of audio processed per CPU hour.
+        """
+        return {
+            "audio_seconds": self.audio_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "lookup_seconds": self.lookup_seconds,
+            "hours_per_cpu_hour": self.audio_seconds / self.cpu_seconds if self.cpu_seconds else 0.,
+        }
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class QueryHashes(object):
+    """
+    The hashes of a query with every offset each of them occurs at. A hash
+    repeated in the query is looked up once, and matched against all of its
+    offsets.
+
+    Iterating gives the distinct hashes, in order of first occurrence, and
+    `items` every (hash, offset) occurrence. Offsets are kept as one array
+    grouped by hash: those of the i-th hash are
+    `offsets[starts[i]:starts[i] + counts[i]]`.
+    """
+
+    def __init__(self, pairs=()):
+        super(QueryHashes, self).__init__()
+        grouped = {}
+        for hash, offset in pairs:
+            grouped.setdefault(hash, []).append(offset)
+        self.hashes = list(grouped)
+        self.index = dict((hash, i) for i, hash in enumerate(self.hashes))
+        self.counts = np.array([len(offsets) for offsets in grouped.values()], np.int64)
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.offsets = np.array([offset for offsets in grouped.values() for offset in offsets], np.int64)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __iter__(self):
+        return iter(self.hashes)
+
+    def __contains__(self, hash):
+        return hash in self.index
+
+    def keys(self):
+        return list(self.hashes)
+
+    def offsets_of(self, hash):
+        i = self.index[hash]
+        return self.offsets[self.starts[i]:self.starts[i] + self.counts[i]]
+
+    def items(self):
+        """
+        Yields every (hash, offset) occurrence.
+        """
+        for hash in self.hashes:
+            for offset in self.offsets_of(hash).tolist():
+                yield hash, offset
+
+    def subset(self, hashes):
+        """
+        Returns the query restricted to `hashes`, with all their offsets.
+        """
+        return QueryHashes((hash, offset) for hash in hashes for offset in self.offsets_of(hash).tolist())
+
+    def matches(self, postings):
+        """
+        Yields a (sid, offset_difference) tuple per (hash, sid, offset)
+        posting and query offset of its hash.
+        """
+        for hash, sid, offset in postings:
+            for query_offset in self.offsets_of(hash).tolist():
+                yield sid, offset - query_offset
+
+    def join(self, owners, sids, offsets, query_offsets=False):
+        """
+        Vectorized `matches`, for postings given as arrays along with the
+        index in `hashes` of the hash each of them belongs to.
+
+        Returns a (sids, offset_differences) tuple of int64 arrays, where
+        each posting is repeated once per query offset of its hash, plus
+        the query offsets themselves if `query_offsets` is set.
+        """
+        owners = np.asarray(owners, np.int64)
+        repeats = self.counts[owners]
+        total = int(repeats.sum())
+        # position of every output row within the offsets of its hash
+        first_rows = np.repeat(np.cumsum(repeats) - repeats, repeats)
+        query_rows = np.repeat(self.starts[owners], repeats) + np.arange(total) - first_rows
+        joined = (np.repeat(np.asarray(sids, np.int64), repeats),
+                  np.repeat(np.asarray(offsets, np.int64), repeats) - self.offsets[query_rows])
+        if query_offsets:
+            return joined + (self.offsets[query_rows],)
+        return joined
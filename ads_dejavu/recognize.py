@@ -1,28 +1,50 @@
 import ads_dejavu.fingerprint as fingerprint
 import ads_dejavu.decoder as decoder
+import ads_dejavu.capture as capture
+from ads_dejavu.buffer import RingBuffer
 import numpy as np
-import pyaudio
 import time
-from resampy import resample
 from pydub import AudioSegment
-from pydub.effects import normalize
 
 
 class BaseRecognizer(object):
+    """
+    File, array and audio segment recognizers keep no state between calls:
+    the sample rate and options of a recognition are passed along with it,
+    so one instance can serve many threads at once.
+    """
 
     def __init__(self, dejavu):
         self.dejavu = dejavu
-        self.Fs = fingerprint.DEFAULT_FS
 
-    def _recognize(self, *data):
+    def _recognize(self, *data, Fs=fingerprint.DEFAULT_FS, top_n=None):
         matches = []
         total_hashes = 0
-        audio_len = len(data[-1]) / self.Fs
+        audio_len = len(data[-1]) / float(Fs)
+        if self.dejavu.server_side_alignment:
+            for d in data:
+                extracted_matches = self.dejavu.find_match_histogram(d, Fs=Fs)
+                total_hashes += extracted_matches[1]
+                matches.extend(extracted_matches[0])
+            return self.dejavu.align_histogram(matches, total_hashes, audio_len, top_n=top_n)
+        if self.dejavu.progressive is not None and top_n is None:
+            return self.dejavu.recognize_progressive(data, Fs=Fs)
+
+        # matches come back as (song ids, offset differences) arrays
         for d in data:
-            extracted_matches = self.dejavu.find_matches(d, Fs=self.Fs)
+            extracted_matches = self.dejavu.find_matches(d, Fs=Fs, as_arrays=True)
             total_hashes += extracted_matches[1]
-            matches.extend(extracted_matches[0])
-        return self.dejavu.align_matches(matches, total_hashes, audio_len)
+            matches.append(extracted_matches[0])
+        sids, diffs = zip(*matches)
+        return self.dejavu.align_matches((np.concatenate(sids), np.concatenate(diffs)), total_hashes, audio_len,
+                                         top_n=top_n)
+
+    @staticmethod
+    def _set_match_time(match, t):
+        # a single match, or the candidates list of `top_n`
+        for candidate in (match if isinstance(match, list) else [match] if match else []):
+            candidate['match_time'] = t
+        return match
 
     def recognize(self, *args, **kwargs):
         pass  # base class does nothing
@@ -32,87 +54,99 @@ class FileRecognizer(BaseRecognizer):
     def __init__(self, dejavu):
         super(FileRecognizer, self).__init__(dejavu)
 
-    def recognize_file(self, filename):
-        frames, self.Fs, file_hash, audio_length = decoder.read(filename, self.dejavu.limit)
-        if decoder.RESAMPLE:
-            frames = resample(np.array(frames, dtype=np.int16), self.Fs, fingerprint.DEFAULT_FS, axis=-1)
-            self.Fs = fingerprint.DEFAULT_FS
+    def recognize_file(self, filename, top_n=None):
+        frames, Fs, file_hash, audio_length = decoder.read(filename, self.dejavu.limit)
+        frames, Fs = decoder.preprocess(frames, Fs)
         t = time.time()
-        match = self._recognize(*frames)
+        match = self._recognize(*frames, Fs=Fs, top_n=top_n)
         t = time.time() - t
 
-        if match:
-            match['match_time'] = t
+        return self._set_match_time(match, t)
 
-        return match
-
-    def recognize(self, filename):
-        return self.recognize_file(filename)
+    def recognize(self, filename, top_n=None):
+        return self.recognize_file(filename, top_n=top_n)
 
 
 class MicrophoneRecognizer(BaseRecognizer):
+    """
+    Records for a number of seconds and recognizes the recording. Chunks are
+    copied straight into a preallocated int16 buffer, one row per channel.
+
+    The recording comes from a `capture.CaptureSource`, by default the
+    microphone through PyAudio; `PyAudioSource(callback=True)` records on
+    PortAudio's thread instead of blocking on every chunk, and a
+    `ChunkSource` or `FileSource` plays back audio instead of recording it.
+    """
     default_chunksize   = 8192
-    default_format      = pyaudio.paInt16
     default_channels    = 1 if decoder.CONVERT_TO_MONO else 2
     default_samplerate  = fingerprint.DEFAULT_FS
 
-    def __init__(self, dejavu):
+    def __init__(self, dejavu, source=None):
         super(MicrophoneRecognizer, self).__init__(dejavu)
-        self.audio = pyaudio.PyAudio()
-        self.stream = None
-        self.data = []
+        self.source = source if source is not None else capture.PyAudioSource()
+        self.data = None
         self.channels = MicrophoneRecognizer.default_channels
         self.chunksize = MicrophoneRecognizer.default_chunksize
         self.samplerate = MicrophoneRecognizer.default_samplerate
+        self.recording = False
         self.recorded = False
+        self.exhausted = False
 
     def start_recording(self, channels=default_channels,
                         samplerate=default_samplerate,
-                        chunksize=default_chunksize):
+                        chunksize=default_chunksize,
+                        seconds=None):
+        """
+        seconds: Expected length of the recording, to allocate its buffer
+                 at once, rounded up to whole chunks since the source is
+                 read a chunk at a time. The buffer grows if the recording
+                 is longer.
+        """
         self.chunksize = chunksize
         self.channels = channels
         self.recorded = False
+        self.exhausted = False
         self.samplerate = samplerate
 
-        if self.stream:
-            self.stream.stop_stream()
-            self.stream.close()
-
-        self.stream = self.audio.open(
-            format=self.default_format,
-            channels=channels,
-            rate=samplerate,
-            input=True,
-            frames_per_buffer=chunksize,
-        )
-
-        self.data = [[] for i in range(channels)]
+        if self.recording:
+            self.source.close()
+        chunks = -(-int(samplerate * seconds) // chunksize) if seconds else 1
+        capacity = max(chunks, 1) * chunksize
+        self.data = RingBuffer(capacity, dtype=np.int16, channels=channels)
+        self.source.open(channels, samplerate, chunksize)
+        self.recording = True
 
     def process_recording(self):
-        data = self.stream.read(self.chunksize)
-        nums = np.fromstring(data, np.int16)
-        for c in range(self.channels):
-            self.data[c].extend(nums[c::self.channels])
+        """
+        Adds the next chunk of the source to the recording. Returns False
+        once the source is exhausted.
+        """
+        chunk = self.source.read()
+        if chunk is None:
+            self.exhausted = True
+            return False
+        self.data.append(chunk)
+        return True
 
     def stop_recording(self):
-        self.stream.stop_stream()
-        self.stream.close()
-        self.stream = None
+        self.source.close()
+        self.recording = False
         self.recorded = True
 
     def recognize_recording(self):
         if not self.recorded:
             raise NoRecordingError("Recording was not complete/begun")
-        return self._recognize(*self.data)
+        frames, Fs = decoder.preprocess(self.data.view(), self.samplerate)
+        return self._recognize(*frames, Fs=Fs)
 
     def get_recorded_time(self):
-        return len(self.data[0]) / self.rate
+        return len(self.data) / float(self.samplerate) if self.data is not None else 0.
 
     def recognize(self, seconds=10):
-        self.start_recording()
-        for i in range(0, int(self.samplerate / self.chunksize
-                              * seconds)):
-            self.process_recording()
+        self.start_recording(seconds=seconds)
+        samples = int(self.samplerate * seconds)
+        while len(self.data) < samples and self.process_recording():
+            pass
         self.stop_recording()
         return self.recognize_recording()
 
@@ -121,25 +155,14 @@ class NumpyArrayRecognizer(BaseRecognizer):
     def __init__(self, dejavu):
         super(NumpyArrayRecognizer, self).__init__(dejavu)
 
-    def recognize_array(self, frames, sr):
+    def recognize_array(self, frames, sr, top_n=None):
         t = time.time()
-        if decoder.CONVERT_TO_MONO:
-            frames = np.array([np.mean(frames, axis=0)], dtype=frames.dtype)
-        if decoder.RESAMPLE and sr != fingerprint.DEFAULT_FS and len(frames[-1]) > 0:
-            frames = resample(frames, sr, fingerprint.DEFAULT_FS, axis=-1)
-            self.Fs = fingerprint.DEFAULT_FS
-        if decoder.NORMALIZE and len(frames[-1]) > 0:
-            gain = (-np.iinfo(frames.dtype).min) / np.max(np.abs(frames))
-            frames = np.array(frames * gain, dtype=frames.dtype)
-        match = self._recognize(*frames)
-        t = time.time() - t
-        if match:
-            match['match_time'] = t
-        return match
+        frames, sr = decoder.preprocess(frames, sr)
+        match = self._recognize(*frames, Fs=sr, top_n=top_n)
+        return self._set_match_time(match, time.time() - t)
 
-    def recognize(self, data, sr=44100):
-        self.Fs = sr
-        return self.recognize_array(data, sr)
+    def recognize(self, data, sr=44100, top_n=None):
+        return self.recognize_array(data, sr, top_n=top_n)
 
 
 class AudioSegmentRecognizer(BaseRecognizer):
@@ -153,31 +176,122 @@ class AudioSegmentRecognizer(BaseRecognizer):
         :param audio_segment: pydub.AudioSegment
         :return: Array Numpy in dejavu's desired format
         """
-        data = np.fromstring(audio_segment._data, np.int16)
+        data = np.frombuffer(audio_segment._data, np.int16)
         channels = []
         for chn in range(audio_segment.channels):
             channels.append(data[chn::audio_segment.channels])
         return np.array(channels, dtype=np.int16)
 
-    def recognize_audio_segment(self, audio_segment: AudioSegment):
+    def recognize_audio_segment(self, audio_segment: AudioSegment, top_n=None):
         t = time.time()
-        if decoder.CONVERT_TO_MONO:
-            audio_segment = audio_segment.set_channels(1)
-        if decoder.RESAMPLE:
-            audio_segment = audio_segment.set_frame_rate(fingerprint.DEFAULT_FS)
-            self.Fs = fingerprint.DEFAULT_FS
-        if decoder.NORMALIZE:
-            audio_segment = normalize(audio_segment)
-        frames = AudioSegmentRecognizer.audio_segment_to_array(audio_segment)
-        match = self._recognize(*frames)
-        t = time.time() - t
-        if match:
-            match['match_time'] = t
-        return match
+        frames, Fs = decoder.preprocess(AudioSegmentRecognizer.audio_segment_to_array(audio_segment),
+                                        audio_segment.frame_rate)
+        match = self._recognize(*frames, Fs=Fs, top_n=top_n)
+        return self._set_match_time(match, time.time() - t)
+
+    def recognize(self, audio_segment: AudioSegment, top_n=None):
+        return self.recognize_audio_segment(audio_segment, top_n=top_n)
+
+
+class StreamRecognizer(BaseRecognizer):
+    """
+    Recognizes audio fed continuously, from a live source or any iterator
+    of PCM chunks, and reports a match as soon as it is certain enough
+    instead of after a fixed number of seconds.
+
+    Each chunk only adds the spectrogram columns and peaks it completes,
+    and the hashes completed are looked up right away. Matches of the last
+    `horizon` seconds are aligned after every chunk, and an event is
+    emitted when the best song reaches `threshold` aligned hashes, once
+    per song and offset.
+
+    ```python
+    recognizer = StreamRecognizer(djv, threshold=20)
+    for event in recognizer.recognize(chunks):
+        print(event["song_name"], event["stream_seconds"])
+    ```
+    """
+
+    STREAM_SECONDS = 'stream_seconds'
+
+    def __init__(self, dejavu, threshold=20, horizon=10., tolerance=2):
+        super(StreamRecognizer, self).__init__(dejavu)
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.fingerprinter = fingerprint.StreamFingerprinter()
+        self.horizon_frames = int(horizon * fingerprint.DEFAULT_FS / self.fingerprinter.hop_length)
+        self.reset()
+
+    def reset(self):
+        self.fingerprinter.reset()
+        # carries the resampling filter over chunks not at DEFAULT_FS
+        self._resampler = None
+        # (query offset, sid, offset difference) of the matches in the horizon
+        self._rows = (np.zeros(0, np.int64),) * 3
+        self._last_event = None
+
+    def feed(self, samples, Fs=fingerprint.DEFAULT_FS):
+        """
+        Adds a chunk of int16 samples, with one row per channel if more than
+        one, and returns the match events it triggered. Chunks not sampled
+        at `fingerprint.DEFAULT_FS` are resampled as one stream, so every
+        chunk of the audio must have the same rate.
+        """
+        samples, _ = decoder.preprocess(samples, Fs, mono=True, resample=False, normalize=False)
+        samples = samples[0]
+        if Fs != fingerprint.DEFAULT_FS:
+            if self._resampler is None:
+                self._resampler = decoder.StreamResampler(Fs)
+            elif self._resampler.Fs != Fs:
+                raise ValueError("Sample rate changed from %s to %s within a stream" % (self._resampler.Fs, Fs))
+            samples = self._resampler.push(samples)
+        return self._match(self.fingerprinter.push(samples))
+
+    def close(self):
+        """
+        Processes the end of the audio and returns the last events.
+        """
+        events = []
+        if self._resampler is not None:
+            events += self._match(self.fingerprinter.push(self._resampler.flush()))
+        events += self._match(self.fingerprinter.flush())
+        self.reset()
+        return events
+
+    def _match(self, hashes):
+        if hashes:
+            self._rows = tuple(np.concatenate(columns) for columns in zip(self._rows, self.dejavu.lookup_hashes(hashes)))
+        frame = self.fingerprinter.samples // self.fingerprinter.hop_length
+        keep = self._rows[0] >= frame - self.horizon_frames
+        self._rows = tuple(column[keep] for column in self._rows)
+
+        _, sids, diffs = self._rows
+        song_id, diff, count, rows = self.dejavu._align_arrays(sids, diffs)
+        if count < self.threshold:
+            return []
+        if self._last_event is not None and self._last_event[0] == song_id and \
+                abs(self._last_event[1] - diff) <= self.tolerance:
+            return []
+
+        seconds = self.fingerprinter.samples / float(fingerprint.DEFAULT_FS)
+        horizon = self.horizon_frames * self.fingerprinter.hop_length / float(fingerprint.DEFAULT_FS)
+        event = self.dejavu._match_info(song_id, diff, count, min(seconds, horizon), rows)
+        if not event:
+            return []
+        self._last_event = (song_id, diff)
+        event[StreamRecognizer.STREAM_SECONDS] = seconds
+        return [event]
+
+    def recognize(self, chunks, Fs=fingerprint.DEFAULT_FS):
+        """
+        Yields the match events of an iterable of sample chunks.
+        """
+        for chunk in chunks:
+            for event in self.feed(chunk, Fs=Fs):
+                yield event
+        for event in self.close():
+            yield event
 
-    def recognize(self, audio_segment: AudioSegment):
-        self.Fs = audio_segment.frame_rate
-        return self.recognize_audio_segment(audio_segment)
 
 class NoRecordingError(Exception):
     pass
@@ -0,0 +1,446 @@
+from __future__ import absolute_import
+import collections
+import errno
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import numpy as np
+from pydub import AudioSegment
+
+import ads_dejavu.decoder as decoder
+import ads_dejavu.fingerprint as fingerprint
+
+
+class LookupBatcher(object):
+    """
+    Coalesces the database lookups of concurrent requests. The first lookup
+    waiting opens a batch, which takes every lookup arriving in the next
+    `window` seconds, up to `max_batch` of them, and all their hashes are
+    looked up with a single `Dejavu.match_hashes_batch` query.
+    """
+
+    def __init__(self, dejavu, window=0.005, max_batch=64):
+        super(LookupBatcher, self).__init__()
+        self.dejavu = dejavu
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.lookups = 0
+        self.max_depth = 0
+        self._queue = queue.Queue()
+        self._stopping = False
+        # nothing may be queued after the sentinel `close` puts
+        self._closing = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="dejavu-lookups")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """
+        Lookups waiting for a batch.
+        """
+        return self._queue.qsize()
+
+    def submit(self, mappers):
+        """
+        Looks up a list of `QueryHashes`, one per channel, and returns their
+        lists of (sid, offset_difference) matches once its batch is done.
+        Raises RuntimeError once the batcher is closed.
+        """
+        request = {"mappers": mappers, "done": threading.Event()}
+        with self._closing:
+            if self._stopping:
+                raise RuntimeError("LookupBatcher is closed")
+            self._queue.put(request)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["matches"]
+
+    def _run(self):
+        # the requests queued before the sentinel are all answered
+        stopped = False
+        while not stopped:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(0., deadline - time.time()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                batch.append(request)
+            self._lookup(batch)
+
+    def _lookup(self, batch):
+        mappers = dict(((i, channeln), mapper)
+                       for i, request in enumerate(batch) for channeln, mapper in enumerate(request["mappers"]))
+        try:
+            found = self.dejavu.match_hashes_batch(mappers)
+        except Exception as e:
+            logging.getLogger('dejavu').exception("Failed looking up a batch of %d requests" % len(batch))
+            for request in batch:
+                request["error"] = e
+        else:
+            for i, request in enumerate(batch):
+                request["matches"] = [found[(i, channeln)] for channeln in range(len(request["mappers"]))]
+        self.batches += 1
+        self.lookups += len(batch)
+        for request in batch:
+            request["done"].set()
+
+    def close(self):
+        with self._closing:
+            if not self._stopping:
+                self._stopping = True
+                self._queue.put(None)
+        self._thread.join()
+
+
+class RecognitionServer(object):
+    """
+    Long-running recognition service over HTTP, on a TCP port or a Unix
+    socket, keeping a warm `Dejavu`: its database connection, stop-list and
+    Bloom filter are loaded once and reused by every request.
+
+    Requests are handled on their own threads, which decode and fingerprint
+    the audio, while the database lookups of concurrent requests are
+    coalesced by a `LookupBatcher`.
+
+    POST /recognize takes, by Content-Type:
+      - application/x-npy: an int16 array saved by `np.save`, one row per
+        channel, sampled at the `rate` query parameter
+      - audio/L16: interleaved 16-bit little-endian PCM, with `rate` and
+        `channels` query parameters
+      - anything else: an audio file, decoded by pydub
+    and answers the match information as JSON, or the `top` best candidates.
+    GET /stats answers latency percentiles, queue depth and batch sizes.
+
+    ```python
+    server = RecognitionServer(djv, socket_path="/tmp/dejavu.sock")
+    server.serve_forever()
+    ```
+    """
+
+    def __init__(self, dejavu, host="127.0.0.1", port=9000, socket_path=None, batch_window=0.005, max_batch=64,
+                 history=10000):
+        """
+        socket_path: Unix socket to listen on instead of `host`:`port`.
+        batch_window: Seconds a batch of lookups waits for more requests.
+        max_batch: Requests per batch of lookups.
+        history: Latest requests the latency percentiles are computed over.
+        """
+        super(RecognitionServer, self).__init__()
+        self.dejavu = dejavu
+        self.batcher = LookupBatcher(dejavu, window=batch_window, max_batch=max_batch)
+        self.latencies = collections.deque(maxlen=history)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._warm()
+
+        handler = _handler(self)
+        if socket_path:
+            self.httpd = _UnixHTTPServer(socket_path, handler)
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), handler)
+            self.httpd.daemon_threads = True
+        self.address = socket_path or "http://%s:%d" % self.httpd.server_address[:2]
+
+    def _warm(self):
+        # loads the stop-list and the Bloom filter, and runs the
+        # fingerprinting code once, before the first request pays for it
+        self.dejavu.stoplist
+        self.dejavu.bloom
+        fingerprint.fingerprint(np.zeros(fingerprint.DEFAULT_FS, np.int16))
+
+    def recognize(self, channels, Fs=fingerprint.DEFAULT_FS, top_n=None):
+        """
+        Recognizes int16 channels sampled at `Fs`, looking their hashes up
+        along with those of the other requests in flight.
+        """
+        t = time.time()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            # always at DEFAULT_FS, the rate fingerprints are computed at below
+            channels, _ = decoder.preprocess(channels, Fs, resample=True)
+            mappers = []
+            total_hashes = 0
+            for channel in channels:
+                mapper, hashes = self.dejavu._hash_mapper(fingerprint.fingerprint(channel))
+                mappers.append(mapper)
+                total_hashes += hashes
+            found = self.batcher.submit(mappers)
+            matches = [match for channel_matches in found for match in channel_matches]
+            audio_len = len(channels[-1]) / float(fingerprint.DEFAULT_FS)
+            match = self.dejavu.align_matches(matches, total_hashes, audio_len, top_n=top_n)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        t = time.time() - t
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(t)
+        for candidate in (match if isinstance(match, list) else [match] if match else []):
+            candidate['match_time'] = t
+        return match
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            stats = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "in_flight": self.in_flight,
+                "uptime": time.time() - self.started,
+            }
+        stats.update({
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "queue_depth": self.batcher.depth,
+            "max_queue_depth": self.batcher.max_depth,
+            "batches": self.batcher.batches,
+            "mean_batch": self.batcher.lookups / float(self.batcher.batches) if self.batcher.batches else 0.,
+        })
+        return stats
+
+    def serve_forever(self):
+        logging.getLogger('dejavu').info("Serving recognitions on %s" % self.address)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def start(self):
+        """
+        Serves on a background thread, and returns it.
+        """
+        thread = threading.Thread(target=self.httpd.serve_forever, name="dejavu-server")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.close()
+
+    def close(self):
+        self.httpd.server_close()
+        self.batcher.close()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        path = self.server_address
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            # only a socket left behind by a server that didn't shut down
+            # cleanly is replaced, never a file or a live server's socket
+            if not stat.S_ISSOCK(mode) or not self._stale(path):
+                raise OSError(errno.EADDRINUSE, "Address already in use: %s" % path)
+            os.unlink(path)
+        socketserver.UnixStreamServer.server_bind(self)
+
+    @staticmethod
+    def _stale(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+        return False
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/stats":
+                self._reply(200, server.stats())
+            else:
+                self._reply(404, {"error": "Unknown path %s" % self.path})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/recognize":
+                return self._reply(404, {"error": "Unknown path %s" % self.path})
+            params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                channels, Fs = _read_body(body, self.headers.get("Content-Type", ""), params)
+                top_n = int(params["top"]) if "top" in params else None
+            except Exception as e:
+                return self._reply(400, {"error": "%s: %s" % (type(e).__name__, e)})
+            try:
+                match = server.recognize(channels, Fs, top_n=top_n)
+            except Exception as e:
+                logging.getLogger('dejavu').exception("Failed recognizing a request")
+                return self._reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            self._reply(200, match)
+
+        def _reply(self, status, data):
+            body = json.dumps(data, default=_json_default).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return self.client_address[0] if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            logging.getLogger('dejavu').debug("%s %s" % (self.address_string(), format % args))
+
+    return Handler
+
+
+def _read_body(body, content_type, params):
+    """
+    Returns the (channels, samplerate) of a /recognize request body.
+    """
+    content_type = content_type.split(";")[0].strip().lower()
+    rate = int(params.get("rate", fingerprint.DEFAULT_FS))
+    if rate <= 0:
+        raise ValueError("rate must be positive, got %d" % rate)
+    if content_type == "application/x-npy":
+        return np.load(io.BytesIO(body), allow_pickle=False), rate
+    if content_type == "audio/l16":
+        channels = int(params.get("channels", 1))
+        if channels <= 0:
+            raise ValueError("channels must be positive, got %d" % channels)
+        data = np.frombuffer(body[:len(body) - len(body) % (2 * channels)], "<i2")
+        return data.reshape(-1, channels).T, rate
+    audio_segment = AudioSegment.from_file(io.BytesIO(body))
+    data = np.frombuffer(audio_segment.raw_data, np.int16)
+    return data.reshape(-1, audio_segment.channels).T, audio_segment.frame_rate
+
+
+def _json_default(value):
+    # NumPy scalars coming from the database
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RecognitionClient(object):
+    """
+    Client of a `RecognitionServer`, at an http:// URL or a Unix socket
+    path. Every thread gets its own connection.
+    """
+
+    def __init__(self, address, timeout=60.):
+        super(RecognitionClient, self).__init__()
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, "connection", None) is None:
+            if self.address.startswith("http://"):
+                url = urlparse(self.address)
+                self._local.connection = http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+            else:
+                self._local.connection = _UnixHTTPConnection(self.address, timeout=self.timeout)
+        return self._local.connection
+
+    def _request(self, method, path, body=None, headers=None):
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            data = json.loads(response.read().decode("utf-8"))
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.status != 200:
+            raise RuntimeError("Server answered %d: %s" % (response.status, data.get("error")))
+        return data
+
+    def recognize(self, channels, Fs=fingerprint.DEFAULT_FS, top_n=None):
+        """
+        Sends int16 channels, or a 1-D array for mono, sampled at `Fs`.
+        """
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(channels, dtype=np.int16), allow_pickle=False)
+        params = {"rate": Fs}
+        if top_n is not None:
+            params["top"] = top_n
+        return self._request("POST", "/recognize?" + urlencode(params), buffer.getvalue(),
+                             {"Content-Type": "application/x-npy"})
+
+    def recognize_file(self, filename, top_n=None):
+        with open(filename, "rb") as f:
+            body = f.read()
+        path = "/recognize" + ("?top=%d" % top_n if top_n is not None else "")
+        return self._request("POST", path, body, {"Content-Type": "application/octet-stream"})
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+
+def load_test(client, clips, concurrency, Fs=fingerprint.DEFAULT_FS):
+    """
+    Sends every clip to a server with `concurrency` requests in flight.
+    Returns the latency of each request as seen by the client, and the
+    total seconds taken.
+    """
+    def request(channels):
+        t = time.time()
+        client.recognize(channels, Fs)
+        return time.time() - t
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        t = time.time()
+        latencies = list(executor.map(request, clips))
+        return latencies, time.time() - t
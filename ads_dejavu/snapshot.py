@@ -0,0 +1,250 @@
+from __future__ import absolute_import
+import json
+import logging
+import math
+import os
+import struct
+import time
+import zlib
+from binascii import hexlify, unhexlify
+from itertools import islice
+
+import numpy as np
+
+from ads_dejavu import fingerprint
+from ads_dejavu.database import Database
+
+# Fingerprinting parameters a snapshot was built with, its hashes are only
+# comparable with query hashes computed the same way
+PARAMS = (
+    "DEFAULT_FS", "DEFAULT_WINDOW_SIZE", "DEFAULT_OVERLAP_RATIO", "DEFAULT_FAN_VALUE",
+    "DEFAULT_AMP_MIN", "PEAK_NEIGHBORHOOD_SIZE", "CONNECTIVITY_MASK", "MIN_HASH_TIME_DELTA",
+    "MAX_HASH_TIME_DELTA", "PEAK_SORT", "FINGERPRINT_REDUCTION", "MIN_FREQ", "N_MELS",
+    "AREA_NORMALIZATION", "HTK",
+)
+
+SONG_FIELDS = (
+    Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1,
+    Database.AUDIO_LENGTH, Database.FIELD_NUM_FINGERPRINTS,
+)
+
+
+def fingerprint_params():
+    """
+    Returns the current fingerprinting parameters.
+    """
+    return dict((name, getattr(fingerprint, name)) for name in PARAMS)
+
+
+def hash_dtype():
+    """
+    Numpy type of the hashes in binary format, sized after FINGERPRINT_REDUCTION.
+    """
+    return np.dtype("S%d" % int(math.ceil(fingerprint.FINGERPRINT_REDUCTION / 2.)))
+
+
+class Snapshot(object):
+    """
+    The whole catalog as three columns sorted by hash (binary hashes, song
+    ids and offsets) plus the songs table and the fingerprinting parameters.
+
+    On disk the columns are stored one after the other, each aligned to 64
+    bytes and optionally zlib compressed, followed by a JSON footer describing
+    them. Uncompressed snapshots are memory mapped when loaded, so nothing is
+    read until looked up.
+
+    ```python
+    Snapshot.from_database(db).save("catalog.djv")
+    other_db.import_snapshot("catalog.djv")
+    ```
+    """
+
+    MAGIC = b"DJVSNAP\x00"
+    VERSION = 1
+    # magic, version
+    HEADER = struct.Struct("<8sI")
+    # metadata offset, metadata length, magic
+    TRAILER = struct.Struct("<QQ8s")
+    ALIGNMENT = 64
+    # rows converted at once when reading a database
+    BLOCK_ROWS = 10 ** 6
+    # bytes handed to zlib at once
+    COMPRESS_CHUNK = 2 ** 24
+
+    def __init__(self, hashes, song_ids, offsets, songs, params=None):
+        super(Snapshot, self).__init__()
+        self.hashes = hashes
+        self.song_ids = song_ids
+        self.offsets = offsets
+        self.songs = songs
+        self.params = params or fingerprint_params()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def from_database(cls, db):
+        """
+        Reads the fingerprinted songs of `db` and their fingerprints.
+        """
+        t = time.time()
+        songs = [dict((field, song.get(field)) for field in SONG_FIELDS) for song in db.get_songs()]
+        dtype = hash_dtype()
+
+        blocks = []
+        rows = iter(db.get_fingerprints())
+        while True:
+            block = list(islice(rows, cls.BLOCK_ROWS))
+            if not block:
+                break
+            hashes, song_ids, offsets = zip(*block)
+            blocks.append((np.frombuffer(unhexlify("".join(hashes)), dtype=dtype),
+                           np.array(song_ids, dtype="<u4"),
+                           np.array(offsets, dtype="<u4")))
+
+        if blocks:
+            hashes, song_ids, offsets = (np.concatenate(column) for column in zip(*blocks))
+        else:
+            hashes, song_ids, offsets = np.zeros(0, dtype), np.zeros(0, "<u4"), np.zeros(0, "<u4")
+
+        # fingerprints of songs being inserted right now stay out
+        keep = np.isin(song_ids, np.array([song[Database.FIELD_SONG_ID] for song in songs], dtype="<u4"))
+        if not keep.all():
+            hashes, song_ids, offsets = hashes[keep], song_ids[keep], offsets[keep]
+
+        snapshot = cls(hashes, song_ids, offsets, songs)
+        snapshot.sort()
+        logging.getLogger('dejavu').info("Read %d fingerprints of %d songs in %.2f seconds" %
+                                         (len(snapshot), len(songs), time.time() - t))
+        return snapshot
+
+    def sort(self):
+        """
+        Sorts the columns by hash, if they aren't already.
+        """
+        if len(self.hashes) < 2 or np.all(self.hashes[1:] >= self.hashes[:-1]):
+            return
+        order = np.argsort(self.hashes, kind="stable")
+        self.hashes, self.song_ids, self.offsets = self.hashes[order], self.song_ids[order], self.offsets[order]
+
+    def check_params(self):
+        """
+        Raises ValueError when the snapshot hashes have another width than
+        the current ones, and warns about any other parameter that differs.
+        """
+        current = fingerprint_params()
+        if self.params.get("FINGERPRINT_REDUCTION") != current["FINGERPRINT_REDUCTION"]:
+            raise ValueError("Snapshot hashes have FINGERPRINT_REDUCTION %s, expected %s" %
+                             (self.params.get("FINGERPRINT_REDUCTION"), current["FINGERPRINT_REDUCTION"]))
+        for name, value in sorted(current.items()):
+            if self.params.get(name) != value:
+                logging.getLogger('dejavu').warning("Snapshot was fingerprinted with %s = %s, now %s" %
+                                                    (name, self.params.get(name), value))
+
+    def iter_songs(self):
+        """
+        Yields a (song, hashes) tuple per song, with hashes as the
+        (hash, offset) tuples expected by `Database.insert_hashes`.
+        """
+        order = np.argsort(self.song_ids, kind="stable")
+        song_ids = self.song_ids[order]
+        width = 2 * self.hashes.dtype.itemsize
+        for song in self.songs:
+            sid = song[Database.FIELD_SONG_ID]
+            rows = order[np.searchsorted(song_ids, sid, side="left"):np.searchsorted(song_ids, sid, side="right")]
+            hex_hashes = hexlify(self.hashes[rows].tobytes()).decode().upper()
+            hashes = [hex_hashes[i:i + width] for i in range(0, len(hex_hashes), width)]
+            yield song, list(zip(hashes, self.offsets[rows].tolist()))
+
+    def columns(self):
+        return (("hash", self.hashes), ("song_id", self.song_ids), ("offset", self.offsets))
+
+    def save(self, path, compression="zlib", level=1):
+        """
+        Writes the snapshot to `path`, replacing any previous file atomically.
+
+        compression: "zlib", or None to write a snapshot that can be memory
+                     mapped.
+        """
+        if compression not in ("zlib", None):
+            raise ValueError("Unsupported snapshot compression: %s" % compression)
+
+        t = time.time()
+        columns = []
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+            for name, array in self.columns():
+                f.write(b"\0" * (-f.tell() % self.ALIGNMENT))
+                start = f.tell()
+                raw = memoryview(np.ascontiguousarray(array).view(np.uint8))
+                if compression == "zlib":
+                    compressor = zlib.compressobj(level)
+                    for i in range(0, len(raw), self.COMPRESS_CHUNK):
+                        f.write(compressor.compress(raw[i:i + self.COMPRESS_CHUNK]))
+                    f.write(compressor.flush())
+                else:
+                    f.write(raw)
+                columns.append({
+                    "name": name,
+                    "dtype": array.dtype.str,
+                    "offset": start,
+                    "length": f.tell() - start,
+                    "raw_length": len(raw),
+                })
+
+            metadata = json.dumps({
+                "rows": len(self),
+                "compression": compression,
+                "columns": columns,
+                "songs": self.songs,
+                "params": self.params,
+            }).encode()
+            metadata_offset = f.tell()
+            f.write(metadata)
+            f.write(self.TRAILER.pack(metadata_offset, len(metadata), self.MAGIC))
+        os.replace(tmp_path, path)
+
+        logging.getLogger('dejavu').info("Saved %d fingerprints to %s in %.2f seconds (%d bytes)" %
+                                         (len(self), path, time.time() - t, os.path.getsize(path)))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Reads a snapshot written by `save`. Uncompressed columns are memory
+        mapped read-only unless `mmap` is False.
+        """
+        t = time.time()
+        with open(path, "rb") as f:
+            magic, version = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError("%s is not a dejavu snapshot" % path)
+            if version != cls.VERSION:
+                raise ValueError("Unsupported snapshot version %d in %s" % (version, path))
+            f.seek(-cls.TRAILER.size, os.SEEK_END)
+            metadata_offset, metadata_length, magic = cls.TRAILER.unpack(f.read(cls.TRAILER.size))
+            if magic != cls.MAGIC:
+                raise ValueError("%s is a truncated dejavu snapshot" % path)
+            f.seek(metadata_offset)
+            metadata = json.loads(f.read(metadata_length).decode())
+
+            rows = metadata["rows"]
+            arrays = {}
+            for column in metadata["columns"]:
+                dtype = np.dtype(column["dtype"])
+                if rows == 0:
+                    arrays[column["name"]] = np.zeros(0, dtype)
+                elif metadata["compression"] is None and mmap:
+                    arrays[column["name"]] = np.memmap(path, dtype=dtype, mode="r",
+                                                       offset=column["offset"], shape=(rows,))
+                else:
+                    f.seek(column["offset"])
+                    data = f.read(column["length"])
+                    if metadata["compression"] == "zlib":
+                        data = zlib.decompress(data, zlib.MAX_WBITS, column["raw_length"])
+                    arrays[column["name"]] = np.frombuffer(data, dtype=dtype)
+
+        snapshot = cls(arrays["hash"], arrays["song_id"], arrays["offset"], metadata["songs"], metadata["params"])
+        logging.getLogger('dejavu').info("Loaded %d fingerprints from %s in %.2f seconds" %
+                                         (len(snapshot), path, time.time() - t))
+        return snapshot
@@ -2,6 +2,7 @@ from __future__ import division
 from pydub import AudioSegment
 from ads_dejavu.decoder import path_to_songname
 from ads_dejavu import Dejavu
+from ads_dejavu.recognize import FileRecognizer
 from ads_dejavu.fingerprint import *
 import traceback
 import fnmatch
@@ -9,8 +10,14 @@ import os, re, ast
 import subprocess
 import random
 import logging
+import sys
 from sys import version
 
+try:
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
 if int(version[0]) > 2:
     xrange = range
 
@@ -116,13 +123,49 @@ def autolabeldoubles(rects, ax):
         ax.text(rect.get_x() + rect.get_width() / 2., 1.05 * height, 
             '%s' % round(float(height), 3), ha='center', va='bottom')
 
+def plot_summaries(summaries, results_folder):
+    """
+    Plots the `DejavuTest.summary` of several runs, given as a dictionary
+    of label => summary, side by side for every test length: one figure
+    per metric, saved in `results_folder`.
+    """
+    if plt is None:
+        raise ImportError("Plotting needs matplotlib, install it with `pip install matplotlib`")
+    metrics = [("matched", "Matching Percentage"), ("accurate", "Matching Times Accuracy"),
+               ("confidence", "Confidence"), ("rows_fetched", "Rows Fetched")]
+    labels = list(summaries)
+    width = 0.8 / len(labels)
+    for key, title in metrics:
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        for i, label in enumerate(labels):
+            summary = summaries[label]
+            ind = np.arange(len(summary))
+            rects = ax.bar(ind + i * width, [column[key] for column in summary], width, label=label)
+            autolabeldoubles(rects, ax)
+        ax.set_ylabel(title)
+        ax.set_title(title)
+        ax.set_xticks(ind + width * (len(labels) - 1) / 2.)
+        ax.set_xticklabels([column["seconds"] for column in summary])
+        ax.legend()
+        plt.grid()
+        fig.savefig(os.path.join(results_folder, "%s.png" % key))
+        plt.close(fig)
+
 class DejavuTest(object):
-    def __init__(self, folder, seconds):
+    """
+    Recognizes every test file of the given lengths, generated by
+    `generate_test_files`, with `python -m ads_dejavu` and the `config`
+    file, or in this process with the `dejavu` instance if given.
+    """
+    def __init__(self, folder, seconds, config=None, dejavu=None):
         super(DejavuTest, self).__init__()
 
         self.test_folder = folder
         self.test_seconds = seconds
         self.test_songs = []
+        self.config = config
+        self.dejavu = dejavu
 
         print ("test_seconds", self.test_seconds)
 
@@ -154,6 +197,9 @@ class DejavuTest(object):
         # variable confidence
         self.result_match_confidence = [[0 for x in xrange(self.n_columns)] for x in xrange(self.n_lines)] 
 
+        # variable fingerprint rows fetched from the database
+        self.result_rows_fetched = [[0 for x in xrange(self.n_columns)] for x in xrange(self.n_lines)]
+
         self.begin()
 
     def get_column_id (self, secs):
@@ -169,6 +215,18 @@ class DejavuTest(object):
         return len(self.test_songs) - 1
 
 
+    @staticmethod
+    def parse_result(result):
+        """
+        Reads the match printed by `python -m ads_dejavu -r file`.
+        """
+        result = result.strip()
+        result = result.replace(" \'", ' "')
+        result = result.replace("{\'", '{"')
+        result = result.replace("\':", '":')
+        result = result.replace("\',", '",')
+        return ast.literal_eval(result)
+
     def begin(self):
         for f in self.test_files:
             log_msg('--------------------------------------------------')
@@ -179,14 +237,19 @@ class DejavuTest(object):
             # format: XXXX_offset_length.mp3
             song = path_to_songname(f).split("_")[0]  
             line = self.get_line_id(song)
-            result = subprocess.check_output([
-                "python", 
-                "dejavu.py",
-                '-r',
-                'file', 
-                self.test_folder + "/" + f])
-
-            if result.strip() == "None":
+            if self.dejavu is not None:
+                result = self.dejavu.recognize(FileRecognizer, os.path.join(self.test_folder, f))
+            else:
+                command = [sys.executable, "-m", "ads_dejavu"]
+                if self.config:
+                    command += ["-c", self.config]
+                result = subprocess.check_output(command + [
+                    '-r',
+                    'file', 
+                    self.test_folder + "/" + f]).decode()
+                result = None if result.strip() == "None" else self.parse_result(result)
+
+            if result is None:
                 log_msg('No match')
                 self.result_match[line][col] = 'no'
                 self.result_matching_times[line][col] = 0
@@ -194,15 +257,10 @@ class DejavuTest(object):
                 self.result_match_confidence[line][col] = 0
             
             else:
-                result = result.strip()
-                result = result.replace(" \'", ' "')
-                result = result.replace("{\'", '{"')
-                result = result.replace("\':", '":')
-                result = result.replace("\',", '",')
-
                 # which song did we predict?
-                result = ast.literal_eval(result)
                 song_result = result["song_name"]
+                self.result_rows_fetched[line][col] = result.get(Dejavu.ROWS_FETCHED, 0)
+                log_msg('rows fetched: %s' % self.result_rows_fetched[line][col])
                 log_msg('song: %s' % song)
                 log_msg('song_result: %s' % song_result)
 
@@ -239,6 +297,25 @@ class DejavuTest(object):
                         log_msg('inaccurate match')
             log_msg('--------------------------------------------------\n')
 
-
-
-
+    def summary(self):
+        """
+        Returns, for every test length, the share of files matched to their
+        song and of those matched at the right time, with the mean
+        confidence and query duration of the right matches and the mean
+        rows fetched by every query answered.
+        """
+        summary = []
+        for col, seconds in enumerate(self.test_seconds):
+            lines = range(self.n_lines)
+            matched = [line for line in lines if self.result_match[line][col] == 'yes']
+            accurate = [line for line in matched if self.result_matching_times[line][col] == 0]
+            answered = [line for line in lines if self.result_match[line][col] != 'no']
+            summary.append({
+                "seconds": seconds,
+                "matched": len(matched) / max(self.n_lines, 1),
+                "accurate": len(accurate) / max(self.n_lines, 1),
+                "confidence": np.mean([self.result_match_confidence[line][col] for line in matched]) if matched else 0.,
+                "query_duration": np.mean([self.result_query_duration[line][col] for line in matched]) if matched else 0.,
+                "rows_fetched": np.mean([self.result_rows_fetched[line][col] for line in answered]) if answered else 0.,
+            })
+        return summary
@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import warnings
+from concurrent import futures
+
+import numpy as np
+
+from ads_dejavu import Dejavu, AsyncDejavu
+from ads_dejavu.archive import ArchiveScanner
+from ads_dejavu.recognize import NumpyArrayRecognizer, AudioSegmentRecognizer
+from ads_dejavu.server import RecognitionServer, RecognitionClient, load_test
+from ads_dejavu.testing import DejavuTest, plot_summaries
+import ads_dejavu.decoder as decoder
+import ads_dejavu.fingerprint as fingerprint
+from resampy import resample
+from pydub import AudioSegment
+from pydub.effects import normalize
+
+warnings.filterwarnings("ignore")
+
+DEFAULT_CONFIG_FILE = "dejavu.cnf.SAMPLE"
+
+
+def load_config(configpath):
+    try:
+        with open(configpath) as f:
+            return json.load(f)
+    except IOError as err:
+        print("Cannot open configuration: %s. Exiting" % (str(err)))
+        sys.exit(1)
+
+
+def load_clips(folder, extensions, seconds, count, seed=None):
+    """
+    Returns `count` random clips of `seconds` seconds taken from the audio
+    files in `folder`, as lists of channels sampled at DEFAULT_FS.
+    """
+    rng = random.Random(seed)
+    songs = []
+    for filename, _ in decoder.find_files(folder, extensions):
+        channels, Fs, _, _ = decoder.read(filename)
+        songs.append(decoder.preprocess(channels, Fs, mono=False, resample=True, normalize=False)[0])
+    if not songs:
+        print("No audio files found in %s. Exiting" % folder)
+        sys.exit(1)
+
+    length = int(seconds * fingerprint.DEFAULT_FS)
+    clips = []
+    for _ in range(count):
+        channels = rng.choice(songs)
+        start = rng.randint(0, max(channels.shape[-1] - length, 0))
+        clips.append(list(channels[:, start:start + length]))
+    return clips
+
+
+def summarize(name, latencies, elapsed):
+    latencies = np.array(latencies)
+    stats = {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed else 0.,
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+    }
+    print("%-10s %6d requests in %7.2fs  %8.2f req/s  p50 %.4fs  p99 %.4fs" %
+          (name, stats["requests"], stats["seconds"], stats["requests_per_second"], stats["p50"], stats["p99"]))
+    return stats
+
+
+def recognize_blocking(djv, channels):
+    t = time.time()
+    matches = []
+    total_hashes = 0
+    for channel in channels:
+        extracted_matches, hashes = djv.find_matches(channel, as_arrays=True)
+        matches.append(extracted_matches)
+        total_hashes += hashes
+    sids, diffs = zip(*matches)
+    djv.align_matches((np.concatenate(sids), np.concatenate(diffs)), total_hashes,
+                      len(channels[-1]) / float(fingerprint.DEFAULT_FS))
+    return time.time() - t
+
+
+def bench_threads(config, clips, concurrency):
+    djv = Dejavu(config)
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        t = time.time()
+        latencies = list(executor.map(lambda channels: recognize_blocking(djv, channels), clips))
+        return summarize("threads", latencies, time.time() - t)
+
+
+def bench_async(config, clips, concurrency):
+    async def run():
+        djv = AsyncDejavu(config, executor=futures.ThreadPoolExecutor(max_workers=concurrency))
+        limit = asyncio.Semaphore(concurrency)
+
+        async def request(channels):
+            async with limit:
+                t = time.time()
+                await djv.recognize(channels)
+                return time.time() - t
+
+        try:
+            t = time.time()
+            latencies = await asyncio.gather(*[request(channels) for channels in clips])
+            return summarize("asyncio", latencies, time.time() - t)
+        finally:
+            await djv.close()
+
+    return asyncio.run(run())
+
+
+def async_command(args):
+    config = load_config(args.config)
+    config["read_only"] = True
+    clips = load_clips(args.folder, ["." + args.extension], args.seconds, args.requests, args.seed)
+    results = {}
+    for concurrency in args.concurrency:
+        print("concurrency %d" % concurrency)
+        results[concurrency] = {
+            "threads": bench_threads(config, clips, concurrency),
+            "asyncio": bench_async(config, clips, concurrency),
+        }
+    return results
+
+
+def synthetic_matches(rows, songs=1000, spread=100000, seed=None):
+    """
+    Returns `rows` random (sid, diff) matches, a tenth of them aligned
+    on the same song and offset difference, as two int64 arrays.
+    """
+    rng = np.random.default_rng(seed)
+    sids = rng.integers(1, songs + 1, rows, dtype=np.int64)
+    diffs = rng.integers(-spread, spread, rows, dtype=np.int64)
+    aligned = rng.random(rows) < 0.1
+    sids[aligned] = 1
+    diffs[aligned] = 42
+    return sids, diffs
+
+
+def align_command(args):
+    results = {}
+    for rows in args.rows:
+        sids, diffs = synthetic_matches(rows, spread=args.spread, seed=args.seed)
+        matches = list(zip(sids.tolist(), diffs.tolist()))
+
+        t = time.time()
+        expected = Dejavu._align(matches)
+        loop_seconds = time.time() - t
+        t = time.time()
+        found = Dejavu._align((sids, diffs))
+        arrays_seconds = time.time() - t
+
+        if found != expected:
+            print("Mismatch at %d rows: %s != %s" % (rows, found, expected))
+            sys.exit(1)
+        print("%9d rows  loop %8.4fs  arrays %8.4fs  x%.1f" %
+              (rows, loop_seconds, arrays_seconds, loop_seconds / arrays_seconds if arrays_seconds else 0.))
+        results[rows] = {"loop": loop_seconds, "arrays": arrays_seconds}
+    return results
+
+
+def archive_command(args):
+    config = load_config(args.config)
+    results = {}
+    for processes in args.processes:
+        scanner = ArchiveScanner(config, shard=args.shard, nprocesses=processes)
+        timelines = scanner.scan(scanner.find_channels(args.folder, ["." + args.extension]))
+        stats = dict(scanner.stats, detections=sum(len(timeline) for timeline in timelines.values()))
+        print("%3d processes  %8.0fs of audio in %7.2fs  %8.1f hours/hour  %8.1f hours/CPU hour  %d detections" %
+              (processes, stats["audio_seconds"], stats["seconds"], stats["hours_per_hour"],
+               stats["hours_per_cpu_hour"], stats["detections"]))
+        results[processes] = stats
+    return results
+
+
+def server_command(args):
+    clips = load_clips(args.folder, ["." + args.extension], args.seconds, args.requests, args.seed)
+    server = None
+    address = args.address
+    if address is None:
+        # a server in this process, on a port picked by the system
+        config = load_config(args.config)
+        config["read_only"] = True
+        server = RecognitionServer(Dejavu(config), port=0, batch_window=args.batch_window)
+        server.start()
+        address = server.address
+    client = RecognitionClient(address)
+    results = {}
+    try:
+        for concurrency in args.concurrency:
+            latencies, elapsed = load_test(client, clips, concurrency)
+            stats = summarize("c=%d" % concurrency, latencies, elapsed)
+            stats["server"] = client.stats()
+            print("%10s queue depth max %d  %d batches of %.2f requests  server p50 %.4fs  p99 %.4fs" %
+                  ("", stats["server"]["max_queue_depth"], stats["server"]["batches"],
+                   stats["server"]["mean_batch"], stats["server"]["p50"], stats["server"]["p99"]))
+            results[concurrency] = stats
+    finally:
+        if server is not None:
+            server.shutdown()
+    return results
+
+
+def stress_command(args):
+    """
+    Shares one recognizer between the threads of a pool, with every request
+    at one of several sample rates, and checks each answer against the one
+    given by the same clip recognized alone.
+    """
+    config = load_config(args.config)
+    config["read_only"] = True
+    recognizer = NumpyArrayRecognizer(Dejavu(config))
+    clips = load_clips(args.folder, ["." + args.extension], args.seconds, args.clips, args.seed)
+
+    variants = []
+    for channels in clips:
+        channels = np.array(channels, dtype=np.int16)
+        for rate in args.rates:
+            if rate != fingerprint.DEFAULT_FS:
+                data = resample(channels.astype(np.float64), fingerprint.DEFAULT_FS, rate, axis=-1).astype(np.int16)
+            else:
+                data = channels
+            variants.append((data, rate))
+    expected = [recognizer.recognize(data, rate) for data, rate in variants]
+
+    def answer(match):
+        return (match[Dejavu.SONG_ID], match[Dejavu.OFFSET]) if match else None
+
+    rng = random.Random(args.seed)
+    requests = [rng.randrange(len(variants)) for _ in range(args.requests)]
+
+    def request(i):
+        t = time.time()
+        match = recognizer.recognize(*variants[i])
+        return time.time() - t, answer(match) == answer(expected[i])
+
+    results = {}
+    for concurrency in args.concurrency:
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            t = time.time()
+            done = list(executor.map(request, requests))
+            elapsed = time.time() - t
+        stats = summarize("c=%d" % concurrency, [latency for latency, _ in done], elapsed)
+        stats["mismatches"] = sum(1 for _, same in done if not same)
+        print("%10s %d answers differ from the sequential ones" % ("", stats["mismatches"]))
+        results[concurrency] = stats
+    return results
+
+
+# audio preparation at each entry point before decoder.preprocess
+
+def _normalize_before(channels):
+    gain = (-np.iinfo(channels.dtype).min) / np.max(np.abs(channels))
+    return np.array(channels * gain, dtype=channels.dtype)
+
+
+def _file_before(channels, Fs):
+    # resampled every channel, and neither mixed nor normalized them
+    return resample(channels, Fs, fingerprint.DEFAULT_FS, axis=-1)
+
+
+def _mixed_before(channels, Fs):
+    # _fingerprint_worker and NumpyArrayRecognizer, which mixed, resampled
+    # and normalized even when there was nothing to do
+    channels = np.array([np.mean(channels, axis=0)], dtype=channels.dtype)
+    if Fs != fingerprint.DEFAULT_FS:
+        channels = resample(channels, Fs, fingerprint.DEFAULT_FS, axis=-1).astype(channels.dtype)
+    return _normalize_before(channels)
+
+
+def _segment_before(audio_segment):
+    audio_segment = normalize(audio_segment.set_channels(1).set_frame_rate(fingerprint.DEFAULT_FS))
+    return AudioSegmentRecognizer.audio_segment_to_array(audio_segment)
+
+
+def _segment(channels, Fs):
+    return AudioSegment(np.ascontiguousarray(channels.T).tobytes(), frame_rate=Fs, sample_width=2,
+                        channels=len(channels))
+
+
+def preprocess_command(args):
+    """
+    Times the preparation of audio, and the fingerprinting of the channels it
+    leaves, at every entry point: as each did it before `decoder.preprocess`
+    and with it.
+    """
+    clips = load_clips(args.folder, ["." + args.extension], args.seconds, args.clips, args.seed)
+    entry_points = [
+        ("ingest", _mixed_before, decoder.preprocess, False),
+        ("file", _file_before, decoder.preprocess, False),
+        ("array", _mixed_before, decoder.preprocess, False),
+        ("segment", _segment_before,
+         lambda segment: decoder.preprocess(AudioSegmentRecognizer.audio_segment_to_array(segment),
+                                            segment.frame_rate)[0], True),
+    ]
+    results = {}
+    for rate, nchannels in ((args.rate, 2), (fingerprint.DEFAULT_FS, 1)):
+        inputs = []
+        for channels in clips:
+            # the first channel, and a quieter copy of it for stereo
+            channels = np.array([channels[0] * (1. - 0.5 * c) for c in range(nchannels)])
+            if rate != fingerprint.DEFAULT_FS:
+                channels = resample(channels, fingerprint.DEFAULT_FS, rate, axis=-1)
+            inputs.append(channels.astype(np.int16))
+        segments = [_segment(channels, rate) for channels in inputs]
+
+        name = "%d Hz, %d channel%s" % (rate, nchannels, "s" if nchannels > 1 else "")
+        print(name)
+        results[name] = {}
+        for entry, before, after, takes_segment in entry_points:
+            stats = {}
+            for label, prepare in (("before", before), ("after", after)):
+                prepared_channels = 0
+                t = time.time()
+                for channels, segment in zip(inputs, segments):
+                    prepared = prepare(segment) if takes_segment else prepare(channels, rate)
+                    if isinstance(prepared, tuple):
+                        prepared = prepared[0]
+                    for channel in prepared:
+                        fingerprint.fingerprint(channel)
+                    prepared_channels += len(prepared)
+                stats[label] = {"seconds": time.time() - t, "channels": prepared_channels}
+            print("  %-8s before %7.3fs (%3d channels)  after %7.3fs (%3d channels)  %5.2fx" %
+                  (entry, stats["before"]["seconds"], stats["before"]["channels"], stats["after"]["seconds"],
+                   stats["after"]["channels"], stats["before"]["seconds"] / stats["after"]["seconds"]))
+            results[name][entry] = stats
+    return results
+
+
+def stoplist_command(args):
+    """
+    Runs the testing harness on the clips of `generate_test_files` without
+    a stop-list, then with one rebuilt for `--max-postings`, and compares
+    accuracy and rows fetched. The stop-list is left in the database.
+    """
+    config = load_config(args.config)
+    config["stoplist"] = None
+    djv = Dejavu(config)
+    test_seconds = ['%dsec' % i for i in range(1, args.secs + 1)]
+
+    results = {}
+    for label in ("without", "with"):
+        if label == "with":
+            # "query" leaves the fingerprints in place, only queries skip them
+            djv.stoplist_mode = "query"
+            size = djv.rebuild_stoplist(args.max_postings)
+            print("%d hashes stop-listed" % size)
+        results[label] = DejavuTest(args.folder, test_seconds, dejavu=djv).summary()
+
+    print("%-8s %21s %21s %27s" % ("", "matched", "accurate", "rows fetched"))
+    for without, with_ in zip(results["without"], results["with"]):
+        print("%-8s %6.1f%% -> %6.1f%%  %6.1f%% -> %6.1f%%  %9.1f -> %9.1f (%+.1f%%)" %
+              (without["seconds"], 100 * without["matched"], 100 * with_["matched"],
+               100 * without["accurate"], 100 * with_["accurate"], without["rows_fetched"], with_["rows_fetched"],
+               100. * (with_["rows_fetched"] - without["rows_fetched"]) / (without["rows_fetched"] or 1)))
+    if args.results:
+        plot_summaries(results, args.results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dejavu benchmarks")
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG_FILE,
+                        help='Path to configuration file')
+    parser.add_argument('-o', '--output',
+                        help='Also write the results as JSON to this file')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('async', help='Concurrent recognitions, threads against asyncio')
+    p.add_argument('folder', help='Folder with the audio files clips are taken from')
+    p.add_argument('extension', help='Extension of the audio files')
+    p.add_argument('--seconds', type=float, default=5, help='Seconds per clip')
+    p.add_argument('--requests', type=int, default=200, help='Clips recognized per run')
+    p.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128],
+                   help='Requests in flight')
+    p.add_argument('--seed', type=int, default=None, help='Random seed')
+    p.set_defaults(run=async_command)
+
+    p = subparsers.add_parser('align', help='align_matches, dictionary loop against arrays')
+    p.add_argument('--rows', type=int, nargs='+', default=[10 ** 5, 10 ** 6, 10 ** 7],
+                   help='Matched rows per query')
+    p.add_argument('--spread', type=int, default=100000,
+                   help='Offset differences are drawn from [-spread, spread)')
+    p.add_argument('--seed', type=int, default=None, help='Random seed')
+    p.set_defaults(run=align_command)
+
+    p = subparsers.add_parser('archive', help='Archive scan throughput by number of processes')
+    p.add_argument('folder', help='Folder of recordings, one subdirectory per channel')
+    p.add_argument('extension', help='Extension of the audio files')
+    p.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8],
+                   help='Processes in the pool')
+    p.add_argument('--shard', type=float, default=1800., help='Seconds of audio per shard')
+    p.set_defaults(run=archive_command)
+
+    p = subparsers.add_parser('server', help='Load test of a recognition server')
+    p.add_argument('folder', help='Folder with the audio files clips are taken from')
+    p.add_argument('extension', help='Extension of the audio files')
+    p.add_argument('--address', help='http://host:port or Unix socket of a running server,\n'
+                                     'by default one is started in this process')
+    p.add_argument('--seconds', type=float, default=5, help='Seconds per clip')
+    p.add_argument('--requests', type=int, default=200, help='Clips recognized per run')
+    p.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128],
+                   help='Requests in flight')
+    p.add_argument('--batch-window', type=float, default=0.005,
+                   help='Seconds the server waits to batch lookups')
+    p.add_argument('--seed', type=int, default=None, help='Random seed')
+    p.set_defaults(run=server_command)
+
+    p = subparsers.add_parser('threads', help='One recognizer shared by a thread pool, answers checked')
+    p.add_argument('folder', help='Folder with the audio files clips are taken from')
+    p.add_argument('extension', help='Extension of the audio files')
+    p.add_argument('--seconds', type=float, default=5, help='Seconds per clip')
+    p.add_argument('--clips', type=int, default=50, help='Distinct clips')
+    p.add_argument('--rates', type=int, nargs='+', default=[8000, 22050, 44100],
+                   help='Sample rates every clip is sent at')
+    p.add_argument('--requests', type=int, default=2000, help='Recognitions per run')
+    p.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                   help='Threads in the pool')
+    p.add_argument('--seed', type=int, default=None, help='Random seed')
+    p.set_defaults(run=stress_command)
+
+    p = subparsers.add_parser('preprocess', help='Audio preparation per entry point, before and after '
+                                                 'the shared pipeline')
+    p.add_argument('folder', help='Folder with the audio files clips are taken from')
+    p.add_argument('extension', help='Extension of the audio files')
+    p.add_argument('--seconds', type=float, default=10, help='Seconds per clip')
+    p.add_argument('--clips', type=int, default=20, help='Clips per entry point')
+    p.add_argument('--rate', type=int, default=44100, help='Sample rate of the stereo inputs')
+    p.add_argument('--seed', type=int, default=None, help='Random seed')
+    p.set_defaults(run=preprocess_command)
+
+    p = subparsers.add_parser('stoplist', help='Testing harness accuracy and rows fetched, without and with '
+                                               'a stop-list')
+    p.add_argument('folder', help='Folder of test clips written by testing.generate_test_files')
+    p.add_argument('--secs', type=int, default=5, help='Test clips of 1 to SECS seconds are recognized')
+    p.add_argument('--max-postings', type=int, default=500,
+                   help='Hashes with more fingerprints are stop-listed')
+    p.add_argument('--results', help='Folder the comparison plots are saved to')
+    p.set_defaults(run=stoplist_command)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(0)
+
+    results = args.run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -48,6 +48,7 @@ setup(
     packages=find_packages(),
     platforms=['Unix'],
     install_requires=REQUIREMENTS,
+    extras_require={"async": ["aiomysql"]},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
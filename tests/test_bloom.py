@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.io import wavfile
+
+from ads_dejavu import Dejavu
+from ads_dejavu.bloom import BloomFilter
+from ads_dejavu.recognize import FileRecognizer
+
+
+def _write_song(path, seed, seconds=10, Fs=8000):
+    rng = np.random.RandomState(seed)
+    samples = np.zeros(seconds * Fs)
+    t = np.arange(Fs // 4) / float(Fs)
+    # a quarter-second tone of random pitch after another
+    for i in range(seconds * 4):
+        samples[i * len(t):(i + 1) * len(t)] = np.sin(2 * np.pi * rng.uniform(200, 3500) * t)
+    samples += rng.normal(0, 0.05, len(samples))
+    wavfile.write(path, Fs, (samples / np.abs(samples).max() * 20000).astype(np.int16))
+
+
+class BloomFilterIngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.folder, "catalog.djv")
+        self.config = {
+            "database_type": "memory",
+            "bloom_filter": {"path": os.path.join(self.folder, "catalog.bloom"), "capacity": 100000},
+        }
+        for i, name in enumerate(("old1", "old2", "new")):
+            _write_song(os.path.join(self.folder, name + ".wav"), seed=i)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_song_ingested_after_filter_was_saved(self):
+        djv = Dejavu(self.config)
+        for name in ("old1", "old2"):
+            djv.fingerprint_file(os.path.join(self.folder, name + ".wav"))
+        djv.db.export_snapshot(self.snapshot)
+        # a first query builds and saves the filter
+        self.assertEqual(djv.recognize(FileRecognizer, os.path.join(self.folder, "old1.wav"))["song_name"], "old1")
+        self.assertTrue(os.path.exists(self.config["bloom_filter"]["path"]))
+
+        # another process ingests a song without having queried first
+        config = dict(self.config, database={"snapshot": self.snapshot})
+        djv = Dejavu(config)
+        djv.fingerprint_file(os.path.join(self.folder, "new.wav"))
+        djv.db.export_snapshot(self.snapshot)
+
+        # and the song is found by a process loading the saved filter
+        djv = Dejavu(config)
+        match = djv.recognize(FileRecognizer, os.path.join(self.folder, "new.wav"))
+        self.assertEqual(match["song_name"], "new")
+
+    def test_concurrent_ingests_keep_each_others_songs(self):
+        djv = Dejavu(self.config)
+        djv.fingerprint_file(os.path.join(self.folder, "old1.wav"))
+        djv.db.export_snapshot(self.snapshot)
+        djv.build_bloom_filter()
+
+        # two processes load the saved filter, then each ingests a song
+        config = dict(self.config, database={"snapshot": self.snapshot})
+        first, second = Dejavu(config), Dejavu(config)
+        first.bloom, second.bloom
+        first.fingerprint_file(os.path.join(self.folder, "old2.wav"))
+        second.fingerprint_file(os.path.join(self.folder, "new.wav"))
+
+        saved = BloomFilter.load(self.config["bloom_filter"]["path"])
+        for djv, name in ((first, "old2"), (second, "new")):
+            hashes = [hash for hash, _, _ in djv.db.get_fingerprints()]
+            self.assertTrue(saved.contains_many(hashes).all(), name)
+
+    def test_reader_merges_songs_saved_later(self):
+        djv = Dejavu(self.config)
+        djv.fingerprint_file(os.path.join(self.folder, "old1.wav"))
+        djv.db.export_snapshot(self.snapshot)
+        djv.build_bloom_filter()
+
+        config = dict(self.config, database={"snapshot": self.snapshot})
+        reader = Dejavu(config)
+        self.assertTrue(len(reader.bloom) > 0)
+
+        writer = Dejavu(config)
+        writer.fingerprint_file(os.path.join(self.folder, "new.wav"))
+        hashes = [hash for hash, sid, _ in writer.db.get_fingerprints()
+                  if writer.db.get_song_by_id(sid)["song_name"] == "new"]
+        self.assertTrue(reader.bloom.contains_many(hashes).all())
+
+
+if __name__ == '__main__':
+    unittest.main()